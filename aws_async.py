@@ -0,0 +1,738 @@
+###########################################################################
+####################### ASYNCIO EXECUTION BACKEND #########################
+###########################################################################
+# Async versions of the Create*, Attach* and Get* functions of
+# aws_create_resources.py and aws_ec2_image_builder.py, taking the same
+# arguments and returning the same results:
+#
+#   results = aws_async.RunAsync(asyncio.gather(
+#       aws_async.CreateSubnet(), aws_async.CreateSecurityGroup(), ...
+#   ))
+#
+# With aiobotocore installed every call is a coroutine on the event loop
+# and the clients share one connection pool per (service, region). Without
+# it the shared boto3 clients are called on a bounded thread pool instead.
+#
+# The backend has its own call lanes: up to AWS_ASYNC_MAX_IN_FLIGHT calls
+# per (service, region), halved on throttling, at the AWS_CALL_RATE_LIMITS
+# rates unless AWS_ASYNC_RATE_LIMITS raises them. The rate is what bounds
+# the calls in flight in practice (rate x latency, 20/s on EC2 by
+# default), so raise it for the services and accounts that allow it to
+# keep thousands of requests in flight on a single thread.
+###########################################################################
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
+
+from botocore.exceptions import ClientError
+
+import aws_call_executor
+import aws_client_factory
+import aws_create_resources as resources
+import aws_ec2_image_builder as imageBuilder
+from aws_ip_allocator import CreateNetworkInterface as CreatePlannedNetworkInterface
+from aws_inventory import AWS_INVENTORY_SMALL_PAGE_SIZE, Filters, PaginationMembers
+from aws_resource_cache import CacheKey
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:
+    AioConfig = None
+    get_session = None
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Async Backend Configuration
+########################################################################
+AWS_ASYNC_MAX_IN_FLIGHT = 2000
+# {service: calls per second} of the async lanes, over AWS_CALL_RATE_LIMITS
+AWS_ASYNC_RATE_LIMITS = {}
+AWS_ASYNC_MAX_POOL_CONNECTIONS = 500
+AWS_ASYNC_FALLBACK_WORKERS = 64
+
+
+def HasNativeAsync():
+    """
+    True when aiobotocore is installed
+    """
+    return get_session is not None
+
+
+########################################################################
+## Call lanes
+########################################################################
+def _SetDone(future):
+    if not future.done():
+        future.set_result(None)
+
+
+async def AcquireLane(lane):
+    """
+    Async counterpart of lane.bucket.Acquire() and lane.limiter.Acquire():
+    waits on the event loop instead of blocking it. The caller releases the
+    slot with lane.limiter.Release().
+    """
+    wait = lane.bucket.TryAcquire()
+    while wait:
+        await asyncio.sleep(wait)
+        wait = lane.bucket.TryAcquire()
+    loop = asyncio.get_running_loop()
+    while not lane.limiter.TryAcquire():
+        future = loop.create_future()
+        woken = []
+
+        def Wakeup():
+            # Called from whichever thread releases a slot
+            woken.append(True)
+            try:
+                loop.call_soon_threadsafe(_SetDone, future)
+            except RuntimeError:
+                pass
+
+        lane.limiter.AddWakeup(Wakeup)
+        try:
+            # A slot freed before the wakeup was queued is not signalled
+            if lane.limiter.TryAcquire():
+                return
+            await future
+        except BaseException:
+            # A cancelled waiter passes the slot it was woken for on
+            if woken:
+                lane.limiter.WakeOne()
+            raise
+        finally:
+            lane.limiter.RemoveWakeup(Wakeup)
+
+
+########################################################################
+## Backend
+########################################################################
+class AsyncBackend:
+    """
+    Clients and call lanes of one event loop. Each (service, region) lane
+    has a token bucket at rateLimits (by default AWS_ASYNC_RATE_LIMITS over
+    AWS_CALL_RATE_LIMITS) and an adaptive limit of maxInFlight calls, with
+    the retry policy and call listeners of aws_call_executor.ExecuteCall().
+    """
+
+    def __init__(
+            self,
+            native=None,
+            maxInFlight=AWS_ASYNC_MAX_IN_FLIGHT,
+            rateLimits=None,
+            maxPoolConnections=AWS_ASYNC_MAX_POOL_CONNECTIONS,
+            fallbackWorkers=AWS_ASYNC_FALLBACK_WORKERS,
+    ):
+        self.native = HasNativeAsync() if native is None else native
+        if self.native and not HasNativeAsync():
+            raise ImportError("The native asyncio backend needs aiobotocore")
+        self.maxPoolConnections = maxPoolConnections
+        self.fallbackWorkers = fallbackWorkers
+        self.maxInFlight = maxInFlight
+        self.rateLimits = dict(AWS_ASYNC_RATE_LIMITS if rateLimits is None else rateLimits)
+        self.lanes = {}
+        self.clients = {}
+        self.clientsLock = asyncio.Lock()
+        self.resolveLocks = {}
+        self.stack = AsyncExitStack()
+        self.session = get_session() if self.native else None
+        self.executor = None if self.native else ThreadPoolExecutor(max_workers=fallbackWorkers)
+
+    async def Client(self, service, region_name=None, accessKey=None, secretAccessKey=None, sessionToken=None):
+        """
+        Getting the shared client of this loop for (service, region, credentials)
+        """
+        key = (service, region_name, accessKey, secretAccessKey, sessionToken)
+        client = self.clients.get(key)
+        if client is not None:
+            return client
+        async with self.clientsLock:
+            client = self.clients.get(key)
+            if client is None:
+                if self.native:
+                    client = await self.stack.enter_async_context(self.session.create_client(
+                        service,
+                        region_name=region_name,
+                        aws_access_key_id=accessKey,
+                        aws_secret_access_key=secretAccessKey,
+                        aws_session_token=sessionToken,
+                        config=AioConfig(
+                            max_pool_connections=self.maxPoolConnections,
+                            retries={"mode": "standard", "total_max_attempts": 1},
+                        ),
+                    ))
+                    aws_client_factory.ApplyClientListeners(client)
+                else:
+                    client = aws_client_factory.GetClient(
+                        service, region_name, accessKey, secretAccessKey, sessionToken,
+                        maxPoolConnections=self.fallbackWorkers,
+                    )
+                self.clients[key] = client
+        return client
+
+    def Lane(self, service, region):
+        """
+        Call lane of this loop for (service, region)
+        """
+        lane = self.lanes.get((service, region))
+        if lane is None:
+            lane = self.lanes[(service, region)] = aws_call_executor.CallLane(
+                service, region, rate=self.rateLimits.get(service), maxConcurrency=self.maxInFlight
+            )
+        return lane
+
+    async def _Invoke(self, client, operation, kwargs):
+        method = getattr(client, operation)
+        if self.native:
+            return await method(**kwargs)
+        # Run in a copy of the context so botocore hooks see the attempt number
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(context.run, method, **kwargs)
+        )
+
+    async def Call(self, client, operation, maxAttempts=aws_call_executor.AWS_CALL_MAX_ATTEMPTS, **kwargs):
+        """
+        ExecuteCall() for coroutines
+        """
+        lane = self.Lane(client.meta.service_model.service_name, client.meta.region_name)
+        apiName = aws_call_executor.OperationName(client, operation) or operation
+        # Every attempt sends the same idempotency token
+        kwargs = aws_call_executor.WithIdempotencyTokens(client, operation, kwargs)
+        throttles = 0
+        for attempt in range(maxAttempts):
+            await AcquireLane(lane)
+            aws_call_executor.SetCurrentAttempt(attempt + 1)
+            try:
+                res = await self._Invoke(client, operation, kwargs)
+            except (ClientError,) + aws_call_executor.AWS_CONNECTION_ERRORS as error:
+                failure = error
+            else:
+                failure = None
+            finally:
+                aws_call_executor.SetCurrentAttempt(0)
+                # Cancellation included, the lane slot goes back
+                lane.limiter.Release()
+
+            if failure is None:
+                lane.bucket.Succeeded()
+                lane.limiter.Succeeded()
+                aws_call_executor.NotifyCallListeners(
+                    lane.service, lane.region, apiName, attempt + 1, throttles, None
+                )
+                return res
+            if aws_call_executor.IsThrottlingError(failure):
+                throttles += 1
+                lane.bucket.Throttled()
+                lane.limiter.Throttled()
+            if not aws_call_executor.IsRetryableError(failure) or attempt == maxAttempts - 1:
+                aws_call_executor.NotifyCallListeners(
+                    lane.service, lane.region, apiName, attempt + 1, throttles, failure
+                )
+                raise failure
+            delay = aws_call_executor.BackoffDelay(attempt)
+            logger.warning(
+                f"{lane.service}.{operation} in {lane.region} failed with "
+                f"{aws_call_executor.ErrorCode(failure)}, retrying in {delay:.2f}s (attempt {attempt + 1})"
+            )
+            await asyncio.sleep(delay)
+
+    async def Iterate(self, client, operation, resultKey, pageSize=None, **kwargs):
+        """
+        Async counterpart of aws_inventory.IterateResources()
+        """
+        token, size = PaginationMembers(client, operation)
+        if size and pageSize:
+            kwargs[size] = pageSize
+        while True:
+            page = await self.Call(client, operation, **kwargs)
+            for item in page.get(resultKey, []):
+                yield item
+            nextToken = page.get(token) if token else None
+            if not nextToken:
+                return
+            kwargs[token] = nextToken
+
+    async def Resolve(self, region, resourceType, filters, loader):
+        """
+        Async counterpart of ResourceIdCache.Resolve() on the shared cache
+        """
+        cache = resources.AWS_RESOURCE_ID_CACHE
+        resourceId = cache.Get(region, resourceType, filters)
+        if resourceId is not None:
+            return resourceId
+        lock = self.resolveLocks.setdefault(CacheKey(region, resourceType, filters), asyncio.Lock())
+        async with lock:
+            resourceId = cache.Get(region, resourceType, filters)
+            if resourceId is None:
+                resourceId = cache.Put(region, resourceType, await loader(), filters)
+        return resourceId
+
+    async def ToThread(self, func, *args):
+        """
+        Run a blocking helper (e.g. a component cache sync) off the loop
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def Close(self):
+        await self.stack.aclose()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+_BACKENDS = weakref.WeakKeyDictionary()
+
+
+def GetAsyncBackend():
+    """
+    Backend of the running event loop, created on first use
+    """
+    loop = asyncio.get_running_loop()
+    backend = _BACKENDS.get(loop)
+    if backend is None:
+        backend = _BACKENDS[loop] = AsyncBackend()
+        logger.info(f"Async backend: {'aiobotocore' if backend.native else 'thread pool fallback'}")
+    return backend
+
+
+async def CloseAsyncBackend():
+    backend = _BACKENDS.pop(asyncio.get_running_loop(), None)
+    if backend is not None:
+        await backend.Close()
+
+
+def RunAsync(awaitable):
+    """
+    asyncio.run() an awaitable and close the loop's clients afterwards
+    """
+    async def Run():
+        try:
+            return await awaitable
+        finally:
+            await CloseAsyncBackend()
+
+    return asyncio.run(Run())
+
+
+########################################################################
+## EC2 resources (aws_create_resources.py)
+########################################################################
+async def _EC2Client():
+    return await GetAsyncBackend().Client(
+        'ec2',
+        region_name=resources.StackRegion(),
+        accessKey=resources.AWS_ACCESS_KEY_ID,
+        secretAccessKey=resources.AWS_SECRET_ACCESS_KEY,
+    )
+
+
+async def _EC2Call(operation, **kwargs):
+    return await GetAsyncBackend().Call(await _EC2Client(), operation, **kwargs)
+
+
+async def _FirstId(operation, resultKey, filters, idKey, description):
+    backend = GetAsyncBackend()
+    async for item in backend.Iterate(
+            await _EC2Client(), operation, resultKey, AWS_INVENTORY_SMALL_PAGE_SIZE, Filters=Filters(filters)
+    ):
+        if resultKey == 'Reservations':
+            if not item['Instances']:
+                continue
+            item = item['Instances'][0]
+        return item[idKey]
+    raise LookupError(f"No {description} found")
+
+
+async def CreateEC2Instance():
+    try:
+        res = await _EC2Call('run_instances', **resources.EC2InstanceParams())
+    except ClientError:
+        logging.exception("******************************** ERROR: Unable to create EC2 instance")
+        raise
+    else:
+        ec2 = resources.GetEC2Resource()
+        instances = [ec2.Instance(instance['InstanceId']) for instance in res['Instances']]
+        resources.AWS_RESOURCE_ID_CACHE.Put(
+            resources.StackRegion(), 'instance', instances[0].id, resources.CacheFilters('instance')
+        )
+        return instances
+
+
+async def CreateVPC():
+    try:
+        res = await _EC2Call('create_default_vpc')
+    except ClientError:
+        logging.exception("******************************** ERROR: Unable to create a default VPC")
+        raise
+    else:
+        resources.AWS_RESOURCE_ID_CACHE.Put(
+            resources.StackRegion(), 'vpc', res['Vpc']['VpcId'], resources.CacheFilters('vpc')
+        )
+        return res
+
+
+async def CreateSecurityGroup():
+    try:
+        res = await _EC2Call('create_security_group', **resources.SecurityGroupParams(await GetVPCIds()))
+    except ClientError as error:
+        resources.AWS_RESOURCE_ID_CACHE.InvalidateOnNotFound(error, resources.StackRegion())
+        logging.exception("******************************** ERROR: Unable to create a security group")
+        raise
+    else:
+        resources.AWS_RESOURCE_ID_CACHE.Put(
+            resources.StackRegion(), 'security-group', res['GroupId'], resources.CacheFilters('security-group'),
+        )
+        return resources.GetEC2Resource().SecurityGroup(res['GroupId'])
+
+
+async def CreateInternetGateway():
+    try:
+        res = await _EC2Call('create_internet_gateway', **resources.InternetGatewayParams())
+    except ClientError:
+        logging.exception("******************************** ERROR: Unable to create a internet gateway")
+        raise
+    else:
+        gatewayId = res['InternetGateway']['InternetGatewayId']
+        resources.AWS_RESOURCE_ID_CACHE.Put(
+            resources.StackRegion(), 'internet-gateway', gatewayId, resources.CacheFilters('internet-gateway')
+        )
+        return resources.GetEC2Resource().InternetGateway(gatewayId)
+
+
+async def CreateSubnet():
+    try:
+        res = await _EC2Call('create_subnet', **resources.SubnetParams(await GetVPCIds()))
+    except ClientError as error:
+        resources.AWS_RESOURCE_ID_CACHE.InvalidateOnNotFound(error, resources.StackRegion())
+        logging.exception("******************************** ERROR: Unable to create a subnet")
+        raise
+    else:
+        subnetId = res['Subnet']['SubnetId']
+        resources.AWS_RESOURCE_ID_CACHE.Put(
+            resources.StackRegion(), 'subnet', subnetId, resources.CacheFilters('subnet')
+        )
+        return resources.GetEC2Resource().Subnet(subnetId)
+
+
+async def CreateNetworkInterface():
+    try:
+        securityGroupId, subnetId = await asyncio.gather(GetSecurityGroupIds(), GetSubnetIds())
+        # Address planning reads the subnet with blocking calls; the
+        # parameters are built in this task's context (the current stack)
+        nic = await GetAsyncBackend().ToThread(
+            contextvars.copy_context().run, CreatePlannedNetworkInterface,
+            resources.GetEC2Client(), subnetId,
+            functools.partial(resources.NetworkInterfaceParams, securityGroupId),
+            resources.CurrentStack()['privateIpAddress'],
+        )
+    except ClientError as error:
+        resources.AWS_RESOURCE_ID_CACHE.InvalidateOnNotFound(error, resources.StackRegion())
+        logging.exception("******************************** ERROR: Unable to create a network interface")
+        raise
+    else:
+        nicId = nic['NetworkInterfaceId']
+        resources.AWS_RESOURCE_ID_CACHE.Put(
+            resources.StackRegion(), 'network-interface', nicId, resources.CacheFilters('network-interface')
+        )
+        return resources.GetEC2Resource().NetworkInterface(nicId)
+
+
+async def CreateRouteTable():
+    try:
+        res = await _EC2Call('create_route_table', **resources.RouteTableParams(await GetVPCIds()))
+    except ClientError as error:
+        resources.AWS_RESOURCE_ID_CACHE.InvalidateOnNotFound(error, resources.StackRegion())
+        logging.exception("******************************** ERROR: Unable to create a route table")
+        raise
+    else:
+        routeTableId = res['RouteTable']['RouteTableId']
+        resources.AWS_RESOURCE_ID_CACHE.Put(
+            resources.StackRegion(), 'route-table', routeTableId, resources.CacheFilters('route-table')
+        )
+        return resources.GetEC2Resource().RouteTable(routeTableId)
+
+
+async def AttachInternetGatewayToVPC():
+    try:
+        gatewayId, vpcId = await asyncio.gather(GetInternetGatewayIds(), GetVPCIds())
+        return await _EC2Call('attach_internet_gateway', **resources.AttachInternetGatewayParams(gatewayId, vpcId))
+    except ClientError as error:
+        resources.AWS_RESOURCE_ID_CACHE.InvalidateOnNotFound(error, resources.StackRegion())
+        logging.exception("******************************** ERROR: Unable to attach an internet gateway to VPC")
+        raise
+
+
+async def AttachNetworkInterfaceToEC2():
+    try:
+        instanceId, nicId = await asyncio.gather(GetEC2InstanceIds(), GetNICIds())
+        return await _EC2Call('attach_network_interface', **resources.AttachNetworkInterfaceParams(instanceId, nicId))
+    except ClientError as error:
+        resources.AWS_RESOURCE_ID_CACHE.InvalidateOnNotFound(error, resources.StackRegion())
+        logging.exception("******************************** ERROR: Unable to attach a network interface to EC2 instance")
+        raise
+
+
+async def GetVPCIds():
+    return await GetAsyncBackend().Resolve(
+        resources.StackRegion(), 'vpc', resources.CacheFilters('vpc'),
+        lambda: _FirstId('describe_vpcs', 'Vpcs', resources.AWS_DEFAULT_VPC_FILTER, 'VpcId', 'default VPC'),
+    )
+
+
+async def GetSecurityGroupIds():
+    async def Load():
+        return await _FirstId(
+            'describe_security_groups', 'SecurityGroups',
+            resources.SecurityGroupLookupFilters(await GetVPCIds()),
+            'GroupId', f"security group {resources.CurrentStack()['securityGroupName']}",
+        )
+
+    return await GetAsyncBackend().Resolve(
+        resources.StackRegion(), 'security-group', resources.CacheFilters('security-group'), Load
+    )
+
+
+async def GetSubnetIds():
+    async def Load():
+        return await _FirstId(
+            'describe_subnets', 'Subnets', resources.SubnetLookupFilters(await GetVPCIds()),
+            'SubnetId', f"subnet {resources.CurrentStack()['cidrBlock']}",
+        )
+
+    return await GetAsyncBackend().Resolve(resources.StackRegion(), 'subnet', resources.CacheFilters('subnet'), Load)
+
+
+async def GetEC2InstanceIds():
+    return await GetAsyncBackend().Resolve(
+        resources.StackRegion(), 'instance', resources.CacheFilters('instance'),
+        lambda: _FirstId(
+            'describe_instances', 'Reservations', resources.EC2InstanceLookupFilters(),
+            'InstanceId', f"instance {resources.CurrentStack()['instanceName']}",
+        ),
+    )
+
+
+async def GetNICIds():
+    return await GetAsyncBackend().Resolve(
+        resources.StackRegion(), 'network-interface', resources.CacheFilters('network-interface'),
+        lambda: _FirstId(
+            'describe_network_interfaces', 'NetworkInterfaces', resources.NICLookupFilters(),
+            'NetworkInterfaceId', 'network interface',
+        ),
+    )
+
+
+async def GetInternetGatewayIds():
+    return await GetAsyncBackend().Resolve(
+        resources.StackRegion(), 'internet-gateway', resources.CacheFilters('internet-gateway'),
+        lambda: _FirstId(
+            'describe_internet_gateways', 'InternetGateways', resources.InternetGatewayLookupFilters(),
+            'InternetGatewayId', 'internet gateway',
+        ),
+    )
+
+
+async def RunResourceGraph(graph):
+    """
+    Run a ResourceGraph whose node functions are coroutine functions (e.g.
+    BuildAsyncResourceGraph()) on the running loop: every node starts as
+    soon as its dependencies are done. Returns {node: result}.
+    """
+    tasks = {}
+
+    async def RunNode(node):
+        if node.dependsOn:
+            await asyncio.gather(*(tasks[name] for name in node.dependsOn))
+        results = {name: tasks[name].result() for name in node.dependsOn}
+        started = time.perf_counter()
+        res = await node.Call(results)
+        logger.info(f"{node.name}: OK took={time.perf_counter() - started:.3f}s")
+        return res
+
+    graph.Validate()
+    for name in graph.nodes:
+        tasks[name] = asyncio.ensure_future(RunNode(graph.nodes[name]))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for task in tasks.values():
+            task.cancel()
+    return {name: task.result() for name, task in tasks.items()}
+
+
+def BuildAsyncResourceGraph(existing=None):
+    """
+    aws_create_resources.BuildResourceGraph() with the async functions
+    """
+    graph = resources.BuildResourceGraph(existing)
+    for node in graph.nodes.values():
+        asyncFunc = globals().get(node.func.__name__)
+        if asyncFunc is not None:
+            node.func = asyncFunc
+        else:
+            node.func = _AsAwaitable(node.func)
+    return graph
+
+
+def _AsAwaitable(func):
+    async def Call(*args, **kwargs):
+        return func(*args, **kwargs)
+
+    return Call
+
+
+########################################################################
+## Image Builder resources (aws_ec2_image_builder.py)
+########################################################################
+def _ImageBuilderCredentials(region_name):
+    # Set by aws_ec2_image_builder.py when run as a script
+    return {
+        "region_name": region_name or getattr(imageBuilder, "region_name", None),
+        "accessKey": getattr(imageBuilder, "accessKey", None),
+        "secretAccessKey": getattr(imageBuilder, "secretAccessKey", None),
+    }
+
+
+async def _ImageBuilderCall(region_name, operation, **kwargs):
+    backend = GetAsyncBackend()
+    client = await backend.Client("imagebuilder", **_ImageBuilderCredentials(region_name))
+    return await backend.Call(client, operation, **kwargs)
+
+
+async def CreateComponent(
+        componentName, componentSemanticVersion, componentPlatform, component_data, region_name=None
+):
+    backend = GetAsyncBackend()
+    # The component cache may sync through the blocking client
+    client = aws_client_factory.GetClient("imagebuilder", **_ImageBuilderCredentials(region_name))
+    try:
+        cached, semanticVersion, tags, contentHash = await backend.ToThread(
+            imageBuilder.LookupCachedComponent,
+            client, componentName, componentSemanticVersion, componentPlatform, component_data,
+        )
+        if cached:
+            return cached
+        res = await _ImageBuilderCall(
+            region_name, "create_component",
+            **imageBuilder.ComponentParams(componentName, semanticVersion, componentPlatform, component_data, tags)
+        )
+    except ClientError as error:
+        if await backend.ToThread(imageBuilder.ShouldResyncComponent, client, componentName, error):
+            return await CreateComponent(
+                componentName, componentSemanticVersion, componentPlatform, component_data, region_name
+            )
+        logger.exception("******* Could not create a component")
+        raise
+    else:
+        if imageBuilder.COMPONENT_CACHE is not None:
+            imageBuilder.COMPONENT_CACHE.Record(
+                client.meta.region_name, componentName, contentHash,
+                semanticVersion, res["componentBuildVersionArn"],
+            )
+        return res
+
+
+async def CreateImageRecipe(
+        recipeName,
+        recipeSemanticVersion,
+        componentName,
+        region_name,
+        recipeImageName,
+        recipeOsVersion,
+        accountId,
+        componentArn=None,
+):
+    try:
+        return await _ImageBuilderCall(
+            region_name, "create_image_recipe",
+            **imageBuilder.ImageRecipeParams(
+                recipeName, recipeSemanticVersion, componentName, region_name,
+                recipeImageName, recipeOsVersion, accountId, componentArn,
+            )
+        )
+    except ClientError:
+        logger.exception("******* Could not create image recipe")
+        raise
+
+
+async def CreateImageDistributionConfiguration(
+        distributionName,
+        region_name,
+        targetRegions=None,
+        targetAccountIds=None,
+):
+    try:
+        return await _ImageBuilderCall(
+            region_name, "create_distribution_configuration",
+            **imageBuilder.DistributionConfigurationParams(
+                distributionName, region_name, targetRegions, targetAccountIds
+            )
+        )
+    except ClientError:
+        logger.exception("******* Could not create image distribution configuration")
+        raise
+
+
+async def CreateImageInfrastructureConfiguration(
+        infrastructureName,
+        infrastructureType,
+        infrastructureInstanceProfileRoleName,
+        region_name=None,
+):
+    try:
+        return await _ImageBuilderCall(
+            region_name, "create_infrastructure_configuration",
+            **imageBuilder.InfrastructureConfigurationParams(
+                infrastructureName, infrastructureType, infrastructureInstanceProfileRoleName
+            )
+        )
+    except ClientError:
+        logger.exception("******* Could not create image infrastructure configuration")
+        raise
+
+
+async def CreateImagePipeline(
+        imagePipelineName,
+        region_name,
+        accountId,
+        recipeName,
+        recipeSemanticVersion,
+        infrastructureName,
+        distributionName,
+):
+    try:
+        return await _ImageBuilderCall(
+            region_name, "create_image_pipeline",
+            **imageBuilder.ImagePipelineParams(
+                imagePipelineName, region_name, accountId, recipeName,
+                recipeSemanticVersion, infrastructureName, distributionName,
+            )
+        )
+    except ClientError:
+        logger.exception("******* Could not create image pipeline")
+        raise
+
+
+async def CreateStartImagepipelineExecution(
+        imagePipelineName,
+        region_name,
+        accountId,
+):
+    try:
+        return await _ImageBuilderCall(
+            region_name, "start_image_pipeline_execution",
+            **imageBuilder.PipelineExecutionParams(imagePipelineName, region_name, accountId)
+        )
+    except ClientError:
+        logger.exception("******* Could not execute image pipeline")
+        raise
@@ -0,0 +1,280 @@
+###########################################################################
+############## IMAGE BUILD PROGRESS EXPORT (NEWLINE-DELIMITED JSON) #######
+###########################################################################
+# Follows image build versions and writes one JSON object per line for
+# every transition, to stdout or appended to a file that dashboards tail:
+#
+#   {"event": "build", "build": "<arn>", "previous": "PENDING", "status": "BUILDING", ...}
+#   {"event": "workflow", "build": "<arn>", "workflow": "<id>", "type": "BUILD", "status": "RUNNING", ...}
+#   {"event": "step", "build": "<arn>", "workflow": "<id>", "step": "<name>", "status": "COMPLETED", ...}
+#   {"event": "image", "build": "<arn>", "amis": [{"region": ..., "image": "ami-...", ...}]}
+#
+#   $ python aws_build_log_export.py -Builds <ARN>,<ARN> -Output builds.ndjson
+###########################################################################
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from aws_call_executor import AWS_CALL_MAX_ATTEMPTS, ErrorCode, ExecuteCallWithRetries, IsThrottlingError
+from aws_image_waiter import AWS_IMAGE_TERMINAL_STATUSES, ImageBuildWaiter, ParseImageBuildVersionArn
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Export Configuration
+########################################################################
+AWS_WORKFLOW_TERMINAL_STATUSES = frozenset(
+    ["COMPLETED", "FAILED", "SKIPPED", "CANCELLED", "ROLLBACK_COMPLETED"]
+)
+
+
+########################################################################
+## Output
+########################################################################
+class NdjsonWriter:
+    """
+    Thread-safe newline-delimited JSON output, flushed after every line so
+    that readers tailing the file see transitions as they happen
+    """
+
+    def __init__(self, output=None):
+        if output in (None, "-"):
+            self.stream, self.owned = sys.stdout, False
+        else:
+            self.stream, self.owned = open(output, "a"), True
+        self.lock = threading.Lock()
+        self.lines = 0
+
+    def Write(self, record):
+        line = json.dumps(record, sort_keys=True, default=str) + "\n"
+        with self.lock:
+            self.stream.write(line)
+            self.stream.flush()
+            self.lines += 1
+
+    def Close(self):
+        if self.owned:
+            self.stream.close()
+
+
+########################################################################
+## Exporter
+########################################################################
+class BuildLogExporter(ImageBuildWaiter):
+    """
+    ImageBuildWaiter which also follows the workflow executions and steps of
+    every running build and the AMIs of every finished one. Only running
+    builds are asked for their workflows and only running workflows for
+    their steps; what is known about a build is dropped once it finishes,
+    so memory follows the number of builds in flight. A finished build
+    stays in its poll group until its last workflows and AMIs are exported.
+    """
+
+    def __init__(self, writer, clientFactory=None, **kwargs):
+        super().__init__(clientFactory=clientFactory, **kwargs)
+        self.writer = writer
+        self.workflows = {}
+        self.steps = {}
+        self.finishing = set()
+        self.listAttempts = 1
+        self.Subscribe(self._OnBuildEvent)
+
+    def _Write(self, event, **fields):
+        fields["event"] = event
+        fields["time"] = time.time()
+        self.writer.Write(fields)
+
+    def _OnBuildEvent(self, event):
+        self._Write(
+            "build",
+            build=event["arn"],
+            previous=event["previous"],
+            status=event["status"],
+            reason=event["reason"],
+        )
+
+    def _List(self, client, operation, resultKey, **kwargs):
+        while True:
+            self.apiCalls += 1
+            res = ExecuteCallWithRetries(client, operation, kwargs, maxAttempts=self.listAttempts)
+            yield from res.get(resultKey, [])
+            if not res.get("nextToken"):
+                return
+            kwargs["nextToken"] = res["nextToken"]
+
+    def _PollSteps(self, client, build, workflowId):
+        known = self.steps.setdefault(workflowId, {})
+        changed = False
+        for step in self._List(client, "list_workflow_step_executions", "steps", workflowExecutionId=workflowId):
+            previous = known.get(step["stepExecutionId"])
+            if step.get("status") == previous:
+                continue
+            changed = True
+            known[step["stepExecutionId"]] = step.get("status")
+            self._Write(
+                "step",
+                build=build,
+                workflow=workflowId,
+                step=step.get("name"),
+                stepId=step["stepExecutionId"],
+                action=step.get("action"),
+                previous=previous,
+                status=step.get("status"),
+                message=step.get("message"),
+                startTime=step.get("startTime"),
+                endTime=step.get("endTime"),
+            )
+        return changed
+
+    def _PollWorkflows(self, client, build):
+        """
+        Export the workflow and step transitions of a build; True on change
+        """
+        known = self.workflows.setdefault(build, {})
+        changed = False
+        for execution in self._List(
+                client, "list_workflow_executions", "workflowExecutions", imageBuildVersionArn=build
+        ):
+            workflowId = execution["workflowExecutionId"]
+            previous = known.get(workflowId)
+            if previous in AWS_WORKFLOW_TERMINAL_STATUSES:
+                continue
+            status = execution.get("status")
+            if status != previous:
+                changed = True
+                known[workflowId] = status
+                self._Write(
+                    "workflow",
+                    build=build,
+                    workflow=workflowId,
+                    type=execution.get("type"),
+                    previous=previous,
+                    status=status,
+                    message=execution.get("message"),
+                )
+            # A finished workflow is read a last time, then forgotten
+            changed |= self._PollSteps(client, build, workflowId)
+            if status in AWS_WORKFLOW_TERMINAL_STATUSES:
+                self.steps.pop(workflowId, None)
+        return changed
+
+    def _ExportImage(self, client, build):
+        self.apiCalls += 1
+        image = ExecuteCallWithRetries(client, "get_image", {"imageBuildVersionArn": build}).get("image", {})
+        self._Write(
+            "image",
+            build=build,
+            name=image.get("name"),
+            version=image.get("version"),
+            amis=(image.get("outputResources") or {}).get("amis", []),
+        )
+
+    def _Finalize(self, client, build):
+        """
+        Read the workflows of a finished build a last time, export its AMIs
+        and forget it
+        """
+        self._PollWorkflows(client, build)
+        if self.statuses[build] == "AVAILABLE":
+            self._ExportImage(client, build)
+        for workflowId in self.workflows.pop(build, {}):
+            self.steps.pop(workflowId, None)
+        self.finishing.discard(build)
+
+    def _PollGroup(self, group):
+        running = sorted(group.arns)
+        if not super()._PollGroup(group):
+            return False
+        client = self.clientFactory(group.region)
+        changed = throttled = False
+        for build in running:
+            if self.statuses.get(build) in AWS_IMAGE_TERMINAL_STATUSES:
+                self.finishing.add(build)
+            if throttled:
+                continue
+            try:
+                if build in self.finishing:
+                    self._Finalize(client, build)
+                else:
+                    changed |= self._PollWorkflows(client, build)
+            except ClientError as error:
+                if not IsThrottlingError(error):
+                    raise
+                throttled = True
+                group.interval = min(group.interval * 2, self.maxInterval)
+                logger.warning(f"Throttled while reading the workflows of {build}, reading the rest later")
+        # Finished builds are polled until they have been exported
+        for build in running:
+            if build in self.finishing:
+                group.arns.add(build)
+            elif self.statuses.get(build) in AWS_IMAGE_TERMINAL_STATUSES:
+                group.arns.discard(build)
+        if changed and not throttled:
+            group.interval = self.minInterval
+        return True
+
+    def _Sweep(self):
+        """
+        Read every build still known once more, with retries, so that
+        nothing which already happened is left out when the export stops
+        """
+        self.listAttempts = AWS_CALL_MAX_ATTEMPTS
+        for build in sorted(set(self.workflows) | self.finishing):
+            client = self.clientFactory(ParseImageBuildVersionArn(build)[0])
+            try:
+                if build in self.finishing:
+                    self._Finalize(client, build)
+                else:
+                    self._PollWorkflows(client, build)
+            except ClientError as error:
+                logger.warning(f"Could not read the last state of {build}: {ErrorCode(error)}")
+
+    def Run(self, timeout=None):
+        try:
+            return super().Run(timeout)
+        finally:
+            self._Sweep()
+
+
+def ExportBuildLogs(imageBuildVersionArns, output=None, clientFactory=None, timeout=None):
+    """
+    Follow image build versions until they finish, writing their progress
+    as newline-delimited JSON to output (a path, or stdout)
+    """
+    writer = NdjsonWriter(output)
+    exporter = BuildLogExporter(writer, clientFactory=clientFactory)
+    try:
+        for arn in imageBuildVersionArns:
+            exporter.Track(arn)
+        statuses = exporter.Run(timeout=timeout)
+    finally:
+        writer.Close()
+    logger.info(f"Build log export: {writer.lines} events, {exporter.apiCalls} API calls")
+    return statuses
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s: %(levelname)s: %(message)s", stream=sys.stderr)
+    parser = argparse.ArgumentParser(description="Exporting image build progress as newline-delimited JSON")
+    parser.add_argument("-Builds", help="Comma-separated image build version ARNs")
+    parser.add_argument("-Builds_file", help="File with one image build version ARN per line")
+    parser.add_argument("-Output", default="-", help="NDJSON file to append to, - for stdout")
+    parser.add_argument("-Timeout", type=float)
+    args = parser.parse_args()
+
+    arns = args.Builds.split(",") if args.Builds else []
+    if args.Builds_file:
+        with open(args.Builds_file) as buildsFile:
+            arns += [line.strip() for line in buildsFile if line.strip()]
+    if not arns:
+        parser.error("-Builds or -Builds_file is required")
+    statuses = ExportBuildLogs(arns, args.Output, timeout=args.Timeout)
+    raise SystemExit(0 if all(status == "AVAILABLE" for status in statuses.values()) else 1)
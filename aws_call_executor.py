@@ -0,0 +1,352 @@
+###########################################################################
+############## ADAPTIVE THROTTLING AND RETRY CALL EXECUTOR ################
+###########################################################################
+import contextvars
+import logging
+import random
+import threading
+import time
+import uuid
+
+from botocore import xform_name
+from botocore.exceptions import ClientError, ConnectionClosedError, EndpointConnectionError, ReadTimeoutError
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Call Executor Configuration
+########################################################################
+AWS_CALL_RATE_LIMITS = {
+    "ec2": 20.0,
+    "imagebuilder": 10.0,
+}
+AWS_CALL_DEFAULT_RATE_LIMIT = 10.0
+AWS_CALL_MIN_RATE_LIMIT = 0.5
+AWS_CALL_MAX_CONCURRENCY = 32
+AWS_CALL_MAX_ATTEMPTS = 8
+AWS_CALL_BACKOFF_BASE = 0.2
+AWS_CALL_BACKOFF_CAP = 20.0
+AWS_THROTTLING_ERRORS = frozenset([
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "SlowDown",
+])
+AWS_TRANSIENT_ERRORS = frozenset([
+    "InternalError",
+    "InternalFailure",
+    "InternalServerError",
+    "InternalServerException",
+    "ServiceUnavailable",
+    "ServiceUnavailableException",
+    "RequestTimeout",
+    "RequestTimeoutException",
+])
+AWS_CONNECTION_ERRORS = (ConnectionClosedError, EndpointConnectionError, ReadTimeoutError)
+
+
+########################################################################
+## Rate limiting and adaptive concurrency
+########################################################################
+class TokenBucket:
+    """
+    Thread-safe token bucket; Acquire() blocks until a token is available
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.maxRate = rate
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _Refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def TryAcquire(self):
+        """
+        Take a token if one is available and return 0, otherwise return the
+        seconds to wait before trying again
+        """
+        with self.lock:
+            self._Refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def Acquire(self):
+        while True:
+            wait = self.TryAcquire()
+            if not wait:
+                return
+            self.sleep(wait)
+
+    def Throttled(self):
+        with self.lock:
+            self.rate = max(AWS_CALL_MIN_RATE_LIMIT, self.rate * 0.7)
+
+    def Succeeded(self):
+        with self.lock:
+            if self.rate < self.maxRate:
+                self.rate = min(self.maxRate, self.rate + self.maxRate * 0.05)
+
+
+class ConcurrencyLimiter:
+    """
+    AIMD limit of in-flight calls: halved on throttling, grown by one call
+    per window of successes. Waiters that cannot block a thread (event
+    loops) use TryAcquire() and queue a wakeup, called (once) when a slot
+    may have been freed for them.
+    """
+
+    def __init__(self, maxLimit=AWS_CALL_MAX_CONCURRENCY):
+        self.maxLimit = maxLimit
+        self.limit = float(maxLimit)
+        self.inFlight = 0
+        self.condition = threading.Condition()
+        # Insertion-ordered set of the queued wakeups
+        self.wakeups = {}
+
+    def TryAcquire(self):
+        with self.condition:
+            if self.inFlight >= int(self.limit):
+                return False
+            self.inFlight += 1
+            return True
+
+    def Acquire(self):
+        with self.condition:
+            while self.inFlight >= int(self.limit):
+                self.condition.wait()
+            self.inFlight += 1
+
+    def AddWakeup(self, callback):
+        with self.condition:
+            self.wakeups[callback] = None
+
+    def RemoveWakeup(self, callback):
+        with self.condition:
+            self.wakeups.pop(callback, None)
+
+    def WakeOne(self):
+        """
+        Call the oldest queued wakeup, e.g. to pass on a wakeup its waiter
+        could not use
+        """
+        with self.condition:
+            if self.wakeups:
+                callback = next(iter(self.wakeups))
+                del self.wakeups[callback]
+                callback()
+
+    def Release(self):
+        with self.condition:
+            self.inFlight -= 1
+            self.condition.notify()
+            self.WakeOne()
+
+    def Throttled(self):
+        with self.condition:
+            self.limit = max(1.0, self.limit / 2)
+
+    def Succeeded(self):
+        with self.condition:
+            if self.limit < self.maxLimit:
+                self.limit = min(float(self.maxLimit), self.limit + 1 / self.limit)
+                self.condition.notify_all()
+                self.WakeOne()
+
+
+class CallLane:
+    """
+    Rate limiter and concurrency limiter of one (service, region)
+    """
+
+    def __init__(self, service, region, rate=None, maxConcurrency=AWS_CALL_MAX_CONCURRENCY):
+        self.service = service
+        self.region = region
+        self.bucket = TokenBucket(rate or AWS_CALL_RATE_LIMITS.get(service, AWS_CALL_DEFAULT_RATE_LIMIT))
+        self.limiter = ConcurrencyLimiter(maxConcurrency)
+
+
+_LANES = {}
+_LANES_LOCK = threading.Lock()
+_LISTENERS = []
+# A context variable rather than a thread-local, so that it follows both
+# threads and asyncio tasks
+_CURRENT_ATTEMPT = contextvars.ContextVar("aws_call_attempt", default=0)
+
+
+def GetCallLane(service, region):
+    key = (service, region)
+    lane = _LANES.get(key)
+    if lane is None:
+        with _LANES_LOCK:
+            lane = _LANES.setdefault(key, CallLane(service, region))
+    return lane
+
+
+def ResetCallLanes():
+    """
+    Forget the adapted rates and limits of every lane
+    """
+    with _LANES_LOCK:
+        _LANES.clear()
+
+
+def AddCallListener(callback):
+    """
+    Register callback(service, region, operation, attempts, throttles, error)
+    invoked once per ExecuteCall, with the API name of the operation (e.g.
+    RunInstances); aws_metrics counts retries and throttles this way
+    """
+    _LISTENERS.append(callback)
+
+
+def NotifyCallListeners(service, region, operation, attempts, throttles, error):
+    for listener in _LISTENERS:
+        listener(service, region, operation, attempts, throttles, error)
+
+
+########################################################################
+## Call execution
+########################################################################
+def CurrentAttempt():
+    """
+    Attempt number (1-based) of the ExecuteCall running in this thread or
+    task, 0 outside of ExecuteCall; lets botocore event hooks tell retries apart
+    """
+    return _CURRENT_ATTEMPT.get()
+
+
+def SetCurrentAttempt(attempt):
+    _CURRENT_ATTEMPT.set(attempt)
+
+
+def _ClientOf(target):
+    client = getattr(target.meta, "client", None)
+    return client if client is not None else target
+
+
+def OperationName(target, operation):
+    """
+    API name (e.g. RunInstances) behind a client method or a resource
+    action, None when there is none
+    """
+    model = getattr(target.meta, "resource_model", None)
+    if model is not None:
+        for action in model.actions:
+            if xform_name(action.name) == operation:
+                return action.request.operation
+        return None
+    return target.meta.method_to_api_mapping.get(operation)
+
+
+def WithIdempotencyTokens(target, operation, kwargs):
+    """
+    kwargs with one token for every idempotency member of the operation
+    (e.g. ClientToken) the caller did not set. botocore generates a new one
+    per request, so without it a retry of a call the server had already
+    carried out would create the resources a second time.
+    """
+    client = _ClientOf(target)
+    operationName = OperationName(target, operation)
+    if operationName is None:
+        return kwargs
+    members = client.meta.service_model.operation_model(operationName).idempotent_members
+    missing = [member for member in members if member not in kwargs]
+    if not missing:
+        return kwargs
+    token = str(uuid.uuid4())
+    return dict(kwargs, **{member: token for member in missing})
+
+
+def ErrorCode(error):
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code", "")
+    return type(error).__name__
+
+
+def IsThrottlingError(error):
+    return isinstance(error, ClientError) and ErrorCode(error) in AWS_THROTTLING_ERRORS
+
+
+def IsRetryableError(error):
+    if isinstance(error, AWS_CONNECTION_ERRORS):
+        return True
+    return isinstance(error, ClientError) and (
+        ErrorCode(error) in AWS_THROTTLING_ERRORS or ErrorCode(error) in AWS_TRANSIENT_ERRORS
+    )
+
+
+def BackoffDelay(attempt):
+    """
+    Exponential backoff with full jitter
+    """
+    return random.uniform(0, min(AWS_CALL_BACKOFF_CAP, AWS_CALL_BACKOFF_BASE * 2 ** attempt))
+
+
+def ExecuteCall(target, operation, **kwargs):
+    """
+    Call target.<operation>(**kwargs) on a boto3 client or resource through
+    the per-service/region token bucket and concurrency limit, retrying
+    throttling and transient errors with jittered exponential backoff
+    """
+    return ExecuteCallWithRetries(target, operation, kwargs)
+
+
+def ExecuteCallWithRetries(target, operation, kwargs, maxAttempts=AWS_CALL_MAX_ATTEMPTS):
+    """
+    ExecuteCall() with an explicit number of attempts
+    """
+    client = _ClientOf(target)
+    lane = GetCallLane(client.meta.service_model.service_name, client.meta.region_name)
+    method = getattr(target, operation)
+    apiName = OperationName(target, operation) or operation
+    # Every attempt sends the same idempotency token
+    kwargs = WithIdempotencyTokens(target, operation, kwargs)
+    throttles = 0
+
+    for attempt in range(maxAttempts):
+        lane.bucket.Acquire()
+        lane.limiter.Acquire()
+        SetCurrentAttempt(attempt + 1)
+        try:
+            res = method(**kwargs)
+        except (ClientError,) + AWS_CONNECTION_ERRORS as error:
+            if IsThrottlingError(error):
+                throttles += 1
+                lane.bucket.Throttled()
+                lane.limiter.Throttled()
+            if not IsRetryableError(error) or attempt == maxAttempts - 1:
+                NotifyCallListeners(lane.service, lane.region, apiName, attempt + 1, throttles, error)
+                raise
+            retryError = error
+        else:
+            lane.bucket.Succeeded()
+            lane.limiter.Succeeded()
+            NotifyCallListeners(lane.service, lane.region, apiName, attempt + 1, throttles, None)
+            return res
+        finally:
+            # Any exception, hooks and interrupts included, gives the slot back
+            SetCurrentAttempt(0)
+            lane.limiter.Release()
+        delay = BackoffDelay(attempt)
+        logger.warning(
+            f"{lane.service}.{operation} in {lane.region} failed with {ErrorCode(retryError)}, "
+            f"retrying in {delay:.2f}s (attempt {attempt + 1})"
+        )
+        time.sleep(delay)
@@ -0,0 +1,175 @@
+###########################################################################
+################### SHARED BOTO3 SESSION AND CLIENT FACTORY ###############
+###########################################################################
+import logging
+import threading
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Client Pool Configuration
+########################################################################
+AWS_CLIENT_MAX_POOL_CONNECTIONS = 50
+AWS_CLIENT_TCP_KEEPALIVE = True
+
+_SESSIONS = {}
+_CLIENTS = {}
+_REGISTRY_LOCK = threading.Lock()
+_RESOURCE_CLASSES = {}
+_THREAD_RESOURCES = threading.local()
+_GENERATION = 0
+_CLIENT_LISTENERS = []
+
+
+########################################################################
+## Sessions and clients registry
+########################################################################
+def _CredentialsKey(accessKey, secretAccessKey, sessionToken):
+    return (accessKey, secretAccessKey, sessionToken)
+
+
+def GetSession(accessKey=None, secretAccessKey=None, sessionToken=None):
+    """
+    Getting the process-wide boto3 session for a set of credentials
+    """
+    key = _CredentialsKey(accessKey, secretAccessKey, sessionToken)
+    session = _SESSIONS.get(key)
+    if session is None:
+        with _REGISTRY_LOCK:
+            session = _SESSIONS.get(key)
+            if session is None:
+                import boto3.session
+
+                session = boto3.session.Session(
+                    aws_access_key_id=accessKey,
+                    aws_secret_access_key=secretAccessKey,
+                    aws_session_token=sessionToken,
+                )
+                _SESSIONS[key] = session
+    return session
+
+
+def _ClientConfig(maxPoolConnections, tcpKeepalive):
+    from botocore.config import Config
+
+    # Retries are left to aws_call_executor so that throttling is not
+    # retried twice (once by botocore, once by the executor)
+    return Config(
+        max_pool_connections=maxPoolConnections,
+        tcp_keepalive=tcpKeepalive,
+        retries={"mode": "standard", "total_max_attempts": 1},
+    )
+
+
+def GetClient(
+        service,
+        region_name=None,
+        accessKey=None,
+        secretAccessKey=None,
+        sessionToken=None,
+        maxPoolConnections=None,
+        tcpKeepalive=None,
+):
+    """
+    Getting a shared, pooled client keyed by (service, region, credentials).
+    boto3 clients are thread-safe, so one instance serves every thread.
+    """
+    maxPoolConnections = maxPoolConnections or AWS_CLIENT_MAX_POOL_CONNECTIONS
+    tcpKeepalive = AWS_CLIENT_TCP_KEEPALIVE if tcpKeepalive is None else tcpKeepalive
+    key = (
+        service,
+        region_name,
+        _CredentialsKey(accessKey, secretAccessKey, sessionToken),
+        maxPoolConnections,
+        tcpKeepalive,
+    )
+    client = _CLIENTS.get(key)
+    if client is None:
+        session = GetSession(accessKey, secretAccessKey, sessionToken)
+        with _REGISTRY_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                logger.debug(f"Creating {service} client for {region_name}")
+                client = session.client(
+                    service,
+                    region_name=region_name,
+                    config=_ClientConfig(maxPoolConnections, tcpKeepalive),
+                )
+                ApplyClientListeners(client)
+                _CLIENTS[key] = client
+    return client
+
+
+def AddClientListener(callback):
+    """
+    Register callback(client) for every client of the registry, e.g. to
+    attach botocore event hooks; it is applied to existing clients too
+    """
+    with _REGISTRY_LOCK:
+        _CLIENT_LISTENERS.append(callback)
+        for client in _CLIENTS.values():
+            callback(client)
+
+
+def ApplyClientListeners(client):
+    """
+    Apply the registered listeners to a client built outside of the
+    registry (e.g. an aiobotocore client)
+    """
+    for listener in _CLIENT_LISTENERS:
+        listener(client)
+
+
+def GetResource(
+        service,
+        region_name=None,
+        accessKey=None,
+        secretAccessKey=None,
+        sessionToken=None,
+):
+    """
+    Getting a boto3 resource for the calling thread. Resources are not
+    thread-safe, so each thread keeps its own, cached like the clients and
+    built on the shared client. The resource class is made once per
+    (service, credentials), so a new thread does not build a client of its
+    own just to throw it away.
+    """
+    key = (service, region_name, _CredentialsKey(accessKey, secretAccessKey, sessionToken))
+    if getattr(_THREAD_RESOURCES, "generation", None) != _GENERATION:
+        # The registry was cleared since this thread last built a resource
+        _THREAD_RESOURCES.resources = {}
+        _THREAD_RESOURCES.generation = _GENERATION
+    resource = _THREAD_RESOURCES.resources.get(key)
+    if resource is None:
+        client = GetClient(service, region_name, accessKey, secretAccessKey, sessionToken)
+        resource = _ResourceClass(service, region_name, key[2])(client=client)
+        _THREAD_RESOURCES.resources[key] = resource
+    return resource
+
+
+def _ResourceClass(service, region_name, credentialsKey):
+    classKey = (service, credentialsKey)
+    resourceClass = _RESOURCE_CLASSES.get(classKey)
+    if resourceClass is None:
+        session = GetSession(*credentialsKey)
+        with _REGISTRY_LOCK:
+            resourceClass = _RESOURCE_CLASSES.get(classKey)
+            if resourceClass is None:
+                resourceClass = type(session.resource(service, region_name=region_name))
+                _RESOURCE_CLASSES[classKey] = resourceClass
+    return resourceClass
+
+
+def ClearClients():
+    """
+    Forget every cached session and client
+    """
+    global _GENERATION
+    with _REGISTRY_LOCK:
+        _CLIENTS.clear()
+        _SESSIONS.clear()
+        _RESOURCE_CLASSES.clear()
+        _GENERATION += 1
@@ -0,0 +1,194 @@
+###########################################################################
+############### CONTENT-ADDRESSED IMAGE BUILDER COMPONENT CACHE ###########
+###########################################################################
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from aws_call_executor import ExecuteCall
+from aws_inventory import IterateResources
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Component Cache Configuration
+########################################################################
+AWS_COMPONENT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "aws-automation", "components.json")
+AWS_COMPONENT_CONTENT_HASH_TAG_KEY = "automation:content-hash"
+AWS_COMPONENT_CACHE_SYNC_WORKERS = 8
+
+
+########################################################################
+## Content hashing and versions
+########################################################################
+def ComponentContentHash(componentPlatform, supportedOsVersions, component_data):
+    """
+    SHA-256 of the canonical form (sorted keys, no whitespace) of everything
+    a component is built from; key order and formatting do not matter
+    """
+    canonical = json.dumps(
+        {
+            "platform": componentPlatform,
+            "supportedOsVersions": sorted(supportedOsVersions or []),
+            "data": component_data,
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _VersionKey(version):
+    return tuple(int(part) for part in version.split("."))
+
+
+def NextSemanticVersion(requested, existingVersions):
+    """
+    The requested version when it is still free, otherwise the patch after
+    the highest existing version
+    """
+    if requested not in existingVersions:
+        return requested
+    major, minor, patch = max(_VersionKey(version) for version in existingVersions)
+    return f"{major}.{minor}.{patch + 1}"
+
+
+def ComponentVersionArn(arn):
+    """
+    Version ARN (.../component/<name>/<version>) of a component build version ARN
+    """
+    return arn.rsplit("/", 1)[0] if arn.split(":", 5)[5].count("/") == 3 else arn
+
+
+########################################################################
+## On-disk index
+########################################################################
+class ComponentCache:
+    """
+    Index of {region/component name: {content hash: {version, arn}}} kept in
+    a JSON file. With sync, the entries of a component are reconciled with
+    list_components/get_component the first time it is looked up, so
+    components created elsewhere (or deleted since) are accounted for.
+    """
+
+    def __init__(self, path=AWS_COMPONENT_CACHE_PATH, sync=False):
+        self.path = path
+        self.sync = sync
+        self.lock = threading.RLock()
+        self.synced = set()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as indexFile:
+                self.entries = json.load(indexFile).get("components", {})
+
+    @staticmethod
+    def _Key(region, componentName):
+        return f"{region}/{componentName.lower()}"
+
+    def Save(self):
+        """
+        Atomically rewrite the index file
+        """
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "w") as indexFile:
+                json.dump({"version": 1, "components": self.entries}, indexFile, indent=2, sort_keys=True)
+            os.replace(temporary, self.path)
+
+    def Record(self, region, componentName, contentHash, version, arn):
+        with self.lock:
+            self.entries.setdefault(self._Key(region, componentName), {})[contentHash] = {
+                "version": version,
+                "arn": arn,
+            }
+            self.Save()
+
+    def Versions(self, client, componentName):
+        """
+        Versions of a component known to the index (synced first if enabled)
+        """
+        self._SyncOnce(client, componentName)
+        with self.lock:
+            key = self._Key(client.meta.region_name, componentName)
+            return {entry["version"] for entry in self.entries.get(key, {}).values()}
+
+    def Lookup(self, client, componentName, contentHash):
+        """
+        ARN of the component built from contentHash, or None
+        """
+        self._SyncOnce(client, componentName)
+        with self.lock:
+            entry = self.entries.get(self._Key(client.meta.region_name, componentName), {}).get(contentHash)
+        return entry["arn"] if entry else None
+
+    def IsSynced(self, client, componentName):
+        return self._Key(client.meta.region_name, componentName) in self.synced
+
+    def _SyncOnce(self, client, componentName):
+        if self.sync and not self.IsSynced(client, componentName):
+            self.Sync(client, componentName)
+
+    def Sync(self, client, componentName):
+        """
+        Rebuild the entries of a component from the account: one name-filtered
+        list_components call, then get_component only for versions the index
+        does not know yet (their content hash comes from the tag set at
+        creation, or from the document itself)
+        """
+        region = client.meta.region_name
+        key = self._Key(region, componentName)
+        versions = {
+            summary["version"]: summary["arn"]
+            for summary in IterateResources(
+                client, "list_components", "componentVersionList",
+                owner="Self", filters=[{"name": "name", "values": [componentName]}],
+            )
+            if summary["name"].lower() == componentName.lower()
+        }
+        with self.lock:
+            known = {
+                entry["version"]: contentHash
+                for contentHash, entry in self.entries.get(key, {}).items()
+                if entry["version"] in versions
+            }
+        unknown = [version for version in versions if version not in known]
+
+        def Describe(version):
+            component = ExecuteCall(client, "get_component", componentBuildVersionArn=versions[version])["component"]
+            contentHash = component.get("tags", {}).get(AWS_COMPONENT_CONTENT_HASH_TAG_KEY)
+            if not contentHash:
+                contentHash = ComponentContentHash(
+                    component.get("platform"),
+                    component.get("supportedOsVersions"),
+                    yaml.safe_load(component.get("data") or "{}"),
+                )
+            return version, contentHash, component["arn"]
+
+        described = []
+        if unknown:
+            with ThreadPoolExecutor(max_workers=min(AWS_COMPONENT_CACHE_SYNC_WORKERS, len(unknown))) as executor:
+                described = list(executor.map(Describe, unknown))
+
+        with self.lock:
+            entries = {
+                contentHash: self.entries[key][contentHash]
+                for version, contentHash in known.items()
+            }
+            for version, contentHash, arn in described:
+                entries[contentHash] = {"version": version, "arn": arn}
+            self.entries[key] = entries
+            self.synced.add(key)
+            self.Save()
+        logger.info(f"Synced {len(entries)} version(s) of component {componentName} in {region}")
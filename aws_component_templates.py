@@ -0,0 +1,211 @@
+###########################################################################
+############### PRECOMPILED IMAGE BUILDER COMPONENT TEMPLATES #############
+###########################################################################
+import logging
+import re
+import string
+
+import yaml
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Component Templates Configuration
+########################################################################
+# libyaml's emitter and parser when PyYAML was built with them
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+COMPONENT_PHASES = frozenset(["build", "validate", "test"])
+
+PATCHING_COMPONENT_TEMPLATE = """
+name: CreateFileAndTestExists
+schemaVersion: "1.0"
+phases:
+  - name: build
+    steps:
+      - name: Patching
+        action: ExecuteBash
+        inputs:
+          commands:
+            - echo 'Start patching stage...'
+            - ${payload}
+            - sleep 10
+            - echo 'Start validation stage...'
+            - ${lastPatchDate}
+"""
+WINDOWS_PATCHING_COMPONENT_TEMPLATE = """
+name: CreateFileAndTestExists
+schemaVersion: "1.0"
+phases:
+  - name: build
+    steps:
+      - name: Patching
+        action: ExecutePowerShell
+        inputs:
+          commands:
+            - Write-Host 'Start patching stage...'
+            - ${payload}
+            - Start-Sleep -Seconds 10
+            - Write-Host 'Start validation stage...'
+            - ${lastPatchDate}
+"""
+
+
+def ComponentDocumentYaml(component_data):
+    """
+    Serialize a component document, with the C emitter when available
+    """
+    return yaml.dump(component_data, Dumper=YAML_DUMPER, default_flow_style=False, sort_keys=True)
+
+
+########################################################################
+## Templates
+########################################################################
+def ValidateComponentDocument(document):
+    """
+    Check the structure Image Builder expects of a component document
+    """
+    if not isinstance(document, dict):
+        raise ValueError("A component document must be a mapping")
+    for key in ("name", "schemaVersion", "phases"):
+        if key not in document:
+            raise ValueError(f"Component document is missing {key}")
+    if not isinstance(document["phases"], list) or not document["phases"]:
+        raise ValueError("Component document needs at least one phase")
+    for phase in document["phases"]:
+        if phase.get("name") not in COMPONENT_PHASES:
+            raise ValueError(f"Unknown component phase {phase.get('name')!r}")
+        for step in phase.get("steps") or []:
+            if not step.get("name") or not step.get("action"):
+                raise ValueError(f"Step of phase {phase['name']} needs a name and an action")
+
+
+def _Compile(node, parameters):
+    """
+    Turn a parsed document into a render(values) function: containers are
+    rebuilt on every render, strings with ${placeholders} are substituted
+    and everything else is shared
+    """
+    if isinstance(node, dict):
+        items = [(key, _Compile(value, parameters)) for key, value in node.items()]
+        return lambda values: {key: render(values) for key, render in items}
+    if isinstance(node, list):
+        items = [_Compile(value, parameters) for value in node]
+        return lambda values: [render(values) for render in items]
+    if isinstance(node, str) and "$" in node:
+        template = string.Template(node)
+        names = {
+            match.group("named") or match.group("braced")
+            for match in template.pattern.finditer(node)
+            if match.group("named") or match.group("braced")
+        }
+        parameters.update(names)
+        return template.substitute
+    return lambda values: node
+
+
+class ComponentTemplate:
+    """
+    A component document parsed and validated once, rendered by substituting
+    ${parameters} into its strings
+    """
+
+    def __init__(self, source):
+        self.document = yaml.load(source, Loader=YAML_LOADER)
+        ValidateComponentDocument(self.document)
+        self.parameters = set()
+        self._render = _Compile(self.document, self.parameters)
+
+    def Render(self, **values):
+        missing = self.parameters - set(values)
+        if missing:
+            raise KeyError(f"Missing template parameters: {', '.join(sorted(missing))}")
+        return self._render(values)
+
+
+class ComponentTemplateRegistry:
+    """
+    Component templates and their default parameters keyed by OS family;
+    the family of a parent image is picked from keywords of its name
+    """
+
+    def __init__(self):
+        self.families = {}
+        self.keywords = {}
+        self.defaultFamily = {}
+        self._patterns = {}
+
+    def Register(self, family, template, parameters, keywords=(), platform="Linux", default=False):
+        if isinstance(template, str):
+            template = ComponentTemplate(template)
+        missing = template.parameters - set(parameters)
+        if missing:
+            raise ValueError(f"Template of {family} has no value for {', '.join(sorted(missing))}")
+        self.families[family] = (template, dict(parameters))
+        platformKeywords = self.keywords.setdefault(platform, {})
+        for keyword in keywords:
+            platformKeywords[keyword] = family
+        if platformKeywords:
+            self._patterns[platform] = re.compile("|".join(re.escape(keyword) for keyword in platformKeywords))
+        if default:
+            self.defaultFamily[platform] = family
+
+    def Family(self, componentPlatform, recipeImageName):
+        """
+        OS family of a parent image: the first keyword of its platform found
+        in the image name, else the platform default
+        """
+        pattern = self._patterns.get(componentPlatform)
+        match = pattern.search(recipeImageName or "") if pattern else None
+        if match:
+            return self.keywords[componentPlatform][match.group(0)]
+        family = self.defaultFamily.get(componentPlatform)
+        if family is None:
+            raise LookupError(f"No component template for {componentPlatform} image {recipeImageName!r}")
+        return family
+
+    def Render(self, family, **overrides):
+        template, parameters = self.families[family]
+        if overrides:
+            parameters = dict(parameters, **overrides)
+        return template.Render(**parameters)
+
+
+COMPONENT_TEMPLATES = ComponentTemplateRegistry()
+COMPONENT_TEMPLATES.Register(
+    "debian",
+    PATCHING_COMPONENT_TEMPLATE,
+    {
+        "payload": "apt update -y",
+        "lastPatchDate": "cat /var/log/apt/history.log | grep 'End-Date' | tail -1",
+    },
+    keywords=("Ubuntu", "Debian"),
+)
+COMPONENT_TEMPLATES.Register(
+    "rhel",
+    COMPONENT_TEMPLATES.families["debian"][0],
+    {
+        "payload": "yum -y update",
+        "lastPatchDate": "grep 'Updated:' /var/log/yum.log | tail -1",
+    },
+    keywords=("Amazon", "Centos"),
+)
+COMPONENT_TEMPLATES.Register(
+    "linux",
+    COMPONENT_TEMPLATES.families["debian"][0],
+    {"payload": "echo Patching stage", "lastPatchDate": "echo No patch history"},
+    default=True,
+)
+COMPONENT_TEMPLATES.Register(
+    "windows",
+    WINDOWS_PATCHING_COMPONENT_TEMPLATE,
+    {
+        "payload": "Write-Host Patching stage",
+        "lastPatchDate": "Get-HotFix | Sort-Object InstalledOn | Select-Object -Last 1",
+    },
+    platform="Windows",
+    default=True,
+)
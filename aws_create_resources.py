@@ -1,7 +1,35 @@
-import boto3
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import atexit
+import contextlib
+import contextvars
+import functools
+import ipaddress
+import json
 import logging
 
+from aws_call_executor import ExecuteCall
+from aws_client_factory import GetClient, GetResource
+from aws_inventory import (
+    AWS_INVENTORY_ALIVE_INSTANCE_STATES,
+    AWS_INVENTORY_SMALL_PAGE_SIZE,
+    FirstOf,
+    IterateInstances,
+    IterateInternetGateways,
+    IterateNetworkInterfaces,
+    IterateRouteTables,
+    IterateSecurityGroups,
+    IterateSubnets,
+    IterateVPCs,
+)
+from aws_metrics import EnableMetrics, WriteMetrics
+from aws_profiler import EnableProfiling, WriteProfile
+from aws_resource_cache import ResourceIdCache
+from aws_resource_graph import ResourceGraph
+from aws_run_id import GetRunId, RunIdTags, SetRunId
+from aws_run_journal import RunJournal
+
 ########################################################################
 ## Setupping logger activities
 ########################################################################
@@ -15,18 +43,63 @@ logging.basicConfig(level=logging.INFO,
 AWS_ACCESS_KEY_ID='<YOUR-AWS-ACCESS-KEY-ID>'
 AWS_SECRET_ACCESS_KEY='YOUR-AWS-SECRET-ACCESS-KEY'
 AWS_DEFAULT_REGION='us-east-1'
-AWS_AUTH_RESOURCES_CREDENTIALS = boto3.resource(
-    'ec2',
-    region_name=AWS_DEFAULT_REGION,
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-)
-AWS_AUTH_CLIENT_CREDENTIALS = boto3.client(
-    'ec2',
-    region_name=AWS_DEFAULT_REGION,
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-)
+
+
+def GetEC2Resource(region=None):
+    """
+    Getting the EC2 resource of region (by default the stack region), built
+    on first use
+    """
+    return GetResource(
+        'ec2',
+        region_name=region or StackRegion(),
+        accessKey=AWS_ACCESS_KEY_ID,
+        secretAccessKey=AWS_SECRET_ACCESS_KEY,
+    )
+
+
+def GetEC2Client():
+    """
+    Getting the EC2 client, built on first use
+    """
+    return GetClient(
+        'ec2',
+        region_name=StackRegion(),
+        accessKey=AWS_ACCESS_KEY_ID,
+        secretAccessKey=AWS_SECRET_ACCESS_KEY,
+    )
+
+
+def LoadEC2Resource(name, resourceId, region=None):
+    """
+    boto3 EC2 resource object of a type name and ID, e.g. ('Subnet', 'subnet-1'),
+    in region (by default the stack region)
+    """
+    return getattr(GetEC2Resource(region), name)(resourceId)
+
+
+def PreloadClients():
+    """
+    Build the clients ahead of time, e.g. during a Lambda init phase
+    """
+    GetEC2Client()
+    GetEC2Resource()
+
+
+def __getattr__(name):
+    # The credentials objects used to be built at import time; keep the
+    # old names working while constructing them only when first accessed.
+    if name == 'AWS_AUTH_RESOURCES_CREDENTIALS':
+        return GetEC2Resource()
+    if name == 'AWS_AUTH_CLIENT_CREDENTIALS':
+        return GetEC2Client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+########################################################################
+## AWS Resource-ID Cache
+########################################################################
+AWS_RESOURCE_ID_CACHE = ResourceIdCache()
+AWS_DEFAULT_VPC_FILTER = {'isDefault': ['true']}
 
 ########################################################################
 ## AWS EC2 Configurations
@@ -55,12 +128,339 @@ AWS_RESOURCE_NETWORK_INTERFACE_DESCRIPTION='This is a simple nic'
 AWS_RESOURCE_NETWORK_INTERFACE_PRIVATE_IP_ADDRESS='10.0.0.50'
 AWS_RESOURCE_INDEX_DEVICE_NIC=123
 
+########################################################################
+## AWS Internet Gateway and Route Table Configuration
+########################################################################
+AWS_INTERNET_GATEWAY_TAGS_VALUE='Internet gateway boto3'
+AWS_ROUTE_TABLE_TAGS_VALUE='Route table boto3'
 
 ########################################################################
 ## AWS CIDR Block Device Configuration
 ########################################################################
 AWS_RESOURCE_CIDRBLOCK='10.0.0.0/24'
 
+########################################################################
+## Stack specs
+########################################################################
+# Stack spec key: module constant holding its default
+AWS_STACK_SPEC_DEFAULTS = {
+    'region': 'AWS_DEFAULT_REGION',
+    'imageId': 'AWS_EC2_IMAGE_ID',
+    'instanceType': 'AWS_EC2_INSTANCE_TYPE',
+    'keyName': 'AWS_SSH_KEY_NAMES',
+    'minCount': 'AWS_EC2_MIN_COUNT',
+    'maxCount': 'AWS_EC2_MAX_COUNT',
+    'instanceName': 'AWS_EC2_TAGS_VALUE',
+    'securityGroupName': 'AWS_SECURITY_GROUP_NAME',
+    'securityGroupDescription': 'AWS_SECURITY_GROUP_DESCRIPTION',
+    'networkInterfaceDescription': 'AWS_RESOURCE_NETWORK_INTERFACE_DESCRIPTION',
+    'deviceIndex': 'AWS_RESOURCE_INDEX_DEVICE_NIC',
+    'internetGatewayName': 'AWS_INTERNET_GATEWAY_TAGS_VALUE',
+    'routeTableName': 'AWS_ROUTE_TABLE_TAGS_VALUE',
+    'cidrBlock': 'AWS_RESOURCE_CIDRBLOCK',
+    'privateIpAddress': 'AWS_RESOURCE_NETWORK_INTERFACE_PRIVATE_IP_ADDRESS',
+}
+AWS_STACK_SPEC_INTEGER_KEYS = ('minCount', 'maxCount', 'deviceIndex')
+# The resources of a stack are found again by these, so two stacks of a
+# region must not share any of them
+AWS_STACK_SPEC_IDENTITY_KEYS = (
+    'instanceName',
+    'securityGroupName',
+    'networkInterfaceDescription',
+    'internetGatewayName',
+    'routeTableName',
+)
+AWS_STACK_MAX_WORKERS = 32
+_CURRENT_STACK = contextvars.ContextVar('aws_current_stack', default=None)
+
+
+def DefaultStack():
+    """
+    The stack described by the module constants
+    """
+    stack = {key: globals()[constant] for key, constant in AWS_STACK_SPEC_DEFAULTS.items()}
+    stack['name'] = 'default'
+    return stack
+
+
+def CurrentStack():
+    """
+    Spec of the stack being provisioned by this thread or task, the module
+    constants outside of UsingStack()
+    """
+    return _CURRENT_STACK.get() or DefaultStack()
+
+
+def StackRegion():
+    return CurrentStack()['region']
+
+
+@contextlib.contextmanager
+def UsingStack(stack):
+    token = _CURRENT_STACK.set(stack)
+    try:
+        yield stack
+    finally:
+        _CURRENT_STACK.reset(token)
+
+
+def InStack(stack, func):
+    """
+    func running with stack as the current stack, e.g. as a graph node
+    """
+    @functools.wraps(func)
+    def Run(*args, **kwargs):
+        with UsingStack(stack):
+            return func(*args, **kwargs)
+
+    return Run
+
+
+def CacheFilters(resourceType):
+    """
+    Resource-ID cache filters of a resource of the current stack; stacks
+    sharing a region differ in them, so their IDs are cached apart
+    """
+    stack = CurrentStack()
+    if resourceType == 'vpc':
+        return AWS_DEFAULT_VPC_FILTER
+    return {
+        'security-group': {'group-name': [stack['securityGroupName']]},
+        'subnet': {'cidr-block': [stack['cidrBlock']]},
+        'instance': {f'tag:{AWS_TAGS_KEY}': [stack['instanceName']]},
+        'network-interface': {'description': [stack['networkInterfaceDescription']]},
+        'internet-gateway': {f'tag:{AWS_TAGS_KEY}': [stack['internetGatewayName']]},
+        'route-table': {f'tag:{AWS_TAGS_KEY}': [stack['routeTableName']]},
+    }[resourceType]
+
+
+def _StackSpec(values, position):
+    """
+    Validate one stack definition and fill it with the defaults; resource
+    names default to the stack name
+    """
+    name = values.get('name')
+    if not name:
+        raise ValueError(f"Stack #{position} has no name")
+    unknown = sorted(set(values) - set(AWS_STACK_SPEC_DEFAULTS) - {'name'})
+    if unknown:
+        raise ValueError(f"Stack {name}: unknown key(s) {', '.join(unknown)}")
+    stack = DefaultStack()
+    stack.update({
+        'name': str(name),
+        'instanceName': str(name),
+        'securityGroupName': str(name),
+        'networkInterfaceDescription': f'{name} network interface',
+        'internetGatewayName': str(name),
+        'routeTableName': str(name),
+    })
+    stack.update(values)
+    for key in AWS_STACK_SPEC_INTEGER_KEYS:
+        try:
+            stack[key] = int(stack[key])
+        except (TypeError, ValueError):
+            raise ValueError(f"Stack {name}: {key} must be an integer, not {stack[key]!r}") from None
+    if not 1 <= stack['minCount'] <= stack['maxCount']:
+        raise ValueError(f"Stack {name}: expected 1 <= minCount <= maxCount")
+    try:
+        stack['cidrBlock'] = str(ipaddress.IPv4Network(stack['cidrBlock']))
+    except ValueError as error:
+        raise ValueError(f"Stack {name}: {error}") from None
+    return stack
+
+
+def _CheckOverlappingSubnets(stacks):
+    networks = sorted(
+        (stack['region'], ipaddress.IPv4Network(stack['cidrBlock']), stack['name']) for stack in stacks
+    )
+    previous = None
+    for region, network, name in networks:
+        if previous and previous[0] == region and network.network_address <= previous[1].broadcast_address:
+            raise ValueError(f"Stacks {previous[2]} and {name} have overlapping subnets in {region}")
+        if not previous or previous[0] != region or network.broadcast_address > previous[1].broadcast_address:
+            previous = (region, network, name)
+
+
+def NormalizeStackSpecs(spec):
+    """
+    Validate a stack spec and expand it into one dict per stack:
+
+        defaults: {region: us-east-1, instanceType: t3.micro}
+        stacks:
+          - {name: web-1, cidrBlock: 10.0.1.0/24}
+          - {name: web-2, cidrBlock: 10.0.2.0/24, region: eu-west-1}
+
+    A bare list of stacks is accepted too. Keys are those of
+    AWS_STACK_SPEC_DEFAULTS; every stack needs a unique name and the stacks
+    of a region need distinct resource names and non-overlapping subnets.
+    """
+    if isinstance(spec, list):
+        spec = {'stacks': spec}
+    defaults = spec.get('defaults') or {}
+    stacks = [
+        _StackSpec({**defaults, **values}, position)
+        for position, values in enumerate(spec.get('stacks') or [], 1)
+    ]
+    if not stacks:
+        raise ValueError("The stack spec has no stacks")
+
+    names = [stack['name'] for stack in stacks]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate stacks: {', '.join(duplicates)}")
+    for key in AWS_STACK_SPEC_IDENTITY_KEYS:
+        seen = {}
+        for stack in stacks:
+            other = seen.setdefault((stack['region'], stack[key]), stack['name'])
+            if other != stack['name']:
+                raise ValueError(f"Stacks {other} and {stack['name']} share {key} {stack[key]!r}")
+    _CheckOverlappingSubnets(stacks)
+    return stacks
+
+
+def LoadStackSpecs(path):
+    """
+    Read a YAML or JSON (.json) stack spec file and normalize it
+    """
+    with open(path) as specFile:
+        if path.endswith('.json'):
+            return NormalizeStackSpecs(json.load(specFile))
+        # Only stack spec files need PyYAML; keep it out of the import time
+        import yaml
+
+        return NormalizeStackSpecs(yaml.safe_load(specFile))
+
+########################################################################
+## Resource types of the graph nodes
+########################################################################
+AWS_GRAPH_NODE_TYPES = {
+    'VPC': 'vpc',
+    'InternetGateway': 'internet-gateway',
+    'EC2Instance': 'instance',
+    'NetworkInterface': 'network-interface',
+    'Subnet': 'subnet',
+    'SecurityGroup': 'security-group',
+    'RouteTable': 'route-table',
+}
+
+########################################################################
+## Request parameters, shared with the asyncio backend (aws_async.py)
+########################################################################
+def EC2InstanceParams():
+    stack = CurrentStack()
+    return {
+        'ImageId': stack['imageId'],
+        'InstanceType': stack['instanceType'],
+        'KeyName': stack['keyName'],
+        'MaxCount': stack['maxCount'],
+        'MinCount': stack['minCount'],
+        'TagSpecifications': [
+            {
+                'ResourceType': 'instance',
+                'Tags': [
+                    {
+                        'Key': f'{AWS_TAGS_KEY}',
+                        'Value': f"{stack['instanceName']}"
+                    }
+                ] + RunIdTags()
+            },
+        ],
+    }
+
+
+def SecurityGroupParams(vpcId):
+    stack = CurrentStack()
+    return {
+        'Description': stack['securityGroupDescription'],
+        'GroupName': stack['securityGroupName'],
+        'VpcId': vpcId,
+        'TagSpecifications': [{'ResourceType': 'security-group', 'Tags': RunIdTags()}],
+    }
+
+
+def InternetGatewayParams():
+    return {
+        'TagSpecifications': [
+            {
+                'ResourceType': 'internet-gateway',
+                'Tags': [{'Key': AWS_TAGS_KEY, 'Value': CurrentStack()['internetGatewayName']}] + RunIdTags(),
+            },
+        ],
+    }
+
+
+def SubnetParams(vpcId):
+    return {
+        'VpcId': f'{vpcId}',
+        'CidrBlock': f"{CurrentStack()['cidrBlock']}",
+        'TagSpecifications': [{'ResourceType': 'subnet', 'Tags': RunIdTags()}],
+    }
+
+
+def NetworkInterfaceParams(securityGroupId, subnetId, privateIpAddress=None):
+    params = {
+        'Description': CurrentStack()['networkInterfaceDescription'],
+        'Groups': [
+            f'{securityGroupId}',
+        ],
+        'SubnetId': f'{subnetId}',
+        'TagSpecifications': [{'ResourceType': 'network-interface', 'Tags': RunIdTags()}],
+    }
+    if privateIpAddress:
+        params['PrivateIpAddress'] = privateIpAddress
+    return params
+
+
+def RouteTableParams(vpcId):
+    return {
+        'VpcId': f'{vpcId}',
+        'TagSpecifications': [
+            {
+                'ResourceType': 'route-table',
+                'Tags': [{'Key': AWS_TAGS_KEY, 'Value': CurrentStack()['routeTableName']}] + RunIdTags(),
+            },
+        ],
+    }
+
+
+def AttachInternetGatewayParams(internetGatewayId, vpcId):
+    return {'InternetGatewayId': f'{internetGatewayId}', 'VpcId': f'{vpcId}'}
+
+
+def AttachNetworkInterfaceParams(instanceId, nicId):
+    return {
+        'DeviceIndex': CurrentStack()['deviceIndex'],
+        'InstanceId': instanceId,
+        'NetworkInterfaceId': nicId,
+    }
+
+
+def SecurityGroupLookupFilters(vpcId):
+    return {'vpc-id': vpcId, 'group-name': CurrentStack()['securityGroupName']}
+
+
+def SubnetLookupFilters(vpcId):
+    return {'vpc-id': vpcId, 'cidr-block': CurrentStack()['cidrBlock']}
+
+
+def EC2InstanceLookupFilters():
+    return {
+        f'tag:{AWS_TAGS_KEY}': CurrentStack()['instanceName'],
+        'instance-state-name': AWS_INVENTORY_ALIVE_INSTANCE_STATES,
+    }
+
+
+def NICLookupFilters():
+    return {'description': CurrentStack()['networkInterfaceDescription']}
+
+
+def InternetGatewayLookupFilters():
+    return {f'tag:{AWS_TAGS_KEY}': CurrentStack()['internetGatewayName']}
+
+
+def RouteTableLookupFilters(vpcId):
+    return {'vpc-id': vpcId, f'tag:{AWS_TAGS_KEY}': CurrentStack()['routeTableName']}
+
 ########################################################################
 ## Main funcs logic
 ########################################################################
@@ -69,29 +469,13 @@ def CreateEC2Instance():
     Create an EC2 instance with Ubuntu OS and SSH keys
     """
     try:
-        res = AWS_AUTH_RESOURCES_CREDENTIALS.create_instances(
-            ImageId=AWS_EC2_IMAGE_ID,
-            InstanceType=AWS_EC2_INSTANCE_TYPE,
-            KeyName=AWS_SSH_KEY_NAMES,
-            MaxCount=AWS_EC2_MAX_COUNT,
-            MinCount=AWS_EC2_MIN_COUNT,
-            TagSpecifications=[
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {
-                            'Key': f'{AWS_TAGS_KEY}',
-                            'Value': f'{AWS_EC2_TAGS_VALUE}'
-                        }
-                    ]  
-                },
-            ]
-        )
+        res = ExecuteCall(GetEC2Resource(), 'create_instances', **EC2InstanceParams())
     except ClientError:
         logging.exception("******************************** ERROR: Unable to create EC2 instance")
         raise
     else:
-        return res 
+        AWS_RESOURCE_ID_CACHE.Put(StackRegion(), 'instance', res[0].id, CacheFilters('instance'))
+        return res
     
     
 def CreateVPC():
@@ -99,12 +483,13 @@ def CreateVPC():
     Create a default VPC
     """
     try:
-        res = AWS_AUTH_CLIENT_CREDENTIALS.create_default_vpc()
+        res = ExecuteCall(GetEC2Client(), 'create_default_vpc')
     except ClientError:
         logging.exception("******************************** ERROR: Unable to create a default VPC")
         raise
     else:
-        return res 
+        AWS_RESOURCE_ID_CACHE.Put(StackRegion(), 'vpc', res['Vpc']['VpcId'], CacheFilters('vpc'))
+        return res
     
 
 def CreateSecurityGroup():
@@ -114,15 +499,13 @@ def CreateSecurityGroup():
     try: 
         AWS_DEFAULT_VPC_ID = GetVPCIds()    
             
-        res = AWS_AUTH_RESOURCES_CREDENTIALS.create_security_group(
-            Description=AWS_SECURITY_GROUP_DESCRIPTION,
-            GroupName=AWS_SECURITY_GROUP_NAME,
-            VpcId=AWS_DEFAULT_VPC_ID,
-        )
-    except ClientError:
+        res = ExecuteCall(GetEC2Resource(), 'create_security_group', **SecurityGroupParams(AWS_DEFAULT_VPC_ID))
+    except ClientError as error:
+        AWS_RESOURCE_ID_CACHE.InvalidateOnNotFound(error, StackRegion())
         logging.exception("******************************** ERROR: Unable to create a security group")
         raise
     else:
+        AWS_RESOURCE_ID_CACHE.Put(StackRegion(), 'security-group', res.id, CacheFilters('security-group'))
         return res
     
 
@@ -131,11 +514,12 @@ def CreateInternetGateway():
     Create an InternetGateway resource 
     """
     try:
-        res = AWS_AUTH_RESOURCES_CREDENTIALS.create_internet_gateway()
+        res = ExecuteCall(GetEC2Resource(), 'create_internet_gateway', **InternetGatewayParams())
     except ClientError:
         logging.exception("******************************** ERROR: Unable to create a internet gateway")
         raise
     else:
+        AWS_RESOURCE_ID_CACHE.Put(StackRegion(), 'internet-gateway', res.id, CacheFilters('internet-gateway'))
         return res
 
 
@@ -146,36 +530,42 @@ def CreateSubnet():
     try:
         AWS_DEFAULT_VPC_ID = GetVPCIds()    
         
-        res = AWS_AUTH_RESOURCES_CREDENTIALS.create_subnet(
-            VpcId=f'{AWS_DEFAULT_VPC_ID}',
-            CidrBlock=f'{AWS_RESOURCE_CIDRBLOCK}'
-        )
-    except ClientError:
+        res = ExecuteCall(GetEC2Resource(), 'create_subnet', **SubnetParams(AWS_DEFAULT_VPC_ID))
+    except ClientError as error:
+        AWS_RESOURCE_ID_CACHE.InvalidateOnNotFound(error, StackRegion())
         logging.exception("******************************** ERROR: Unable to create a subnet")
         raise
     else:
-        return res 
+        AWS_RESOURCE_ID_CACHE.Put(StackRegion(), 'subnet', res.id, CacheFilters('subnet'))
+        return res
 
 
 def CreateNetworkInterface():
     """
-    Create a network interface with the IP address: 10.0.0.50
+    Create a network interface with the stack's private IP address (by
+    default 10.0.0.50), or the first free address of the subnet when it is
+    taken or outside of it
     """
+    # aws_ip_allocator imports this module; everything stack-specific is
+    # passed in, so it also works when this module runs as __main__
+    from aws_ip_allocator import CreateNetworkInterface as CreatePlannedNetworkInterface
+
     try:
         AWS_RESOURCE_SECURITY_GROUP_ID = GetSecurityGroupIds()
         AWS_RESOURCE_SUBNET_ID = GetSubnetIds()
-        
-        res = AWS_AUTH_RESOURCES_CREDENTIALS.create_network_interface(
-            Description=AWS_RESOURCE_NETWORK_INTERFACE_DESCRIPTION,
-            Groups=[
-                f'{AWS_RESOURCE_SECURITY_GROUP_ID}',
-            ],
-            SubnetId=f'{AWS_RESOURCE_SUBNET_ID}',
+
+        nic = CreatePlannedNetworkInterface(
+            GetEC2Client(), AWS_RESOURCE_SUBNET_ID,
+            functools.partial(NetworkInterfaceParams, AWS_RESOURCE_SECURITY_GROUP_ID),
+            CurrentStack()['privateIpAddress'],
         )
-    except ClientError:
+    except ClientError as error:
+        AWS_RESOURCE_ID_CACHE.InvalidateOnNotFound(error, StackRegion())
         logging.exception("******************************** ERROR: Unable to create a network interface")
         raise
     else:
+        res = GetEC2Resource().NetworkInterface(nic['NetworkInterfaceId'])
+        AWS_RESOURCE_ID_CACHE.Put(StackRegion(), 'network-interface', res.id, CacheFilters('network-interface'))
         return res
 
 def CreateRouteTable():
@@ -184,14 +574,14 @@ def CreateRouteTable():
     """
     try:
         AWS_DEFAULT_VPC_ID = GetVPCIds()
-        res = AWS_AUTH_RESOURCES_CREDENTIALS.create_route_table(
-            VpcId=f'{AWS_DEFAULT_VPC_ID}',
-        )
-    except ClientError:
+        res = ExecuteCall(GetEC2Resource(), 'create_route_table', **RouteTableParams(AWS_DEFAULT_VPC_ID))
+    except ClientError as error:
+        AWS_RESOURCE_ID_CACHE.InvalidateOnNotFound(error, StackRegion())
         logging.exception("******************************** ERROR: Unable to create a route table")
         raise
     else:
-        return res 
+        AWS_RESOURCE_ID_CACHE.Put(StackRegion(), 'route-table', res.id, CacheFilters('route-table'))
+        return res
     
 ########################################################################
 ## Attaching Resources to each other 
@@ -203,11 +593,12 @@ def AttachInternetGatewayToVPC():
     try:
         AWS_RESOURCE_INTERNET_GATEWAY_ID = GetInternetGatewayIds()
         AWS_DEFAULT_VPC_ID = GetVPCIds()   
-        res = AWS_AUTH_CLIENT_CREDENTIALS.attach_internet_gateway(
-            InternetGatewayId=f'{AWS_RESOURCE_INTERNET_GATEWAY_ID}',
-            VpcId=f'{AWS_DEFAULT_VPC_ID}',
+        res = ExecuteCall(
+            GetEC2Client(), 'attach_internet_gateway',
+            **AttachInternetGatewayParams(AWS_RESOURCE_INTERNET_GATEWAY_ID, AWS_DEFAULT_VPC_ID)
         ) 
-    except ClientError:
+    except ClientError as error:
+        AWS_RESOURCE_ID_CACHE.InvalidateOnNotFound(error, StackRegion())
         logging.exception("******************************** ERROR: Unable to attach an internet gateway to VPC")
         raise
     else:
@@ -221,12 +612,12 @@ def AttachNetworkInterfaceToEC2():
         AWS_RESOURCE_EC2_INSTANCE_ID = GetEC2InstanceIds()
         AWS_RESOURCE_NIC_ID = GetNICIds()
         
-        res = AWS_AUTH_CLIENT_CREDENTIALS.attach_network_interface(
-            DeviceIndex=AWS_RESOURCE_INDEX_DEVICE_NIC,
-            InstanceId=AWS_RESOURCE_EC2_INSTANCE_ID,
-            NetworkInterfaceId=AWS_RESOURCE_NIC_ID,
+        res = ExecuteCall(
+            GetEC2Client(), 'attach_network_interface',
+            **AttachNetworkInterfaceParams(AWS_RESOURCE_EC2_INSTANCE_ID, AWS_RESOURCE_NIC_ID)
         )
-    except ClientError:
+    except ClientError as error:
+        AWS_RESOURCE_ID_CACHE.InvalidateOnNotFound(error, StackRegion())
         logging.exception("******************************** ERROR: Unable to attach a network interface to EC2 instance")
         raise
     else:
@@ -235,72 +626,377 @@ def AttachNetworkInterfaceToEC2():
 ########################################################################
 ## Getting useful ids of resources
 ########################################################################
+def _FirstId(iterator, idKey, description):
+    """
+    ID of the first resource streamed by an inventory iterator
+    """
+    resource = FirstOf(iterator)
+    if resource is None:
+        raise LookupError(f"No {description} found")
+    return resource[idKey]
+
+
 def GetVPCIds():
     """
     Getting nessesary ID of the VPC
     """
-    vps_ids = AWS_AUTH_CLIENT_CREDENTIALS.describe_vpcs(
-            Filters=[{'Name':'isDefault','Values': ['true']},]
-        ) 
-    return vps_ids['Vpcs'][0]['VpcId']
+    return AWS_RESOURCE_ID_CACHE.Resolve(
+        StackRegion(), 'vpc', CacheFilters('vpc'),
+        lambda: _FirstId(
+            IterateVPCs(GetEC2Client(), AWS_DEFAULT_VPC_FILTER, AWS_INVENTORY_SMALL_PAGE_SIZE),
+            'VpcId', 'default VPC',
+        ),
+    )
+
 
- 
 def GetSecurityGroupIds():
     """
     Getting nessesary ID of the security group
     """
-    sec_ids = AWS_AUTH_CLIENT_CREDENTIALS.describe_security_groups(
-        GroupNames=[f'{AWS_SECURITY_GROUP_NAME}']
+    return AWS_RESOURCE_ID_CACHE.Resolve(
+        StackRegion(), 'security-group', CacheFilters('security-group'),
+        lambda: _FirstId(
+            IterateSecurityGroups(
+                GetEC2Client(), SecurityGroupLookupFilters(GetVPCIds()), AWS_INVENTORY_SMALL_PAGE_SIZE,
+            ),
+            'GroupId', f"security group {CurrentStack()['securityGroupName']}",
+        ),
     )
-    return sec_ids['SecurityGroups'][0]['GroupId']
 
 
 def GetSubnetIds():
     """
     Getting nessesary ID of the subnet
     """
-    subnet_ids = AWS_AUTH_CLIENT_CREDENTIALS.describe_subnets()
-    return subnet_ids['Subnets'][0]['SubnetId']
+    return AWS_RESOURCE_ID_CACHE.Resolve(
+        StackRegion(), 'subnet', CacheFilters('subnet'),
+        lambda: _FirstId(
+            IterateSubnets(GetEC2Client(), SubnetLookupFilters(GetVPCIds()), AWS_INVENTORY_SMALL_PAGE_SIZE),
+            'SubnetId', f"subnet {CurrentStack()['cidrBlock']}",
+        ),
+    )
 
 def GetEC2InstanceIds():
     """
     Getting nessesary ID of the ec2 instance
     """
-    ec2_ids = AWS_AUTH_CLIENT_CREDENTIALS.describe_instance()
-    return ec2_ids['Reservations'][1]['InstanceId']
+    return AWS_RESOURCE_ID_CACHE.Resolve(
+        StackRegion(), 'instance', CacheFilters('instance'),
+        lambda: _FirstId(
+            IterateInstances(GetEC2Client(), EC2InstanceLookupFilters(), AWS_INVENTORY_SMALL_PAGE_SIZE),
+            'InstanceId', f"instance {CurrentStack()['instanceName']}",
+        ),
+    )
 
 def GetNICIds():
     """
     Getting nessesary ID of the nics
     """
-    nic_ids = AWS_AUTH_CLIENT_CREDENTIALS.describe_network_intertface()
-    return nic_ids['NetworkInterfaces'][0]['NetworkInterfaceId']
+    return AWS_RESOURCE_ID_CACHE.Resolve(
+        StackRegion(), 'network-interface', CacheFilters('network-interface'),
+        lambda: _FirstId(
+            IterateNetworkInterfaces(GetEC2Client(), NICLookupFilters(), AWS_INVENTORY_SMALL_PAGE_SIZE),
+            'NetworkInterfaceId', 'network interface',
+        ),
+    )
 
 def GetInternetGatewayIds():
     """
     Getting nessesary ID of the internet gateway interface
     """
-    internet_gateway = AWS_AUTH_CLIENT_CREDENTIALS.describe_internet_gateways()
-    return internet_gateway['InternetGateways'][0]['InternetGatewayId']
-    
-    
+    return AWS_RESOURCE_ID_CACHE.Resolve(
+        StackRegion(), 'internet-gateway', CacheFilters('internet-gateway'),
+        lambda: _FirstId(
+            IterateInternetGateways(GetEC2Client(), InternetGatewayLookupFilters(), AWS_INVENTORY_SMALL_PAGE_SIZE),
+            'InternetGatewayId', 'internet gateway',
+        ),
+    )
+
+
+########################################################################
+## Account state snapshot and plan
+########################################################################
+def _FirstOrNone(items, key):
+    return items[0][key] if items else None
+
+
+def ResultId(value):
+    """
+    Resource ID of a graph node result: an ID, a boto3 resource (or a list
+    of them, for instances) or the create_default_vpc response
+    """
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if isinstance(value, dict):
+        return value.get('Vpc', {}).get('VpcId')
+    return getattr(value, 'id', value)
+
+
+def SeedResourceIdCache(existing):
+    """
+    Fill the resource-ID cache from {graph node: result}, so that the steps
+    left to run do not describe these resources again
+    """
+    for node, value in existing.items():
+        if node in AWS_GRAPH_NODE_TYPES and ResultId(value):
+            resourceType = AWS_GRAPH_NODE_TYPES[node]
+            AWS_RESOURCE_ID_CACHE.Put(StackRegion(), resourceType, ResultId(value), CacheFilters(resourceType))
+
+
+def SnapshotEC2State():
+    """
+    Find the resources of the stack which already exist with a few bulk
+    Describe calls. Returns {graph node: resource ID} and fills the
+    resource-ID cache so that applying the plan does not describe again.
+    """
+    client = GetEC2Client()
+    existing = {}
+    try:
+        # Through the cache: the stacks of a region share the default VPC
+        vpcId = GetVPCIds()
+    except LookupError:
+        vpcId = None
+
+    calls = {
+        'InternetGateway': lambda: list(IterateInternetGateways(client, InternetGatewayLookupFilters())),
+        'EC2Instance': lambda: list(IterateInstances(client, EC2InstanceLookupFilters())),
+        'NetworkInterface': lambda: list(IterateNetworkInterfaces(client, NICLookupFilters())),
+    }
+    if vpcId:
+        calls.update({
+            'Subnet': lambda: list(IterateSubnets(client, SubnetLookupFilters(vpcId))),
+            'SecurityGroup': lambda: list(IterateSecurityGroups(client, SecurityGroupLookupFilters(vpcId))),
+            'RouteTable': lambda: list(IterateRouteTables(client, RouteTableLookupFilters(vpcId))),
+        })
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = {node: executor.submit(contextvars.copy_context().run, call) for node, call in calls.items()}
+        found = {node: future.result() for node, future in futures.items()}
+
+    if vpcId:
+        existing['VPC'] = vpcId
+    ids = {
+        'InternetGateway': 'InternetGatewayId',
+        'EC2Instance': 'InstanceId',
+        'NetworkInterface': 'NetworkInterfaceId',
+        'Subnet': 'SubnetId',
+        'SecurityGroup': 'GroupId',
+        'RouteTable': 'RouteTableId',
+    }
+    for node, items in found.items():
+        resourceId = _FirstOrNone(items, ids[node])
+        if resourceId:
+            existing[node] = resourceId
+    SeedResourceIdCache(existing)
+
+    gateways = found['InternetGateway']
+    if vpcId and gateways and any(a.get('VpcId') == vpcId for a in gateways[0].get('Attachments', [])):
+        existing['AttachInternetGateway'] = gateways[0]['InternetGatewayId']
+    nics = found['NetworkInterface']
+    instanceId = existing.get('EC2Instance')
+    if instanceId and nics and nics[0].get('Attachment', {}).get('InstanceId') == instanceId:
+        existing['AttachNetworkInterface'] = nics[0]['Attachment'].get('AttachmentId')
+    return existing
+
+
+def PlanResources(existing):
+    """
+    Names of the graph nodes which still have to be created or attached
+    """
+    return [name for name in BuildResourceGraph().nodes if name not in existing]
+
+
+########################################################################
+## Resources dependency graph
+########################################################################
+# (node, step, prerequisites) of one stack
+AWS_STACK_STEPS = (
+    ("EC2Instance", CreateEC2Instance, ()),
+    ("VPC", CreateVPC, ()),
+    ("InternetGateway", CreateInternetGateway, ()),
+    ("Subnet", CreateSubnet, ("VPC",)),
+    ("RouteTable", CreateRouteTable, ("VPC",)),
+    ("SecurityGroup", CreateSecurityGroup, ("VPC",)),
+    ("NetworkInterface", CreateNetworkInterface, ("Subnet", "SecurityGroup")),
+    ("AttachInternetGateway", AttachInternetGatewayToVPC, ("InternetGateway", "VPC")),
+    ("AttachNetworkInterface", AttachNetworkInterfaceToEC2, ("NetworkInterface", "EC2Instance")),
+)
+
+
+def BuildResourceGraph(existing=None):
+    """
+    Declare the resources and the order in which they depend on each other;
+    nodes found in existing are not created again
+    """
+    graph = ResourceGraph()
+    for name, func, dependsOn in AWS_STACK_STEPS:
+        graph.AddNode(name, func, dependsOn=dependsOn)
+    if existing:
+        graph.MarkExisting(existing)
+    return graph
+
+
+########################################################################
+## Many stacks in one process
+########################################################################
+def StackNodeName(stack, node):
+    """
+    Node of a stack in a shared graph; the default VPC node is shared by
+    the stacks of a region
+    """
+    if node == 'VPC':
+        return f"{stack['region']}:VPC"
+    return f"{stack['name']}:{node}"
+
+
+def AddStackNodes(graph, stack, existing=None):
+    """
+    Add the steps of one stack to a shared graph, running with stack as
+    the current stack
+    """
+    for name, func, dependsOn in AWS_STACK_STEPS:
+        nodeName = StackNodeName(stack, name)
+        if nodeName not in graph.nodes:
+            graph.AddNode(nodeName, InStack(stack, func), dependsOn=[StackNodeName(stack, dep) for dep in dependsOn])
+    if existing:
+        graph.MarkExisting({StackNodeName(stack, node): value for node, value in existing.items()})
+
+
+def ProvisionStacks(stacks, maxWorkers=AWS_STACK_MAX_WORKERS, planOnly=False, journal=None):
+    """
+    Snapshot the stacks concurrently, then create what is missing of all of
+    them on one graph and one bounded worker pool. Clients and the
+    resource-ID cache are shared by the stacks. Returns one report row per
+    stack.
+    """
+    graph = ResourceGraph()
+    for stack in stacks:
+        AddStackNodes(graph, stack)
+    done = journal.Completed(graph.nodes) if journal else {}
+
+    def Snapshot(stack):
+        with UsingStack(stack):
+            if not done:
+                return SnapshotEC2State()
+            existing = {
+                node: done[StackNodeName(stack, node)]
+                for node, _, _ in AWS_STACK_STEPS if StackNodeName(stack, node) in done
+            }
+            SeedResourceIdCache(existing)
+            return existing
+
+    with ThreadPoolExecutor(max_workers=max(1, min(maxWorkers, len(stacks)))) as executor:
+        snapshots = list(executor.map(Snapshot, stacks))
+    for stack, existing in zip(stacks, snapshots):
+        AddStackNodes(graph, stack, existing)
+    plans = [
+        [node for node, _, _ in AWS_STACK_STEPS if node not in existing]
+        for existing in snapshots
+    ]
+    logger.info(
+        f"Stacks: {len(stacks)}, {sum(len(plan) for plan in plans)} steps planned, "
+        f"{sum(len(existing) for existing in snapshots)} already done"
+    )
+
+    run = None
+    if not planOnly and any(plans):
+        run = graph.Run(maxWorkers=maxWorkers, raiseOnError=False, journal=journal)
+    report = []
+    for stack, plan in zip(stacks, plans):
+        errors = {}
+        for node in plan:
+            name = StackNodeName(stack, node)
+            if run and name in run.errors:
+                errors[node] = str(run.errors[name])
+            elif run and name in run.skipped:
+                errors[node] = "Skipped, a prerequisite step failed"
+        if planOnly:
+            status = "PLANNED" if plan else "OK"
+        else:
+            status = "FAILED" if errors else "OK"
+        report.append({
+            "stack": stack["name"],
+            "region": stack["region"],
+            "status": status,
+            "planned": plan,
+            "errors": errors,
+        })
+    LogStackReport(report)
+    return report
+
+
+def LogStackReport(report):
+    width = max([len(row["stack"]) for row in report] + [5])
+    for row in report:
+        if row["errors"]:
+            detail = "; ".join(f"{step}: {error}" for step, error in row["errors"].items())
+        else:
+            detail = ", ".join(row["planned"]) or "up to date"
+        logger.info(f"{row['region']} {row['stack']:<{width}} {row['status']:<7} {detail}")
+    failed = sum(1 for row in report if row["status"] == "FAILED")
+    logger.info(f"Stacks: {len(report) - failed} OK, {failed} FAILED")
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Creating nessesary AWS resources")
+    parser.add_argument("-Plan_only", choices=["true", "false"], default="false")
+    parser.add_argument("-Metrics_output", help="Write API call metrics to a .json or .prom file")
+    parser.add_argument("-Profile_output",
+                        help="Profile the run: folded stacks for flamegraphs here, the time breakdown next to it")
+    parser.add_argument("-Profile_memory", choices=["true", "false"], default="false",
+                        help="With -Profile_output, also report the top allocation sites (tracemalloc)")
+    parser.add_argument("-Run_id", help="ID tagged on the created resources, used by aws_teardown.py")
+    parser.add_argument("-Journal", help="Record every completed step in this JSON-lines file")
+    parser.add_argument("-Resume", choices=["true", "false"], default="false",
+                        help="Continue the last run of -Journal, skipping its completed steps")
+    parser.add_argument("-Stack_file", help="YAML or JSON spec of many stacks to provision at once")
+    parser.add_argument("-Stack_report", help="Write the per-stack report to a JSON file")
+    parser.add_argument("-Max_workers", type=int, default=AWS_STACK_MAX_WORKERS)
+    args = parser.parse_args()
+
+    if args.Profile_output:
+        EnableProfiling(traceMemory=args.Profile_memory == "true")
+        atexit.register(WriteProfile, args.Profile_output)
+
+    if args.Run_id:
+        SetRunId(args.Run_id)
+    journal = None
+    if args.Journal:
+        journal = RunJournal(args.Journal, resume=args.Resume == "true", resourceLoader=LoadEC2Resource)
+        SetRunId(journal.runId)
+    logger.info(f"Run ID: {GetRunId()}")
+
+    if args.Metrics_output:
+        EnableMetrics()
+        atexit.register(WriteMetrics, args.Metrics_output)
+
+    if args.Stack_file:
+        report = ProvisionStacks(
+            LoadStackSpecs(args.Stack_file),
+            maxWorkers=args.Max_workers,
+            planOnly=args.Plan_only == "true",
+            journal=journal,
+        )
+        if args.Stack_report:
+            with open(args.Stack_report, "w") as reportFile:
+                json.dump(report, reportFile, indent=2)
+        raise SystemExit(1 if any(row["status"] == "FAILED" for row in report) else 0)
+
     """
-    Creating nessesary AWS resources 
+    Snapshotting the account and planning what is missing
     """
-    logger.info("Creating nessesary AWS resources...")
-    CreateEC2Instance()
-    CreateVPC()
-    CreateInternetGateway()
-    CreateSubnet()
-    CreateRouteTable()
-    CreateSecurityGroup()
-    CreateNetworkInterface()
-    
+    existing = journal.Completed(BuildResourceGraph().nodes) if journal else {}
+    if existing:
+        SeedResourceIdCache(existing)
+    else:
+        existing = SnapshotEC2State()
+    plan = PlanResources(existing)
+    logger.info(f"Already existing: {', '.join(sorted(existing)) or 'nothing'}")
+    logger.info(f"Planned: {', '.join(plan) or 'nothing, the stack is up to date'}")
+
     """
-    Attaching resources to each other
+    Creating and attaching the missing AWS resources, independent ones in parallel
     """
-    logger.info("Attaching nessesary AWS resources...")
-    AttachInternetGatewayToVPC()
-    AttachNetworkInterfaceToEC2()
-    
+    if args.Plan_only == "false" and plan:
+        logger.info("Creating nessesary AWS resources...")
+        run = BuildResourceGraph(existing).Run(journal=journal)
+        run.LogTimings()
@@ -0,0 +1,183 @@
+###########################################################################
+###################### EC2 FLEET (BATCHED RUNINSTANCES) ###################
+###########################################################################
+import logging
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+import aws_create_resources as resources
+from aws_call_executor import ExecuteCall
+from aws_run_id import AWS_RUN_ID_TAG_KEY, GetRunId
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## AWS EC2 Fleet Configuration
+########################################################################
+AWS_EC2_FLEET_MAX_BATCH = 500
+AWS_EC2_FLEET_SHORTFALL_RETRIES = 3
+AWS_EC2_FLEET_RETRY_DELAY = 5
+AWS_EC2_CREATE_TAGS_MAX_RESOURCES = 1000
+AWS_EC2_CAPACITY_ERRORS = (
+    'InsufficientInstanceCapacity',
+    'InstanceLimitExceeded',
+    'InsufficientCapacity',
+)
+
+
+########################################################################
+## Fleet specs
+########################################################################
+def NormalizeInstanceSpec(spec):
+    """
+    Fill an instance spec with the defaults of the current stack
+    """
+    stack = resources.CurrentStack()
+    tags = dict(spec.get('Tags', {resources.AWS_TAGS_KEY: stack['instanceName']}))
+    tags.setdefault(AWS_RUN_ID_TAG_KEY, GetRunId())
+    return {
+        'ImageId': spec.get('ImageId', stack['imageId']),
+        'InstanceType': spec.get('InstanceType', stack['instanceType']),
+        'KeyName': spec.get('KeyName', stack['keyName']),
+        'SubnetId': spec.get('SubnetId'),
+        'Tags': tags,
+    }
+
+
+def GroupInstanceSpecs(specs, maxBatch=AWS_EC2_FLEET_MAX_BATCH):
+    """
+    Group compatible specs (same AMI, type, key and subnet) into batches of
+    at most maxBatch instances. Returns a list of (launch key, [spec indexes]).
+    """
+    groups = OrderedDict()
+    for index, spec in enumerate(specs):
+        key = (spec['ImageId'], spec['InstanceType'], spec['KeyName'], spec['SubnetId'])
+        groups.setdefault(key, []).append(index)
+
+    batches = []
+    for key, indexes in groups.items():
+        for start in range(0, len(indexes), maxBatch):
+            batches.append((key, indexes[start:start + maxBatch]))
+    return batches
+
+
+def _CommonTags(specs):
+    common = dict(specs[0]['Tags'])
+    for spec in specs[1:]:
+        common = {key: value for key, value in common.items() if spec['Tags'].get(key) == value}
+    return common
+
+
+########################################################################
+## Fleet creation
+########################################################################
+def _RunInstances(launchKey, count, commonTags):
+    imageId, instanceType, keyName, subnetId = launchKey
+    params = {
+        'ImageId': imageId,
+        'InstanceType': instanceType,
+        'MinCount': 1,
+        'MaxCount': count,
+    }
+    if keyName:
+        params['KeyName'] = keyName
+    if subnetId:
+        params['SubnetId'] = subnetId
+    if commonTags:
+        params['TagSpecifications'] = [
+            {
+                'ResourceType': 'instance',
+                'Tags': [{'Key': key, 'Value': value} for key, value in commonTags.items()],
+            },
+        ]
+    res = ExecuteCall(resources.GetEC2Client(), 'run_instances', **params)
+    return [instance['InstanceId'] for instance in res['Instances']]
+
+
+def _InstanceTagCalls(launched, specs, commonTags):
+    """
+    (instance IDs, tags) create_tags calls for the tags RunInstances did not
+    apply. A tag shared by several instances is applied to all of them in
+    one call; the tags only one instance carries (such as a unique Name) go
+    together in one call per instance, since create_tags gives every
+    resource of a call the same tags.
+    """
+    byTag = OrderedDict()
+    for index, instanceId in launched:
+        for key, value in specs[index]['Tags'].items():
+            if commonTags.get(key) != value:
+                byTag.setdefault((key, value), []).append(instanceId)
+
+    calls = []
+    unique = OrderedDict()
+    for (key, value), instanceIds in byTag.items():
+        if len(instanceIds) == 1:
+            unique.setdefault(instanceIds[0], {})[key] = value
+            continue
+        for start in range(0, len(instanceIds), AWS_EC2_CREATE_TAGS_MAX_RESOURCES):
+            calls.append((instanceIds[start:start + AWS_EC2_CREATE_TAGS_MAX_RESOURCES], {key: value}))
+    calls.extend(([instanceId], tags) for instanceId, tags in unique.items())
+    return calls
+
+
+def _TagInstances(calls):
+    for instanceIds, tags in calls:
+        ExecuteCall(
+            resources.GetEC2Client(), 'create_tags',
+            Resources=instanceIds,
+            Tags=[{'Key': key, 'Value': value} for key, value in tags.items()],
+        )
+
+
+def CreateEC2Fleet(
+        instanceSpecs,
+        maxBatch=AWS_EC2_FLEET_MAX_BATCH,
+        shortfallRetries=AWS_EC2_FLEET_SHORTFALL_RETRIES,
+        retryDelay=AWS_EC2_FLEET_RETRY_DELAY,
+):
+    """
+    Create many EC2 instances with as few RunInstances calls as possible.
+    Each spec may set ImageId, InstanceType, KeyName, SubnetId and Tags;
+    missing values fall back to the module defaults. Partial capacity is
+    accepted and only the shortfall is retried. Returns the instance IDs in
+    the order of the specs, None where an instance could not be launched.
+    Tags shared by a whole batch are set by RunInstances itself; the others
+    are applied as soon as the batch is up, so a later failure leaves no
+    instance untagged.
+    """
+    specs = [NormalizeInstanceSpec(spec) for spec in instanceSpecs]
+    instanceIds = [None] * len(specs)
+
+    for launchKey, indexes in GroupInstanceSpecs(specs, maxBatch):
+        pending = list(indexes)
+        commonTags = _CommonTags([specs[index] for index in indexes])
+        for attempt in range(shortfallRetries + 1):
+            if attempt:
+                logger.info(f"Retrying {len(pending)} instances of {launchKey} in {retryDelay}s")
+                time.sleep(retryDelay)
+            try:
+                launchedIds = _RunInstances(launchKey, len(pending), commonTags)
+            except ClientError as error:
+                if error.response['Error']['Code'] not in AWS_EC2_CAPACITY_ERRORS:
+                    logging.exception("******************************** ERROR: Unable to create EC2 fleet")
+                    raise
+                logger.warning(f"No capacity for {launchKey}: {error.response['Error']['Code']}")
+                continue
+
+            launched = list(zip(pending, launchedIds))
+            for index, instanceId in launched:
+                instanceIds[index] = instanceId
+            _TagInstances(_InstanceTagCalls(launched, specs, commonTags))
+            pending = pending[len(launchedIds):]
+            if not pending:
+                break
+
+        if pending:
+            logger.error(f"Could not launch {len(pending)} of {len(indexes)} instances of {launchKey}")
+
+    return instanceIds
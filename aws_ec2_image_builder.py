@@ -3,10 +3,34 @@
 ###########################################################################
 import logging
 import argparse
-import boto3
+import atexit
+import itertools
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 import yaml
 
+from aws_build_log_export import ExportBuildLogs
+from aws_call_executor import ErrorCode, ExecuteCall
+import aws_client_factory
+from aws_client_factory import GetClient
+from aws_component_cache import (
+    AWS_COMPONENT_CONTENT_HASH_TAG_KEY,
+    ComponentCache,
+    ComponentContentHash,
+    ComponentVersionArn,
+    NextSemanticVersion,
+)
+from aws_component_templates import COMPONENT_TEMPLATES, ComponentDocumentYaml
+from aws_image_waiter import ImageBuildWaiter
+from aws_inventory import IterateResources
+from aws_metrics import EnableMetrics, WriteMetrics
+from aws_profiler import EnableProfiling, WriteProfile
+from aws_resource_graph import NodeResult, ResourceGraph
+from aws_run_id import GetRunId, RunIdTagMap, SetRunId
+from aws_run_journal import JournaledCall, RunJournal
+
 ############################################################################
 # Setup logger
 ############################################################################
@@ -15,52 +39,242 @@ logging.basicConfig(
     level=logging.INFO, format="%(asctime)s: %(levelname)s: %(message)s"
 )
 
+############################################################################
+# Fan-out configuration
+############################################################################
+FANOUT_MAX_WORKERS = 8
+FANOUT_STEPS = (
+    "Component",
+    "Recipe",
+    "Distribution",
+    "Infrastructure",
+    "Pipeline",
+    "Execution",
+)
+COMPONENT_SUPPORTED_OS_VERSIONS = ["Ubuntu 18"]
+# Set to a ComponentCache to reuse unchanged components (-Component_cache)
+COMPONENT_CACHE = None
+# Credentials and default region of the image builder clients; None uses
+# the default boto3 credential chain and region. Set by -Access_key,
+# -Secret_access_key and -Region_name when run as a script.
+accessKey = None
+secretAccessKey = None
+region_name = None
+
 
 ############################################################################
 # Init AWS resources
 ############################################################################
-def GetImageBuilderClient():
+def GetImageBuilderClient(region=None):
     """
-    Getting the image builder client
+    Getting the shared image builder client, by default for region_name
+    (-Region_name) with the module credentials
     """
-    imageBuilderClient = boto3.client(
+    imageBuilderClient = GetClient(
         "imagebuilder",
-        region_name=region_name,
-        aws_access_key_id=accessKey,
-        aws_secret_access_key=secretAccessKey,
+        region_name=region or region_name,
+        accessKey=accessKey,
+        secretAccessKey=secretAccessKey,
     )
 
     return imageBuilderClient
 
 
+############################################################################
+# Request parameters, shared with the asyncio backend (aws_async.py)
+############################################################################
+def ComponentParams(componentName, componentSemanticVersion, componentPlatform, component_data, tags):
+    return {
+        "name": componentName,
+        "semanticVersion": componentSemanticVersion,
+        "description": "Component created using boto3 API",
+        "platform": componentPlatform,
+        "supportedOsVersions": COMPONENT_SUPPORTED_OS_VERSIONS,
+        "data": ComponentDocumentYaml(component_data),
+        "tags": tags,
+    }
+
+
+def ImageRecipeParams(
+        recipeName,
+        recipeSemanticVersion,
+        componentName,
+        region_name,
+        recipeImageName,
+        recipeOsVersion,
+        accountId,
+        componentArn=None,
+):
+    recipeImageName = recipeImageName.replace(" ", "-").lower()
+    componentName = componentName.lower()
+    componentArn = componentArn or (
+        f"arn:aws:imagebuilder:{region_name}:{accountId}:component/{componentName}/{recipeSemanticVersion}"
+    )
+    return {
+        "name": recipeName,
+        "semanticVersion": recipeSemanticVersion,
+        "components": [
+            {
+                "componentArn": componentArn,
+            }
+        ],
+        "parentImage": f"arn:aws:imagebuilder:{region_name}:aws:image/{recipeImageName}/{recipeOsVersion}",
+        "additionalInstanceConfiguration": {
+            'systemsManagerAgent': {
+                'uninstallAfterBuild': True,
+            },
+        },
+        "tags": RunIdTagMap(),
+    }
+
+
+def DistributionConfigurationParams(distributionName, region_name, targetRegions=None, targetAccountIds=None):
+    amiDistributionConfiguration = {
+        "name": "boto-{{imagebuilder:buildDate}}"
+    }
+    if targetAccountIds:
+        amiDistributionConfiguration["targetAccountIds"] = list(targetAccountIds)
+    return {
+        "name": distributionName,
+        "distributions": [
+            {
+                "region": f"{region}",
+                "amiDistributionConfiguration": amiDistributionConfiguration,
+            }
+            for region in (targetRegions or [region_name])
+        ],
+        "tags": RunIdTagMap(),
+    }
+
+
+def InfrastructureConfigurationParams(infrastructureName, infrastructureType, infrastructureInstanceProfileRoleName):
+    return {
+        "name": infrastructureName,
+        "instanceTypes": [f"{infrastructureType}"],
+        "instanceProfileName": f"{infrastructureInstanceProfileRoleName}",
+        "terminateInstanceOnFailure": True,
+        "tags": RunIdTagMap(),
+    }
+
+
+def ImagePipelineParams(
+        imagePipelineName,
+        region_name,
+        accountId,
+        recipeName,
+        recipeSemanticVersion,
+        infrastructureName,
+        distributionName,
+):
+    recipeName = recipeName.lower()
+    infrastructureName = infrastructureName.lower()
+    distributionName = distributionName.lower()
+    return {
+        "name": imagePipelineName,
+        "imageRecipeArn": f"arn:aws:imagebuilder:{region_name}:{accountId}:image-recipe/{recipeName}/{recipeSemanticVersion}",
+        "description": "Created using the boto3 API from python",
+        "infrastructureConfigurationArn": f"arn:aws:imagebuilder:{region_name}:{accountId}:infrastructure-configuration/{infrastructureName}",
+        "distributionConfigurationArn": f"arn:aws:imagebuilder:{region_name}:{accountId}:distribution-configuration/{distributionName}",
+        "imageTestsConfiguration": {"imageTestsEnabled": True, "timeoutMinutes": 60},
+        # "schedule": {
+        #     "scheduleExpression": "cron(0 * * * ?)",
+        #     "timezone": "UTC",
+        #     "pipelineExecutionStartCondition": "EXPRESSION_MATCH_AND_DEPENDENCY_UPDATES_AVAILABLE",
+        # },
+        "status": "ENABLED",
+        "tags": RunIdTagMap(),
+    }
+
+
+def PipelineExecutionParams(imagePipelineName, region_name, accountId):
+    imagePipelineName = imagePipelineName.lower()
+    return {
+        "imagePipelineArn": f'arn:aws:imagebuilder:{region_name}:{accountId}:image-pipeline/{imagePipelineName}',
+    }
+
+
+def LookupCachedComponent(client, componentName, componentSemanticVersion, componentPlatform, component_data):
+    """
+    Consult COMPONENT_CACHE before creating a component. Returns the result
+    to reuse (or None), the semantic version to create, the tags and the
+    content hash.
+    """
+    tags = RunIdTagMap()
+    if COMPONENT_CACHE is None:
+        return None, componentSemanticVersion, tags, None
+    contentHash = ComponentContentHash(componentPlatform, COMPONENT_SUPPORTED_OS_VERSIONS, component_data)
+    cachedArn = COMPONENT_CACHE.Lookup(client, componentName, contentHash)
+    if cachedArn:
+        logger.info(f"Component {componentName} is unchanged, reusing {cachedArn}")
+        return {"componentBuildVersionArn": cachedArn, "reused": True}, componentSemanticVersion, tags, contentHash
+    componentSemanticVersion = NextSemanticVersion(
+        componentSemanticVersion, COMPONENT_CACHE.Versions(client, componentName)
+    )
+    tags[AWS_COMPONENT_CONTENT_HASH_TAG_KEY] = contentHash
+    return None, componentSemanticVersion, tags, contentHash
+
+
+def ShouldResyncComponent(client, componentName, error):
+    """
+    True when a version conflict may come from a component created outside
+    of the index: it is synced and the creation retried once
+    """
+    if (
+            COMPONENT_CACHE is not None
+            and ErrorCode(error) == "ResourceAlreadyExistsException"
+            and not COMPONENT_CACHE.IsSynced(client, componentName)
+    ):
+        COMPONENT_CACHE.Sync(client, componentName)
+        return True
+    return False
+
+
 ############################################################################
 # Main logic
 ############################################################################
 def CreateComponent(
-        componentName, componentSemanticVersion, componentPlatform, component_data
+        componentName, componentSemanticVersion, componentPlatform, component_data, region_name=None
 ):
     """
-    Create a EC2 Image Builder Componet
+    Create a EC2 Image Builder Componet. With COMPONENT_CACHE set, a component
+    whose document did not change is reused without any upload, and a
+    changed one is uploaded under the next free semantic version.
     """
     try:
-        client = GetImageBuilderClient()
-        res = client.create_component(
-            name=componentName,
-            semanticVersion=componentSemanticVersion,
-            description="Component created using boto3 API",
-            platform=componentPlatform,
-            supportedOsVersions=[
-                "Ubuntu 18",
-            ],
-            data=yaml.dump(component_data),
+        client = GetImageBuilderClient(region_name)
+        cached, semanticVersion, tags, contentHash = LookupCachedComponent(
+            client, componentName, componentSemanticVersion, componentPlatform, component_data
         )
-    except ClientError:
+        if cached:
+            return cached
+        res = ExecuteCall(
+            client, "create_component",
+            **ComponentParams(componentName, semanticVersion, componentPlatform, component_data, tags)
+        )
+    except ClientError as error:
+        if ShouldResyncComponent(client, componentName, error):
+            return CreateComponent(
+                componentName, componentSemanticVersion, componentPlatform, component_data, region_name
+            )
         logger.exception("******* Could not create a component")
         raise
     else:
+        if COMPONENT_CACHE is not None:
+            COMPONENT_CACHE.Record(
+                client.meta.region_name, componentName, contentHash,
+                semanticVersion, res["componentBuildVersionArn"],
+            )
         return res
 
 
+def ComponentArnOf(component):
+    """
+    Version ARN of a CreateComponent result, or of an existing component ARN
+    """
+    arn = component if isinstance(component, str) else component["componentBuildVersionArn"]
+    return ComponentVersionArn(arn)
+
+
 def CreateImageRecipe(
         recipeName,
         recipeSemanticVersion,
@@ -69,35 +283,22 @@ def CreateImageRecipe(
         recipeImageName,
         recipeOsVersion,
         accountId,
+        componentArn=None,
 ):
     """
-    Create a EC2 Image Builder Recipe
+    Create a EC2 Image Builder Recipe using componentArn, by default the
+    component version named after the recipe version
     """
     try:
-        client = GetImageBuilderClient()
-        recipeImageName = recipeImageName.replace(" ", "-").lower()
-        componentName = componentName.lower()
-        print(
-            f"arn:aws:imagebuilder:{region_name}:aws:image/{recipeImageName}/{recipeOsVersion}"
-        )
-        print(
-            f"arn:aws:imagebuilder:{region_name}:{accountId}:component/{componentName}/{recipeSemanticVersion}"
-        )
-        res = client.create_image_recipe(
-            name=recipeName,
-            semanticVersion=recipeSemanticVersion,
-            components=[
-                {
-                    "componentArn": f"arn:aws:imagebuilder:{region_name}:{accountId}:component/{componentName}/{recipeSemanticVersion}",
-                }
-            ],
-            parentImage=f"arn:aws:imagebuilder:{region_name}:aws:image/{recipeImageName}/{recipeOsVersion}",
-            additionalInstanceConfiguration={
-                'systemsManagerAgent': {
-                    'uninstallAfterBuild': True,
-                },
-            }
+        client = GetImageBuilderClient(region_name)
+        params = ImageRecipeParams(
+            recipeName, recipeSemanticVersion, componentName, region_name,
+            recipeImageName, recipeOsVersion, accountId, componentArn,
         )
+        # Logged rather than printed: stdout may carry the -Build_log - stream
+        logger.debug(f"Recipe {recipeName}: parent image {params['parentImage']}")
+        logger.debug(f"Recipe {recipeName}: component {params['components'][0]['componentArn']}")
+        res = ExecuteCall(client, "create_image_recipe", **params)
 
     except ClientError:
         logger.exception("******* Could not create image recipe")
@@ -109,22 +310,18 @@ def CreateImageRecipe(
 def CreateImageDistributionConfiguration(
         distributionName,
         region_name,
+        targetRegions=None,
+        targetAccountIds=None,
 ):
     """
-    Create a EC2 Image Builder Distribution Configuration
+    Create a EC2 Image Builder Distribution Configuration, distributing to
+    region_name or to every region of targetRegions (and target accounts)
     """
     try:
-        client = GetImageBuilderClient()
-        res = client.create_distribution_configuration(
-            name=distributionName,
-            distributions=[
-                {
-                    "region": f"{region_name}",
-                    "amiDistributionConfiguration": {
-                        "name": "boto-{{imagebuilder:buildDate}}"
-                    },
-                }
-            ],
+        client = GetImageBuilderClient(region_name)
+        res = ExecuteCall(
+            client, "create_distribution_configuration",
+            **DistributionConfigurationParams(distributionName, region_name, targetRegions, targetAccountIds)
         )
     except ClientError:
         logger.exception("******* Could not create image distribution configuration")
@@ -137,17 +334,18 @@ def CreateImageInfrastructureConfiguration(
         infrastructureName,
         infrastructureType,
         infrastructureInstanceProfileRoleName,
+        region_name=None,
 ):
     """
     Create a EC2 Image Builder Infrastructure Configuration
     """
     try:
-        client = GetImageBuilderClient()
-        res = client.create_infrastructure_configuration(
-            name=infrastructureName,
-            instanceTypes=[f"{infrastructureType}"],
-            instanceProfileName=f"{infrastructureInstanceProfileRoleName}",
-            terminateInstanceOnFailure=True,
+        client = GetImageBuilderClient(region_name)
+        res = ExecuteCall(
+            client, "create_infrastructure_configuration",
+            **InfrastructureConfigurationParams(
+                infrastructureName, infrastructureType, infrastructureInstanceProfileRoleName
+            )
         )
     except ClientError:
         logger.exception("******* Could not create image infrastructure configuration")
@@ -169,23 +367,13 @@ def CreateImagePipeline(
     Create a EC2 Image Builder Pipeline
     """
     try:
-        client = GetImageBuilderClient()
-        recipeName = recipeName.lower()
-        infrastructureName = infrastructureName.lower()
-        distributionName = distributionName.lower()
-        res = client.create_image_pipeline(
-            name=imagePipelineName,
-            imageRecipeArn=f"arn:aws:imagebuilder:{region_name}:{accountId}:image-recipe/{recipeName}/{recipeSemanticVersion}",
-            description="Created using the boto3 API from python",
-            infrastructureConfigurationArn=f"arn:aws:imagebuilder:{region_name}:{accountId}:infrastructure-configuration/{infrastructureName}",
-            distributionConfigurationArn=f"arn:aws:imagebuilder:{region_name}:{accountId}:distribution-configuration/{distributionName}",
-            imageTestsConfiguration={"imageTestsEnabled": True, "timeoutMinutes": 60},
-            # schedule={
-            #     "scheduleExpression": "cron(0 * * * ?)",
-            #     "timezone": "UTC",
-            #     "pipelineExecutionStartCondition": "EXPRESSION_MATCH_AND_DEPENDENCY_UPDATES_AVAILABLE",
-            # },
-            status="ENABLED",
+        client = GetImageBuilderClient(region_name)
+        res = ExecuteCall(
+            client, "create_image_pipeline",
+            **ImagePipelineParams(
+                imagePipelineName, region_name, accountId, recipeName,
+                recipeSemanticVersion, infrastructureName, distributionName,
+            )
         )
     except ClientError:
         logger.exception("******* Could not create image pipeline")
@@ -203,10 +391,10 @@ def CreateStartImagepipelineExecution(
     Execute image pipeline
     """
     try:
-        client = GetImageBuilderClient()
-        imagePipelineName = imagePipelineName.lower()
-        res = client.start_image_pipeline_execution(
-            imagePipelineArn=f'arn:aws:imagebuilder:{region_name}:{accountId}:image-pipeline/{imagePipelineName}',
+        client = GetImageBuilderClient(region_name)
+        res = ExecuteCall(
+            client, "start_image_pipeline_execution",
+            **PipelineExecutionParams(imagePipelineName, region_name, accountId)
         )
     except ClientError:
         logger.exception("******* Could not execute image pipeline")
@@ -214,6 +402,427 @@ def CreateStartImagepipelineExecution(
     else:
         return res
 
+############################################################################
+# Component documents
+############################################################################
+def BuildComponentData(componentPlatform, recipeImageName, **parameters):
+    """
+    Patching component document for the OS family of the parent image,
+    rendered from the precompiled template registry
+    """
+    return COMPONENT_TEMPLATES.Render(
+        COMPONENT_TEMPLATES.Family(componentPlatform, recipeImageName), **parameters
+    )
+
+
+############################################################################
+# Account state snapshot
+############################################################################
+SNAPSHOT_LIST_CALLS = {
+    "Component": ("list_components", "componentVersionList", {"owner": "Self"}),
+    "Recipe": ("list_image_recipes", "imageRecipeSummaryList", {"owner": "Self"}),
+    "Distribution": ("list_distribution_configurations", "distributionConfigurationSummaryList", {}),
+    "Infrastructure": ("list_infrastructure_configurations", "infrastructureConfigurationSummaryList", {}),
+    "Pipeline": ("list_image_pipelines", "imagePipelineList", {}),
+}
+
+
+def ExpectedImagePipelineArns(
+        region_name,
+        accountId,
+        componentName,
+        componentSemanticVersion,
+        recipeName,
+        recipeSemanticVersion,
+        distributionName,
+        infrastructureName,
+        imagePipelineName,
+):
+    """
+    ARNs the pipeline resources get once they are created
+    """
+    prefix = f"arn:aws:imagebuilder:{region_name}:{accountId}"
+    return {
+        "Component": f"{prefix}:component/{componentName.lower()}/{componentSemanticVersion}",
+        "Recipe": f"{prefix}:image-recipe/{recipeName.lower()}/{recipeSemanticVersion}",
+        "Distribution": f"{prefix}:distribution-configuration/{distributionName.lower()}",
+        "Infrastructure": f"{prefix}:infrastructure-configuration/{infrastructureName.lower()}",
+        "Pipeline": f"{prefix}:image-pipeline/{imagePipelineName.lower()}",
+    }
+
+
+def SnapshotImageBuilderState(region_name, expectedArns):
+    """
+    Find which of the expected resources already exist, with one name-filtered
+    list call per resource type. Returns {step: ARN}.
+    """
+    client = GetImageBuilderClient(region_name)
+    existing = {}
+    for step, expectedArn in expectedArns.items():
+        operation, resultKey, kwargs = SNAPSHOT_LIST_CALLS[step]
+        name = expectedArn.split(":", 5)[5].split("/")[1]
+        for summary in IterateResources(
+                client, operation, resultKey, filters=[{"name": "name", "values": [name]}], **kwargs
+        ):
+            arn = summary["arn"].lower()
+            if arn == expectedArn.lower() or arn.startswith(expectedArn.lower() + "/"):
+                existing[step] = summary["arn"]
+                break
+    return existing
+
+
+############################################################################
+# Multi-region fan-out
+############################################################################
+def FanOutImagePipelines(
+        regions,
+        accountId,
+        componentName,
+        componentSemanticVersion,
+        componentPlatform,
+        component_data,
+        recipeName,
+        recipeSemanticVersion,
+        recipeImageName,
+        recipeOsVersion,
+        distributionName,
+        infrastructureName,
+        infrastructureType,
+        infrastructureInstanceProfileRoleName,
+        imagePipelineName,
+        targetAccountIds=None,
+        distributionRegions=None,
+        maxWorkers=FANOUT_MAX_WORKERS,
+        skipExisting=False,
+        journal=None,
+):
+    """
+    Set up and start the image pipeline in every region concurrently on a
+    bounded worker pool. Each region distributes to itself, or to every
+    region of distributionRegions. Returns a {region: {step: result}}
+    matrix and a {region: {step: error}} matrix; steps skipped because a
+    prerequisite failed are reported as errors too.
+
+    With skipExisting the account is snapshotted first and only missing
+    resources are created; a region whose pipeline is fully in place makes
+    no mutating call at all (its execution is not started again). Steps
+    found in journal are not run again.
+    """
+    existing = {region: {} for region in regions}
+    if skipExisting:
+        def Snapshot(region):
+            return SnapshotImageBuilderState(
+                region,
+                ExpectedImagePipelineArns(
+                    region,
+                    accountId,
+                    componentName,
+                    componentSemanticVersion,
+                    recipeName,
+                    recipeSemanticVersion,
+                    distributionName,
+                    infrastructureName,
+                    imagePipelineName,
+                ),
+            )
+
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            existing = dict(zip(regions, executor.map(Snapshot, regions)))
+
+    graph = ResourceGraph()
+    for region in regions:
+        graph.AddNode(
+            f"{region}:Component",
+            CreateComponent,
+            args=(componentName, componentSemanticVersion, componentPlatform, component_data, region),
+        )
+        graph.AddNode(
+            f"{region}:Recipe",
+            CreateImageRecipe,
+            args=(recipeName, recipeSemanticVersion, componentName, region, recipeImageName, recipeOsVersion, accountId),
+            kwargs={"componentArn": NodeResult(f"{region}:Component", ComponentArnOf)},
+        )
+        graph.AddNode(
+            f"{region}:Distribution",
+            CreateImageDistributionConfiguration,
+            args=(distributionName, region, distributionRegions, targetAccountIds),
+        )
+        graph.AddNode(
+            f"{region}:Infrastructure",
+            CreateImageInfrastructureConfiguration,
+            args=(infrastructureName, infrastructureType, infrastructureInstanceProfileRoleName, region),
+        )
+        graph.AddNode(
+            f"{region}:Pipeline",
+            CreateImagePipeline,
+            dependsOn=[f"{region}:Recipe", f"{region}:Distribution", f"{region}:Infrastructure"],
+            args=(imagePipelineName, region, accountId, recipeName, recipeSemanticVersion, infrastructureName, distributionName),
+        )
+        if len(existing[region]) < len(SNAPSHOT_LIST_CALLS):
+            graph.AddNode(
+                f"{region}:Execution",
+                CreateStartImagepipelineExecution,
+                dependsOn=[f"{region}:Pipeline"],
+                args=(imagePipelineName, region, accountId),
+            )
+        else:
+            logger.info(f"{region}: pipeline is up to date, nothing to do")
+        graph.MarkExisting({f"{region}:{step}": arn for step, arn in existing[region].items()})
+
+    run = graph.Run(maxWorkers=maxWorkers, raiseOnError=False, journal=journal)
+    results = {region: {} for region in regions}
+    errors = {region: {} for region in regions}
+    for name, res in run.results.items():
+        region, step = name.split(":", 1)
+        results[region][step] = res
+    for name, error in run.errors.items():
+        region, step = name.split(":", 1)
+        errors[region][step] = error
+    for name in run.skipped:
+        region, step = name.split(":", 1)
+        errors[region][step] = RuntimeError("Skipped, a prerequisite step failed")
+
+    for region in regions:
+        status = "OK" if not errors[region] else f"FAILED ({', '.join(errors[region])})"
+        logger.info(f"{region}: {status}")
+    return results, errors
+
+
+############################################################################
+# Build matrix
+############################################################################
+MATRIX_CELL_DEFAULTS = {
+    "componentPlatform": "Linux",
+    "componentSemanticVersion": "1.0.0",
+    "recipeSemanticVersion": "1.0.0",
+}
+MATRIX_REQUIRED_KEYS = (
+    "recipeImageName",
+    "recipeOsVersion",
+    "infrastructureType",
+    "infrastructureInstanceProfileRoleName",
+)
+
+
+def _Slug(value):
+    return re.sub(r"[^A-Za-z0-9]+", "-", str(value)).strip("-").lower()
+
+
+def _MatrixCell(prefix, values, labels):
+    """
+    Fill a matrix cell with the names of its resources. The names only
+    depend on what the resource is built from, so cells sharing a resource
+    share its name: one component per OS image, one recipe per OS image and
+    version, one infrastructure configuration per instance type and one
+    distribution configuration for the whole matrix.
+    """
+    cell = dict(MATRIX_CELL_DEFAULTS)
+    cell.update(values)
+    missing = [key for key in MATRIX_REQUIRED_KEYS if not cell.get(key)]
+    if missing:
+        raise ValueError(f"Matrix cell {labels} is missing {', '.join(missing)}")
+    image = _Slug(cell["recipeImageName"])
+    cell.setdefault("label", "-".join(_Slug(label) for label in labels))
+    cell.setdefault("componentName", f"{prefix}-component-{image}")
+    cell.setdefault("recipeName", f"{prefix}-recipe-{image}-{_Slug(cell['recipeOsVersion'])}")
+    cell.setdefault("infrastructureName", f"{prefix}-infrastructure-{_Slug(cell['infrastructureType'])}")
+    cell.setdefault("distributionName", f"{prefix}-distribution")
+    cell.setdefault("imagePipelineName", f"{prefix}-{cell['label']}")
+    return cell
+
+
+def ExpandBuildMatrix(spec):
+    """
+    Expand a build matrix spec into cells:
+
+        name: patching
+        defaults: {infrastructureInstanceProfileRoleName: EC2ImageBuilderRole}
+        matrix:
+          os:
+            - {label: ubuntu, recipeImageName: Ubuntu Server 20.04 LTS x86}
+            - {label: amazon, recipeImageName: Amazon Linux 2 x86}
+          recipeOsVersion: [x.x.x]
+          infrastructureType: [t3.micro, t3.large]
+        include:
+          - {label: debian, recipeImageName: Debian 11 x86, recipeOsVersion: x.x.x, infrastructureType: t3.micro}
+
+    Every combination of the matrix axes is a cell; an axis value is either
+    a scalar set under the axis name or a mapping of parameters. Extra cells
+    may be listed under include.
+    """
+    prefix = _Slug(spec.get("name", "matrix"))
+    defaults = spec.get("defaults") or {}
+    axes = spec.get("matrix") or {}
+    cells = []
+    if axes:
+        for combination in itertools.product(*axes.values()):
+            values = dict(defaults)
+            labels = []
+            for axis, value in zip(axes, combination):
+                if isinstance(value, dict):
+                    value = dict(value)
+                    labels.append(value.pop("label", None) or "-".join(str(v) for v in value.values()))
+                    values.update(value)
+                else:
+                    labels.append(value)
+                    values[axis] = value
+            cells.append(_MatrixCell(prefix, values, labels))
+    for extra in spec.get("include") or []:
+        values = dict(defaults)
+        values.update(extra)
+        cells.append(_MatrixCell(prefix, values, [extra.get("label") or len(cells)]))
+
+    labels = [cell["label"] for cell in cells]
+    duplicates = sorted({label for label in labels if labels.count(label) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate matrix cells: {', '.join(duplicates)}")
+    return cells
+
+
+def LoadBuildMatrix(path):
+    """
+    Read a build matrix YAML file and expand it into cells
+    """
+    with open(path) as matrixFile:
+        return ExpandBuildMatrix(yaml.safe_load(matrixFile))
+
+
+def _AddSharedNode(graph, configs, name, func, args, dependsOn=(), kwargs=None):
+    """
+    Add a graph node once per resource; cells sharing it must agree on how
+    it is built
+    """
+    if name in graph.nodes:
+        if configs[name] != args:
+            raise ValueError(f"Matrix cells build {name} in different ways")
+        return
+    configs[name] = args
+    graph.AddNode(name, func, dependsOn=dependsOn, args=args, kwargs=kwargs)
+
+
+def RunBuildMatrix(
+        cells,
+        regions,
+        accountId,
+        targetAccountIds=None,
+        distributionRegions=None,
+        maxWorkers=FANOUT_MAX_WORKERS,
+        journal=None,
+):
+    """
+    Create the components, recipes, infrastructure and distribution
+    configurations and pipelines of every cell in every region, shared
+    resources once, all on one bounded worker pool, and start the pipelines.
+    Every client is built for an explicit region with the module credentials
+    (the default chain unless set), so this can be called as a library.
+    Returns one report row per (region, cell).
+    """
+    graph = ResourceGraph()
+    configs = {}
+    cellNodes = []
+    for region in regions:
+        for cell in cells:
+            nodes = {
+                "Component": f"{region}:Component:{cell['componentName']}",
+                "Recipe": f"{region}:Recipe:{cell['recipeName']}",
+                "Distribution": f"{region}:Distribution:{cell['distributionName']}",
+                "Infrastructure": f"{region}:Infrastructure:{cell['infrastructureName']}",
+                "Pipeline": f"{region}:Pipeline:{cell['imagePipelineName']}",
+                "Execution": f"{region}:Execution:{cell['imagePipelineName']}",
+            }
+            _AddSharedNode(
+                graph, configs, nodes["Component"], CreateComponent,
+                (
+                    cell["componentName"],
+                    cell["componentSemanticVersion"],
+                    cell["componentPlatform"],
+                    BuildComponentData(cell["componentPlatform"], cell["recipeImageName"]),
+                    region,
+                ),
+            )
+            _AddSharedNode(
+                graph, configs, nodes["Recipe"], CreateImageRecipe,
+                (
+                    cell["recipeName"],
+                    cell["recipeSemanticVersion"],
+                    cell["componentName"],
+                    region,
+                    cell["recipeImageName"],
+                    cell["recipeOsVersion"],
+                    accountId,
+                ),
+                kwargs={"componentArn": NodeResult(nodes["Component"], ComponentArnOf)},
+            )
+            _AddSharedNode(
+                graph, configs, nodes["Distribution"], CreateImageDistributionConfiguration,
+                (cell["distributionName"], region, distributionRegions, targetAccountIds),
+            )
+            _AddSharedNode(
+                graph, configs, nodes["Infrastructure"], CreateImageInfrastructureConfiguration,
+                (
+                    cell["infrastructureName"],
+                    cell["infrastructureType"],
+                    cell["infrastructureInstanceProfileRoleName"],
+                    region,
+                ),
+            )
+            _AddSharedNode(
+                graph, configs, nodes["Pipeline"], CreateImagePipeline,
+                (
+                    cell["imagePipelineName"],
+                    region,
+                    accountId,
+                    cell["recipeName"],
+                    cell["recipeSemanticVersion"],
+                    cell["infrastructureName"],
+                    cell["distributionName"],
+                ),
+                dependsOn=[nodes["Recipe"], nodes["Distribution"], nodes["Infrastructure"]],
+            )
+            _AddSharedNode(
+                graph, configs, nodes["Execution"], CreateStartImagepipelineExecution,
+                (cell["imagePipelineName"], region, accountId),
+                dependsOn=[nodes["Pipeline"]],
+            )
+            cellNodes.append((region, cell, nodes))
+
+    logger.info(
+        f"Build matrix: {len(cells)} cells in {len(regions)} region(s), "
+        f"{len(graph.nodes)} resources to create"
+    )
+    run = graph.Run(maxWorkers=maxWorkers, raiseOnError=False, journal=journal)
+    report = []
+    for region, cell, nodes in cellNodes:
+        errors = {}
+        for step, name in nodes.items():
+            if name in run.errors:
+                errors[step] = str(run.errors[name])
+            elif name in run.skipped:
+                errors[step] = "Skipped, a prerequisite step failed"
+        execution = run.results.get(nodes["Execution"]) or {}
+        report.append({
+            "region": region,
+            "cell": cell["label"],
+            "status": "FAILED" if errors else "OK",
+            "pipeline": (run.results.get(nodes["Pipeline"]) or {}).get("imagePipelineArn"),
+            "imageBuildVersionArn": execution.get("imageBuildVersionArn"),
+            "errors": errors,
+        })
+    LogBuildMatrixReport(report)
+    return report
+
+
+def LogBuildMatrixReport(report):
+    width = max([len(row["cell"]) for row in report] + [4])
+    for row in report:
+        detail = row["imageBuildVersionArn"] or "; ".join(
+            f"{step}: {error}" for step, error in row["errors"].items()
+        )
+        logger.info(f"{row['region']} {row['cell']:<{width}} {row['status']:<6} {detail}")
+    failed = sum(1 for row in report if row["status"] != "OK")
+    logger.info(f"Build matrix: {len(report) - failed} OK, {failed} FAILED")
+
+
 if __name__ == '__main__':
     ###########################################################################
     # Parsing arguments
@@ -238,9 +847,35 @@ if __name__ == '__main__':
     parser.add_argument("-Infrastructure_type")
     parser.add_argument("-Infrastructure_instance_profile_role_name")
     parser.add_argument("-Image_pipeline_name")
+    parser.add_argument("-Max_pool_connections", type=int, default=aws_client_factory.AWS_CLIENT_MAX_POOL_CONNECTIONS)
+    parser.add_argument("-Tcp_keepalive", choices=["true", "false"], default="true")
+    parser.add_argument("-Wait_for_image", choices=["true", "false"], default="false")
+    parser.add_argument("-Build_log", help="Follow the started builds, writing their progress as NDJSON (- for stdout)")
+    parser.add_argument("-Regions", help="Comma-separated regions to fan the pipeline out to")
+    parser.add_argument("-Distribution_regions", help="Comma-separated regions every pipeline distributes to")
+    parser.add_argument("-Target_account_ids", help="Comma-separated accounts the AMIs are distributed to")
+    parser.add_argument("-Max_workers", type=int, default=FANOUT_MAX_WORKERS)
+    parser.add_argument("-Skip_existing", choices=["true", "false"], default="false")
+    parser.add_argument("-Metrics_output", help="Write API call metrics to a .json or .prom file")
+    parser.add_argument("-Profile_output",
+                        help="Profile the run: folded stacks for flamegraphs here, the time breakdown next to it")
+    parser.add_argument("-Profile_memory", choices=["true", "false"], default="false",
+                        help="With -Profile_output, also report the top allocation sites (tracemalloc)")
+    parser.add_argument("-Run_id", help="ID tagged on the created resources, used by aws_teardown.py")
+    parser.add_argument("-Matrix_file", help="YAML build matrix (OS x version x instance type) to create at once")
+    parser.add_argument("-Matrix_report", help="Write the per-cell build matrix report to a JSON file")
+    parser.add_argument("-Component_cache", help="Reuse unchanged components, indexed in this JSON file")
+    parser.add_argument("-Component_cache_sync", choices=["true", "false"], default="false")
+    parser.add_argument("-Journal", help="Record every completed step in this JSON-lines file")
+    parser.add_argument("-Resume", choices=["true", "false"], default="false",
+                        help="Continue the last run of -Journal, skipping its completed steps")
 
     args = parser.parse_args()
 
+    if args.Profile_output:
+        EnableProfiling(traceMemory=args.Profile_memory == "true")
+        atexit.register(WriteProfile, args.Profile_output)
+
     accountId = args.Account_id
     accessKey = args.Access_key
     secretAccessKey = args.Secret_access_key
@@ -257,85 +892,127 @@ if __name__ == '__main__':
     infrastructureType = args.Infrastructure_type
     infrastructureInstanceProfileRoleName = args.Infrastructure_instance_profile_role_name
     imagePipelineName = args.Image_pipeline_name
-
-    #############################################################################
-    # Set pathing parameters
-    #############################################################################
-    payload = None
-    lastPatchDate = None
-
-    if componentPlatform == "Linux":
-        if "Ubuntu" in recipeImageName or "Debian" in recipeImageName:
-            payload = "apt update -y"
-            lastPatchDate = "cat /var/log/apt/history.log | grep 'End-Date' | tail -1"
-        elif "Amazon" in recipeImageName or "Centos" in recipeImageName:
-            payload = "yum -y update"
-            lastPatchDate = "grep 'Updated:' /var/log/yum.log | tail -1"
-        else:
-            payload = "echo Patching stage"
-
-    component_data = {
-        "name": "CreateFileAndTestExists",
-        "schemaVersion": "1.0",
-        "phases": [
-            {
-                "name": "build",
-                "steps": [
-                    {
-                        "name": "Patching",
-                        "action": "ExecuteBash",
-                        "inputs": {
-                            "commands": [
-                                "echo 'Start patching stage...'",
-                                f"{payload}",
-                                "sleep 10",
-                                "echo 'Start validation stage...'",
-                                f"{lastPatchDate}",
-                            ]
-                        },
-                    }
-                ],
-            },
-        ],
-    }
+    regions = args.Regions.split(",") if args.Regions else None
+    distributionRegions = args.Distribution_regions.split(",") if args.Distribution_regions else None
+    targetAccountIds = args.Target_account_ids.split(",") if args.Target_account_ids else None
+    aws_client_factory.AWS_CLIENT_MAX_POOL_CONNECTIONS = args.Max_pool_connections
+    aws_client_factory.AWS_CLIENT_TCP_KEEPALIVE = args.Tcp_keepalive == "true"
+    if args.Metrics_output:
+        EnableMetrics()
+        atexit.register(WriteMetrics, args.Metrics_output)
+    if args.Run_id:
+        SetRunId(args.Run_id)
+    if args.Component_cache:
+        COMPONENT_CACHE = ComponentCache(args.Component_cache, sync=args.Component_cache_sync == "true")
+    journal = None
+    if args.Journal:
+        journal = RunJournal(args.Journal, resume=args.Resume == "true")
+        SetRunId(journal.runId)
+    logger.info(f"Run ID: {GetRunId()}")
 
     #######################################################################################
     # Running funs
     #######################################################################################
-    CreateComponent(
-        componentName,
-        componentSemanticVersion,
-        componentPlatform,
-        component_data,
-    )
-    CreateImageRecipe(
-        recipeName,
-        recipeSemanticVersion,
-        componentName,
-        region_name,
-        recipeImageName,
-        recipeOsVersion,
-        accountId,
-    )
-    CreateImageDistributionConfiguration(
-        distributionName, region_name
-    )
-    CreateImageInfrastructureConfiguration(
-        infrastructureName,
-        infrastructureType,
-        infrastructureInstanceProfileRoleName,
-    )
-    CreateImagePipeline(
-        imagePipelineName,
-        region_name,
-        accountId,
-        recipeName,
-        recipeSemanticVersion,
-        infrastructureName,
-        distributionName,
-    )
-    CreateStartImagepipelineExecution(
-        imagePipelineName,
-        region_name,
-        accountId,
-    )
+    if args.Matrix_file:
+        report = RunBuildMatrix(
+            LoadBuildMatrix(args.Matrix_file),
+            regions or [region_name],
+            accountId,
+            targetAccountIds=targetAccountIds,
+            distributionRegions=distributionRegions,
+            maxWorkers=args.Max_workers,
+            journal=journal,
+        )
+        if args.Matrix_report:
+            with open(args.Matrix_report, "w") as reportFile:
+                json.dump(report, reportFile, indent=2)
+        executions = [
+            {"imageBuildVersionArn": row["imageBuildVersionArn"]}
+            for row in report if row["imageBuildVersionArn"]
+        ]
+    elif regions or args.Skip_existing == "true":
+        # Matrix cells render their own documents; only these paths need -Component_platform
+        component_data = BuildComponentData(componentPlatform, recipeImageName)
+        results, errors = FanOutImagePipelines(
+            regions or [region_name],
+            accountId,
+            componentName,
+            componentSemanticVersion,
+            componentPlatform,
+            component_data,
+            recipeName,
+            recipeSemanticVersion,
+            recipeImageName,
+            recipeOsVersion,
+            distributionName,
+            infrastructureName,
+            infrastructureType,
+            infrastructureInstanceProfileRoleName,
+            imagePipelineName,
+            targetAccountIds=targetAccountIds,
+            distributionRegions=distributionRegions,
+            maxWorkers=args.Max_workers,
+            skipExisting=args.Skip_existing == "true",
+            journal=journal,
+        )
+        executions = [res["Execution"] for res in results.values() if "Execution" in res]
+    else:
+        component_data = BuildComponentData(componentPlatform, recipeImageName)
+        component = JournaledCall(
+            journal, "Component", CreateComponent,
+            componentName,
+            componentSemanticVersion,
+            componentPlatform,
+            component_data,
+        )
+        JournaledCall(
+            journal, "Recipe", CreateImageRecipe,
+            recipeName,
+            recipeSemanticVersion,
+            componentName,
+            region_name,
+            recipeImageName,
+            recipeOsVersion,
+            accountId,
+            componentArn=ComponentArnOf(component),
+        )
+        JournaledCall(
+            journal, "Distribution", CreateImageDistributionConfiguration,
+            distributionName, region_name, distributionRegions, targetAccountIds
+        )
+        JournaledCall(
+            journal, "Infrastructure", CreateImageInfrastructureConfiguration,
+            infrastructureName,
+            infrastructureType,
+            infrastructureInstanceProfileRoleName,
+        )
+        JournaledCall(
+            journal, "Pipeline", CreateImagePipeline,
+            imagePipelineName,
+            region_name,
+            accountId,
+            recipeName,
+            recipeSemanticVersion,
+            infrastructureName,
+            distributionName,
+        )
+        executions = [
+            JournaledCall(
+                journal, "Execution", CreateStartImagepipelineExecution,
+                imagePipelineName,
+                region_name,
+                accountId,
+            )
+        ]
+
+    if args.Build_log:
+        ExportBuildLogs(
+            [execution["imageBuildVersionArn"] for execution in executions],
+            args.Build_log,
+            clientFactory=GetImageBuilderClient,
+        )
+    elif args.Wait_for_image == "true":
+        waiter = ImageBuildWaiter(clientFactory=GetImageBuilderClient)
+        for execution in executions:
+            waiter.Track(execution["imageBuildVersionArn"])
+        waiter.Run()
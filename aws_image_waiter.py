@@ -0,0 +1,222 @@
+###########################################################################
+############### IMAGE PIPELINE EXECUTION WAITER ENGINE ####################
+###########################################################################
+import asyncio
+import logging
+import random
+import time
+
+from botocore.exceptions import ClientError
+
+from aws_call_executor import ExecuteCallWithRetries, IsThrottlingError
+from aws_client_factory import GetClient
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Waiter Configuration
+########################################################################
+AWS_WAITER_MIN_INTERVAL = 15
+AWS_WAITER_MAX_INTERVAL = 120
+AWS_WAITER_BACKOFF = 1.5
+AWS_WAITER_JITTER = 0.2
+AWS_WAITER_MAX_THROTTLE_PENALTY = 8
+AWS_IMAGE_TERMINAL_STATUSES = frozenset(
+    ["AVAILABLE", "CANCELLED", "FAILED", "DEPRECATED", "DELETED", "DISABLED"]
+)
+
+
+########################################################################
+## Image build version ARNs
+########################################################################
+def ParseImageBuildVersionArn(imageBuildVersionArn):
+    """
+    Split arn:aws:imagebuilder:<region>:<account>:image/<name>/<version>/<build>
+    into its region and image version ARN
+    """
+    parts = imageBuildVersionArn.split(":")
+    if len(parts) < 6 or parts[2] != "imagebuilder" or parts[5].count("/") != 3:
+        raise ValueError(f"Not an image build version ARN: {imageBuildVersionArn}")
+    return parts[3], imageBuildVersionArn.rsplit("/", 1)[0]
+
+
+class _PollGroup:
+    """
+    Builds of one image version, polled together with a single list call
+    """
+
+    def __init__(self, region, imageVersionArn, interval, nextPoll):
+        self.region = region
+        self.imageVersionArn = imageVersionArn
+        self.arns = set()
+        self.interval = interval
+        self.nextPoll = nextPoll
+
+
+########################################################################
+## Waiter engine
+########################################################################
+class ImageBuildWaiter:
+    """
+    Track many image pipeline executions from a single thread or asyncio
+    loop. Builds of the same image version are polled with one
+    list_image_build_versions call, each poll group backs off (with jitter)
+    while nothing changes, and throttling slows every group down.
+    Subscribers get an event for every status transition.
+    """
+
+    def __init__(
+            self,
+            clientFactory=None,
+            minInterval=AWS_WAITER_MIN_INTERVAL,
+            maxInterval=AWS_WAITER_MAX_INTERVAL,
+            backoff=AWS_WAITER_BACKOFF,
+            jitter=AWS_WAITER_JITTER,
+            clock=time.monotonic,
+            sleep=time.sleep,
+    ):
+        self.clientFactory = clientFactory or (lambda region: GetClient("imagebuilder", region_name=region))
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.clock = clock
+        self.sleep = sleep
+        self.statuses = {}
+        self.groups = {}
+        self.listeners = []
+        self.throttlePenalty = 1.0
+        self.apiCalls = 0
+
+    def Track(self, imageBuildVersionArn):
+        """
+        Start watching an image build version, e.g. the imageBuildVersionArn
+        returned by start_image_pipeline_execution
+        """
+        region, imageVersionArn = ParseImageBuildVersionArn(imageBuildVersionArn)
+        group = self.groups.get(imageVersionArn)
+        if group is None:
+            group = self.groups[imageVersionArn] = _PollGroup(
+                region, imageVersionArn, self.minInterval, self.clock()
+            )
+        group.arns.add(imageBuildVersionArn)
+        self.statuses.setdefault(imageBuildVersionArn, None)
+
+    def Subscribe(self, callback):
+        """
+        Register callback(event) for status transitions
+        """
+        self.listeners.append(callback)
+
+    @property
+    def pending(self):
+        return [arn for arn, status in self.statuses.items() if status not in AWS_IMAGE_TERMINAL_STATUSES]
+
+    def _Emit(self, arn, previous, state):
+        event = {
+            "arn": arn,
+            "previous": previous,
+            "status": state.get("status"),
+            "reason": state.get("reason"),
+            "time": time.time(),
+        }
+        logger.info(f"{arn}: {previous} -> {event['status']}")
+        for listener in self.listeners:
+            listener(event)
+
+    def _Jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _ListBuildStates(self, group):
+        client = self.clientFactory(group.region)
+        states = {}
+        kwargs = {"imageVersionArn": group.imageVersionArn}
+        while True:
+            self.apiCalls += 1
+            # A single attempt: throttling is handled by the poll backoff below
+            res = ExecuteCallWithRetries(client, "list_image_build_versions", kwargs, maxAttempts=1)
+            for summary in res.get("imageSummaryList", []):
+                if summary["arn"] in group.arns:
+                    states[summary["arn"]] = summary.get("state", {})
+            if not res.get("nextToken") or len(states) == len(group.arns):
+                return states
+            kwargs["nextToken"] = res["nextToken"]
+
+    def _PollGroup(self, group):
+        """
+        Poll the builds of a group; False when throttled
+        """
+        try:
+            states = self._ListBuildStates(group)
+        except ClientError as error:
+            if not IsThrottlingError(error):
+                raise
+            self.throttlePenalty = min(self.throttlePenalty * 2, AWS_WAITER_MAX_THROTTLE_PENALTY)
+            group.interval = min(group.interval * 2, self.maxInterval)
+            logger.warning(f"Throttled while polling {group.imageVersionArn}, backing off")
+            return False
+
+        self.throttlePenalty = max(1.0, self.throttlePenalty * 0.75)
+        changed = False
+        for arn, state in states.items():
+            previous = self.statuses.get(arn)
+            if state.get("status") != previous:
+                changed = True
+                self.statuses[arn] = state.get("status")
+                self._Emit(arn, previous, state)
+                if self.statuses[arn] in AWS_IMAGE_TERMINAL_STATUSES:
+                    group.arns.discard(arn)
+
+        if changed:
+            group.interval = self.minInterval
+        else:
+            group.interval = min(group.interval * self.backoff, self.maxInterval)
+        return True
+
+    def PollOnce(self):
+        """
+        Poll every group which is due and return the seconds until the next one
+        """
+        now = self.clock()
+        for key, group in list(self.groups.items()):
+            if not group.arns:
+                del self.groups[key]
+                continue
+            if group.nextPoll <= now:
+                self._PollGroup(group)
+                group.nextPoll = self.clock() + self._Jittered(group.interval * self.throttlePenalty)
+            if not group.arns:
+                del self.groups[key]
+        if not self.groups:
+            return None
+        return max(0.0, min(group.nextPoll for group in self.groups.values()) - self.clock())
+
+    def Run(self, timeout=None):
+        """
+        Block until every tracked build reaches a terminal status
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            delay = self.PollOnce()
+            if delay is None:
+                return dict(self.statuses)
+            if deadline is not None and self.clock() + delay > deadline:
+                raise TimeoutError(f"{len(self.pending)} image builds still running")
+            self.sleep(delay)
+
+    async def RunAsync(self, timeout=None):
+        """
+        Same as Run() for an asyncio loop; polls run in the default executor
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            delay = await loop.run_in_executor(None, self.PollOnce)
+            if delay is None:
+                return dict(self.statuses)
+            if deadline is not None and self.clock() + delay > deadline:
+                raise TimeoutError(f"{len(self.pending)} image builds still running")
+            await asyncio.sleep(delay)
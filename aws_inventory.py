@@ -0,0 +1,126 @@
+###########################################################################
+################# PAGINATED, STREAMING INVENTORY ITERATORS ################
+###########################################################################
+import logging
+
+from aws_call_executor import ExecuteCall
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Inventory Configuration
+########################################################################
+AWS_INVENTORY_PAGE_SIZE = 100
+AWS_INVENTORY_SMALL_PAGE_SIZE = 5
+AWS_INVENTORY_ALIVE_INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+
+########################################################################
+## Pagination
+########################################################################
+def PaginationMembers(client, operation):
+    """
+    Names of the token and page-size members of an operation (EC2 uses
+    NextToken/MaxResults, Image Builder nextToken/maxResults, the tagging
+    API PaginationToken/ResourcesPerPage)
+    """
+    apiName = client.meta.method_to_api_mapping[operation]
+    members = client.meta.service_model.operation_model(apiName).input_shape.members
+    token = next((name for name in ('NextToken', 'nextToken', 'PaginationToken') if name in members), None)
+    size = next((name for name in ('MaxResults', 'maxResults', 'ResourcesPerPage') if name in members), None)
+    return token, size
+
+
+def PaginateCall(client, operation, pageSize=AWS_INVENTORY_PAGE_SIZE, **kwargs):
+    """
+    Yield the pages of an operation one at a time, each fetched through
+    ExecuteCall; the next page is only requested when the caller asks for it
+    """
+    token, size = PaginationMembers(client, operation)
+    if size and pageSize:
+        kwargs[size] = pageSize
+    while True:
+        page = ExecuteCall(client, operation, **kwargs)
+        yield page
+        nextToken = page.get(token) if token else None
+        if not nextToken:
+            return
+        kwargs[token] = nextToken
+
+
+def IterateResources(client, operation, resultKey, pageSize=AWS_INVENTORY_PAGE_SIZE, **kwargs):
+    """
+    Stream the items of a paginated Describe*/List* call with server-side
+    filters; breaking out of the loop stops further page requests
+    """
+    for page in PaginateCall(client, operation, pageSize, **kwargs):
+        yield from page.get(resultKey, [])
+
+
+def Filters(filters):
+    """
+    EC2 Filters list from a {'vpc-id': 'vpc-1', 'tag:Name': ['a', 'b']} dict
+    """
+    return [
+        {'Name': name, 'Values': list(values) if isinstance(values, (list, tuple)) else [values]}
+        for name, values in (filters or {}).items()
+    ]
+
+
+########################################################################
+## EC2 inventory iterators
+########################################################################
+def IterateVPCs(client, filters=None, pageSize=AWS_INVENTORY_PAGE_SIZE):
+    return IterateResources(client, 'describe_vpcs', 'Vpcs', pageSize, Filters=Filters(filters))
+
+
+def IterateSubnets(client, filters=None, pageSize=AWS_INVENTORY_PAGE_SIZE):
+    return IterateResources(client, 'describe_subnets', 'Subnets', pageSize, Filters=Filters(filters))
+
+
+def IterateSecurityGroups(client, filters=None, pageSize=AWS_INVENTORY_PAGE_SIZE):
+    return IterateResources(
+        client, 'describe_security_groups', 'SecurityGroups', pageSize, Filters=Filters(filters)
+    )
+
+
+def IterateSecurityGroupRules(client, filters=None, pageSize=AWS_INVENTORY_PAGE_SIZE):
+    return IterateResources(
+        client, 'describe_security_group_rules', 'SecurityGroupRules', pageSize, Filters=Filters(filters)
+    )
+
+
+def IterateInternetGateways(client, filters=None, pageSize=AWS_INVENTORY_PAGE_SIZE):
+    return IterateResources(
+        client, 'describe_internet_gateways', 'InternetGateways', pageSize, Filters=Filters(filters)
+    )
+
+
+def IterateRouteTables(client, filters=None, pageSize=AWS_INVENTORY_PAGE_SIZE):
+    return IterateResources(client, 'describe_route_tables', 'RouteTables', pageSize, Filters=Filters(filters))
+
+
+def IterateNetworkInterfaces(client, filters=None, pageSize=AWS_INVENTORY_PAGE_SIZE):
+    return IterateResources(
+        client, 'describe_network_interfaces', 'NetworkInterfaces', pageSize, Filters=Filters(filters)
+    )
+
+
+def IterateInstances(client, filters=None, pageSize=AWS_INVENTORY_PAGE_SIZE):
+    """
+    Stream instances, flattening the reservations of each page
+    """
+    for reservation in IterateResources(
+            client, 'describe_instances', 'Reservations', pageSize, Filters=Filters(filters)
+    ):
+        yield from reservation['Instances']
+
+
+def FirstOf(iterator):
+    """
+    First item of an inventory iterator or None; no further page is fetched
+    """
+    return next(iter(iterator), None)
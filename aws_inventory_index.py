@@ -0,0 +1,394 @@
+###########################################################################
+################### LOCAL INVENTORY INDEX (SQLITE) ########################
+###########################################################################
+# A local SQLite copy of the account inventory, indexed by ID, name and
+# tag, so that "does it exist / what is its ID" is answered without AWS:
+#
+#   index = InventoryIndex('inventory.db')
+#   index.Refresh(['us-east-1'])                        # full, parallel
+#   index.Refresh(['us-east-1'], maxAge=600)            # stale types only
+#   index.Refresh(['us-east-1'], tags={'automation:run-id': runId})
+#   index.FindByName('us-east-1', 'subnet', 'private-us-east-1a')
+###########################################################################
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import aws_create_resources as resources
+from aws_client_factory import GetClient
+from aws_inventory import (
+    IterateInstances,
+    IterateInternetGateways,
+    IterateNetworkInterfaces,
+    IterateResources,
+    IterateSecurityGroups,
+    IterateSubnets,
+    IterateVPCs,
+)
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Inventory Index Configuration
+########################################################################
+AWS_INVENTORY_INDEX_PATH = 'inventory.db'
+AWS_INVENTORY_INDEX_MAX_WORKERS = 16
+# type: (iterator, ID key)
+AWS_INVENTORY_INDEX_EC2_TYPES = {
+    'vpc': (IterateVPCs, 'VpcId'),
+    'subnet': (IterateSubnets, 'SubnetId'),
+    'security-group': (IterateSecurityGroups, 'GroupId'),
+    'internet-gateway': (IterateInternetGateways, 'InternetGatewayId'),
+    'network-interface': (IterateNetworkInterfaces, 'NetworkInterfaceId'),
+    'instance': (IterateInstances, 'InstanceId'),
+}
+# type: (operation, result key, parameters)
+AWS_INVENTORY_INDEX_IMAGE_BUILDER_TYPES = {
+    'component': ('list_components', 'componentVersionList', {'owner': 'Self'}),
+    'image-recipe': ('list_image_recipes', 'imageRecipeSummaryList', {'owner': 'Self'}),
+    'image-pipeline': ('list_image_pipelines', 'imagePipelineList', {}),
+}
+AWS_INVENTORY_INDEX_TYPES = tuple(AWS_INVENTORY_INDEX_EC2_TYPES) + tuple(AWS_INVENTORY_INDEX_IMAGE_BUILDER_TYPES)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS resources (
+    region TEXT NOT NULL,
+    type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT,
+    vpc_id TEXT,
+    data TEXT NOT NULL,
+    refreshed REAL NOT NULL,
+    PRIMARY KEY (region, type, id)
+);
+CREATE INDEX IF NOT EXISTS resources_name ON resources (region, type, name, id);
+CREATE INDEX IF NOT EXISTS resources_vpc ON resources (region, type, vpc_id, id);
+CREATE TABLE IF NOT EXISTS tags (
+    region TEXT NOT NULL,
+    type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (region, type, id, key)
+);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value, region, type, id);
+CREATE TABLE IF NOT EXISTS refreshes (
+    region TEXT NOT NULL,
+    type TEXT NOT NULL,
+    refreshed REAL NOT NULL,
+    PRIMARY KEY (region, type)
+);
+'''
+
+
+def GetInventoryClient(service, region):
+    """
+    Getting a shared client with the credentials of aws_create_resources
+    """
+    return GetClient(
+        service,
+        region_name=region,
+        accessKey=resources.AWS_ACCESS_KEY_ID,
+        secretAccessKey=resources.AWS_SECRET_ACCESS_KEY,
+    )
+
+
+########################################################################
+## Rows
+########################################################################
+def _Tags(item):
+    """
+    {key: value} of an EC2 item (Tags or TagSet list) or Image Builder item
+    """
+    tags = item.get('Tags') or item.get('TagSet') or item.get('tags') or {}
+    if isinstance(tags, dict):
+        return dict(tags)
+    return {tag['Key']: tag.get('Value') for tag in tags}
+
+
+def _Row(region, resourceType, item, refreshed):
+    if resourceType in AWS_INVENTORY_INDEX_EC2_TYPES:
+        resourceId = item[AWS_INVENTORY_INDEX_EC2_TYPES[resourceType][1]]
+        tags = _Tags(item)
+        name = tags.get(resources.AWS_TAGS_KEY) or item.get('GroupName')
+    else:
+        resourceId = IndexedArn(resourceType, item['arn'])
+        tags = _Tags(item)
+        name = item.get('name') or resourceId.split('/')[1]
+    data = json.dumps(item, sort_keys=True, default=str)
+    return (region, resourceType, resourceId, name, item.get('VpcId'), data, refreshed), tags
+
+
+def _ImageBuilderType(arn):
+    # arn:aws:imagebuilder:<region>:<account>:<type>/<name>[/<version>...]
+    return arn.split(':', 5)[5].split('/', 1)[0]
+
+
+def IndexedArn(resourceType, arn):
+    """
+    The ARN a resource is indexed under: list_components reports component
+    version ARNs, the tagging API build version ARNs (.../<version>/<build>)
+    """
+    if resourceType == 'component' and arn.split(':', 5)[5].count('/') == 3:
+        return arn.rsplit('/', 1)[0]
+    return arn
+
+
+########################################################################
+## Index
+########################################################################
+class InventoryIndex:
+    """
+    SQLite index of EC2 and Image Builder resources. Thread-safe: describes
+    run in parallel, writes and lookups share one connection under a lock.
+    """
+
+    def __init__(self, path=AWS_INVENTORY_INDEX_PATH):
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(_SCHEMA)
+
+    def Close(self):
+        with self.lock:
+            self.connection.close()
+
+    ####################################################################
+    ## Writing
+    ####################################################################
+    def _Store(self, region, resourceType, items, scope=None):
+        """
+        Upsert items and drop the rows of the scope which were not seen:
+        the whole (region, type) after a full describe, or only the rows
+        carrying all the scope tags after a tag-filtered one
+        """
+        refreshed = time.time()
+        rows, tagRows, seen = [], [], set()
+        for item in items:
+            row, tags = _Row(region, resourceType, item, refreshed)
+            rows.append(row)
+            seen.add(row[2])
+            tagRows.extend((region, resourceType, row[2], key, value) for key, value in tags.items())
+
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN')
+            try:
+                if scope is None:
+                    known = cursor.execute(
+                        'SELECT id FROM resources WHERE region = ? AND type = ?', (region, resourceType)
+                    ).fetchall()
+                else:
+                    # Rows carrying every tag of the scope
+                    match = ' OR '.join(['(key = ? AND value = ?)'] * len(scope))
+                    known = cursor.execute(
+                        f'SELECT id FROM tags WHERE region = ? AND type = ? AND ({match}) '
+                        'GROUP BY id HAVING COUNT(*) = ?',
+                        (region, resourceType, *(item for pair in scope.items() for item in pair), len(scope)),
+                    ).fetchall()
+                gone = [(region, resourceType, resourceId) for (resourceId,) in known if resourceId not in seen]
+                for table in ('resources', 'tags'):
+                    cursor.executemany(f'DELETE FROM {table} WHERE region = ? AND type = ? AND id = ?', gone)
+                cursor.executemany(
+                    'DELETE FROM tags WHERE region = ? AND type = ? AND id = ?',
+                    [(region, resourceType, resourceId) for resourceId in seen],
+                )
+                cursor.executemany('INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                cursor.executemany('INSERT INTO tags VALUES (?, ?, ?, ?, ?)', tagRows)
+                if scope is None:
+                    cursor.execute(
+                        'INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?)', (region, resourceType, refreshed)
+                    )
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+        return len(rows), len(gone)
+
+    def _Describe(self, region, resourceType, tags=None):
+        if resourceType in AWS_INVENTORY_INDEX_EC2_TYPES:
+            iterate, _ = AWS_INVENTORY_INDEX_EC2_TYPES[resourceType]
+            filters = {f'tag:{key}': value for key, value in (tags or {}).items()}
+            return list(iterate(GetInventoryClient('ec2', region), filters))
+        operation, resultKey, params = AWS_INVENTORY_INDEX_IMAGE_BUILDER_TYPES[resourceType]
+        return list(IterateResources(GetInventoryClient('imagebuilder', region), operation, resultKey, **params))
+
+    def _TaggedImageBuilder(self, region, tags):
+        """
+        {type: [item]} of the Image Builder resources carrying tags, from one
+        paginated tagging API query (list_* calls cannot filter on tags)
+        """
+        found = {resourceType: {} for resourceType in AWS_INVENTORY_INDEX_IMAGE_BUILDER_TYPES}
+        for mapping in IterateResources(
+                GetInventoryClient('resourcegroupstaggingapi', region), 'get_resources', 'ResourceTagMappingList',
+                TagFilters=[{'Key': key, 'Values': [value]} for key, value in tags.items()],
+                ResourceTypeFilters=['imagebuilder'],
+        ):
+            resourceType = _ImageBuilderType(mapping['ResourceARN'])
+            if resourceType in found:
+                # The tagging API only has ARN and tags: keep the indexed details
+                arn = IndexedArn(resourceType, mapping['ResourceARN'])
+                item = dict(self.Get(region, resourceType, arn) or {'arn': arn})
+                item['tags'] = {tag['Key']: tag['Value'] for tag in mapping.get('Tags', [])}
+                found[resourceType][arn] = item
+        return {resourceType: list(items.values()) for resourceType, items in found.items()}
+
+    def Stale(self, region, resourceType, maxAge):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT refreshed FROM refreshes WHERE region = ? AND type = ?', (region, resourceType)
+            ).fetchone()
+        return row is None or time.time() - row[0] > maxAge
+
+    def Refresh(self, regions, types=AWS_INVENTORY_INDEX_TYPES, maxAge=None, tags=None,
+                maxWorkers=AWS_INVENTORY_INDEX_MAX_WORKERS):
+        """
+        Describe the resources of every (region, type) in parallel, one
+        paginated call each. With maxAge, types refreshed more recently
+        are skipped; with tags, only resources carrying all of them are
+        described (Image Builder ones through one tagging API query per
+        region) and only their rows are replaced.
+        """
+        scope = dict(tags) if tags else None
+        jobs = {}
+        for region in regions:
+            for resourceType in types:
+                if maxAge is not None and not tags and not self.Stale(region, resourceType, maxAge):
+                    continue
+                if tags and resourceType in AWS_INVENTORY_INDEX_IMAGE_BUILDER_TYPES:
+                    continue
+                jobs[(region, resourceType)] = lambda region=region, resourceType=resourceType: (
+                    self._Describe(region, resourceType, tags)
+                )
+            if tags and any(resourceType in AWS_INVENTORY_INDEX_IMAGE_BUILDER_TYPES for resourceType in types):
+                jobs[(region, 'imagebuilder')] = lambda region=region: self._TaggedImageBuilder(region, tags)
+        if not jobs:
+            logger.info('Inventory index: everything is fresh')
+            return {}
+
+        def Run(key):
+            found = jobs[key]()
+            region, resourceType = key
+            if resourceType == 'imagebuilder':
+                return {
+                    (region, kind): self._Store(region, kind, items, scope)
+                    for kind, items in found.items() if kind in types
+                }
+            return {key: self._Store(region, resourceType, found, scope)}
+
+        counts = {}
+        with ThreadPoolExecutor(max_workers=min(maxWorkers, len(jobs))) as executor:
+            for result in executor.map(Run, jobs):
+                counts.update(result)
+        for (region, resourceType), (stored, removed) in sorted(counts.items()):
+            logger.info(f"Inventory index: {region} {resourceType}: {stored} stored, {removed} removed")
+        return counts
+
+    ####################################################################
+    ## Lookups
+    ####################################################################
+    def _Rows(self, query, params):
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def Get(self, region, resourceType, resourceId):
+        """
+        The described resource, or None
+        """
+        rows = self._Rows(
+            'SELECT data FROM resources WHERE region = ? AND type = ? AND id = ?',
+            (region, resourceType, IndexedArn(resourceType, resourceId)),
+        )
+        return rows[0] if rows else None
+
+    def Exists(self, region, resourceType, resourceId):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT 1 FROM resources WHERE region = ? AND type = ? AND id = ?',
+                (region, resourceType, IndexedArn(resourceType, resourceId)),
+            ).fetchone() is not None
+
+    def IdsByName(self, region, resourceType, name):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id FROM resources WHERE region = ? AND type = ? AND name = ? ORDER BY id',
+                (region, resourceType, name),
+            ).fetchall()
+        return [resourceId for (resourceId,) in rows]
+
+    def FindByName(self, region, resourceType, name):
+        return self._Rows(
+            'SELECT data FROM resources WHERE region = ? AND type = ? AND name = ? ORDER BY id',
+            (region, resourceType, name),
+        )
+
+    def FindByTag(self, region, resourceType, key, value):
+        return self._Rows(
+            'SELECT r.data FROM tags t JOIN resources r USING (region, type, id) '
+            'WHERE t.key = ? AND t.value = ? AND t.region = ? AND t.type = ? ORDER BY r.id',
+            (key, value, region, resourceType),
+        )
+
+    def FindInVPC(self, region, resourceType, vpcId):
+        return self._Rows(
+            'SELECT data FROM resources WHERE region = ? AND type = ? AND vpc_id = ? ORDER BY id',
+            (region, resourceType, vpcId),
+        )
+
+    def Counts(self):
+        with self.lock:
+            return {
+                (region, resourceType): count
+                for region, resourceType, count in self.connection.execute(
+                    'SELECT region, type, COUNT(*) FROM resources GROUP BY region, type ORDER BY region, type'
+                )
+            }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Indexing the account inventory locally")
+    parser.add_argument("-Database", default=AWS_INVENTORY_INDEX_PATH)
+    parser.add_argument("-Regions", help="Comma-separated regions, by default the aws_create_resources region")
+    parser.add_argument("-Types", default=",".join(AWS_INVENTORY_INDEX_TYPES))
+    parser.add_argument("-Refresh", choices=["full", "stale", "tags", "none"], default="stale")
+    parser.add_argument("-Max_age", type=float, default=900, help="Seconds after which -Refresh stale rescans a type")
+    parser.add_argument("-Tag_key", help="-Refresh tags: only rescan resources tagged -Tag_key=-Tag_value")
+    parser.add_argument("-Tag_value")
+    parser.add_argument("-Find", help="type:id, type:name=<name> or type:tag:<key>=<value>")
+    args = parser.parse_args()
+
+    regions = args.Regions.split(",") if args.Regions else [resources.AWS_DEFAULT_REGION]
+    index = InventoryIndex(args.Database)
+    if args.Refresh == "full":
+        index.Refresh(regions, args.Types.split(","))
+    elif args.Refresh == "stale":
+        index.Refresh(regions, args.Types.split(","), maxAge=args.Max_age)
+    elif args.Refresh == "tags":
+        if not args.Tag_key:
+            parser.error("-Refresh tags needs -Tag_key/-Tag_value")
+        index.Refresh(regions, args.Types.split(","), tags={args.Tag_key: args.Tag_value})
+
+    if args.Find:
+        resourceType, _, query = args.Find.partition(":")
+        for region in regions:
+            if query.startswith("name="):
+                found = index.FindByName(region, resourceType, query[len("name="):])
+            elif query.startswith("tag:"):
+                key, _, value = query[len("tag:"):].partition("=")
+                found = index.FindByTag(region, resourceType, key, value)
+            else:
+                found = [item for item in [index.Get(region, resourceType, query)] if item]
+            print(json.dumps(found, indent=2, sort_keys=True))
+    else:
+        for (region, resourceType), count in index.Counts().items():
+            logger.info(f"{region} {resourceType}: {count}")
@@ -0,0 +1,275 @@
+###########################################################################
+################### NETWORK INTERFACE AND IP ALLOCATION ###################
+###########################################################################
+import functools
+import ipaddress
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+import aws_create_resources as resources
+from aws_call_executor import ErrorCode, ExecuteCall
+from aws_inventory import IterateNetworkInterfaces, IterateSubnets
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## AWS IP Allocation Configuration
+########################################################################
+# AWS reserves the first four and the last address of every subnet
+AWS_SUBNET_RESERVED_HEAD = 4
+AWS_SUBNET_RESERVED_TAIL = 1
+AWS_ENI_CREATE_WORKERS = 16
+AWS_ENI_IN_USE_RETRIES = 5
+AWS_ENI_IN_USE_ERRORS = ('InvalidIPAddress.InUse',)
+
+
+########################################################################
+## Per-subnet address bitmap
+########################################################################
+class SubnetAddressMap:
+    """
+    Used/free bitmap of the IPv4 addresses of one subnet, one byte per
+    address. Allocation scans forward from a cursor with bytearray.find, so
+    handing out every address of a subnet costs one pass over the bitmap.
+    """
+
+    def __init__(self, subnetId, cidrBlock):
+        network = ipaddress.IPv4Network(cidrBlock)
+        self.subnetId = subnetId
+        self.cidrBlock = cidrBlock
+        self.base = int(network.network_address)
+        self.used = bytearray(network.num_addresses)
+        self.free = network.num_addresses
+        for offset in range(min(AWS_SUBNET_RESERVED_HEAD, network.num_addresses)):
+            self._Take(offset)
+        self._Take(network.num_addresses - AWS_SUBNET_RESERVED_TAIL)
+        self.cursor = 0
+
+    def _Offset(self, address):
+        offset = int(ipaddress.IPv4Address(address)) - self.base
+        if not 0 <= offset < len(self.used):
+            raise ValueError(f"{address} is not in subnet {self.subnetId} ({self.cidrBlock})")
+        return offset
+
+    def _Take(self, offset):
+        if not self.used[offset]:
+            self.used[offset] = 1
+            self.free -= 1
+
+    def _Address(self, offset):
+        return str(ipaddress.IPv4Address(self.base + offset))
+
+    def MarkUsed(self, address):
+        self._Take(self._Offset(address))
+
+    def IsFree(self, address):
+        return not self.used[self._Offset(address)]
+
+    def Allocate(self, preferred=None):
+        """
+        Reserve preferred when it is free, else the lowest free address
+        after the cursor; None when the subnet is full
+        """
+        if preferred and self.IsFree(preferred):
+            self.MarkUsed(preferred)
+            return preferred
+        offset = self.used.find(0, self.cursor)
+        if offset < 0 and self.cursor:
+            offset = self.used.find(0)
+        if offset < 0:
+            return None
+        self._Take(offset)
+        self.cursor = offset + 1
+        return self._Address(offset)
+
+    def Release(self, address):
+        offset = self._Offset(address)
+        if self.used[offset]:
+            self.used[offset] = 0
+            self.free += 1
+            self.cursor = min(self.cursor, offset)
+
+
+class IPAllocator:
+    """
+    Address maps of a set of subnets, filled from the account with one
+    describe_subnets and one paginated describe_network_interfaces call.
+    Thread-safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subnets = {}
+
+    def Load(self, client, subnetIds):
+        """
+        Read the CIDR blocks of subnetIds and mark every primary and
+        secondary private address of their network interfaces as used
+        """
+        subnetIds = list(subnetIds)
+        maps = {
+            subnet['SubnetId']: SubnetAddressMap(subnet['SubnetId'], subnet['CidrBlock'])
+            for subnet in IterateSubnets(client, {'subnet-id': subnetIds})
+        }
+        missing = set(subnetIds) - set(maps)
+        if missing:
+            raise LookupError(f"Subnets not found: {', '.join(sorted(missing))}")
+        inUse = 0
+        for nic in IterateNetworkInterfaces(client, {'subnet-id': subnetIds}):
+            for address in nic.get('PrivateIpAddresses') or [{'PrivateIpAddress': nic['PrivateIpAddress']}]:
+                maps[nic['SubnetId']].MarkUsed(address['PrivateIpAddress'])
+                inUse += 1
+        with self.lock:
+            self.subnets.update(maps)
+        logger.info(f"IP allocator: {len(maps)} subnet(s), {inUse} address(es) in use")
+        return self
+
+    def Free(self, subnetId=None):
+        with self.lock:
+            if subnetId:
+                return self.subnets[subnetId].free
+            return sum(addressMap.free for addressMap in self.subnets.values())
+
+    def Allocate(self, subnetId=None, preferred=None, subnetIds=None):
+        """
+        Reserve an address, in subnetId or else in the subnet of subnetIds
+        (by default all loaded subnets) with the most free addresses.
+        Returns (subnet ID, address).
+        """
+        with self.lock:
+            if subnetId is None:
+                candidates = [key for key in (subnetIds or self.subnets) if self.subnets[key].free]
+                subnetId = max(candidates, key=lambda key: self.subnets[key].free, default=None)
+            address = self.subnets[subnetId].Allocate(preferred) if subnetId else None
+        if address is None:
+            raise LookupError(f"No free address left in {subnetId or ', '.join(subnetIds or self.subnets)}")
+        return subnetId, address
+
+    def AllocateMany(self, count, subnetIds=None):
+        """
+        Reserve count addresses spread evenly over subnetIds (by default all
+        loaded subnets)
+        """
+        subnetIds = list(subnetIds or self.subnets)
+        with self.lock:
+            available = sum(self.subnets[subnetId].free for subnetId in subnetIds)
+        if available < count:
+            raise LookupError(f"{count} addresses requested, {available} free in {', '.join(subnetIds)}")
+        allocations = []
+        with self.lock:
+            # Round-robin over the subnets; a round without any address means
+            # concurrent allocations took what was counted as free above
+            while len(allocations) < count:
+                taken = len(allocations)
+                for subnetId in subnetIds:
+                    address = self.subnets[subnetId].Allocate()
+                    if address is not None:
+                        allocations.append((subnetId, address))
+                        if len(allocations) == count:
+                            break
+                if len(allocations) == taken:
+                    for subnetId, address in allocations:
+                        self.subnets[subnetId].Release(address)
+                    raise LookupError(f"{count} addresses requested, only {taken} free in {', '.join(subnetIds)}")
+        return allocations
+
+    def MarkUsed(self, subnetId, address):
+        with self.lock:
+            self.subnets[subnetId].MarkUsed(address)
+
+    def Release(self, subnetId, address):
+        with self.lock:
+            self.subnets[subnetId].Release(address)
+
+
+########################################################################
+## Network interfaces
+########################################################################
+def _CreatePlannedNetworkInterface(client, allocator, paramsBuilder, subnetId, address, subnetIds=None):
+    """
+    Create an ENI on a planned address, with the create_network_interface
+    parameters of paramsBuilder(subnetId, address); an address taken by
+    someone else since the allocator was loaded stays marked used and the
+    next one is tried, in another of subnetIds when this subnet is full
+    """
+    for attempt in range(AWS_ENI_IN_USE_RETRIES + 1):
+        try:
+            res = ExecuteCall(client, 'create_network_interface', **paramsBuilder(subnetId, address))
+        except ClientError as error:
+            if ErrorCode(error) not in AWS_ENI_IN_USE_ERRORS:
+                allocator.Release(subnetId, address)
+                raise
+            # AWS holds the address: it is never handed out again
+            allocator.MarkUsed(subnetId, address)
+            if attempt == AWS_ENI_IN_USE_RETRIES:
+                raise
+            logger.warning(f"{address} in {subnetId} is already in use, taking the next free address")
+            try:
+                subnetId, address = allocator.Allocate(subnetId)
+            except LookupError:
+                subnetId, address = allocator.Allocate(subnetIds=subnetIds)
+        else:
+            return res['NetworkInterface']
+
+
+def CreateNetworkInterface(client, subnetId, paramsBuilder, preferred=None):
+    """
+    Create one network interface in subnetId on a planned address: preferred
+    when it lies in the subnet and is free, else the lowest free one. The
+    create_network_interface parameters come from paramsBuilder(subnetId,
+    address). Returns the created interface.
+    """
+    allocator = IPAllocator().Load(client, [subnetId])
+    cidrBlock = allocator.subnets[subnetId].cidrBlock
+    if preferred and ipaddress.IPv4Address(preferred) not in ipaddress.IPv4Network(cidrBlock):
+        logger.info(f"{preferred} is not in {subnetId} ({cidrBlock}), taking the first free address")
+        preferred = None
+    subnetId, address = allocator.Allocate(subnetId, preferred)
+    return _CreatePlannedNetworkInterface(client, allocator, paramsBuilder, subnetId, address, [subnetId])
+
+
+def CreateNetworkInterfaces(
+        count,
+        securityGroupId=None,
+        subnetIds=None,
+        allocator=None,
+        maxWorkers=AWS_ENI_CREATE_WORKERS,
+):
+    """
+    Create count network interfaces with planned private addresses, spread
+    over subnetIds (by default the stack subnet), in parallel. Returns the
+    created interfaces in order, None where a creation failed.
+    """
+    client = resources.GetEC2Client()
+    securityGroupId = securityGroupId or resources.GetSecurityGroupIds()
+    subnetIds = list(subnetIds or [resources.GetSubnetIds()])
+    if allocator is None:
+        allocator = IPAllocator().Load(client, subnetIds)
+    allocations = allocator.AllocateMany(count, subnetIds)
+    paramsBuilder = functools.partial(resources.NetworkInterfaceParams, securityGroupId)
+
+    def Create(allocation):
+        subnetId, address = allocation
+        try:
+            return _CreatePlannedNetworkInterface(
+                client, allocator, paramsBuilder, subnetId, address, subnetIds
+            )
+        except (ClientError, LookupError):
+            logging.exception(f"******************************** ERROR: Unable to create a network interface in {subnetId}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(maxWorkers, count))) as executor:
+        interfaces = list(executor.map(Create, allocations))
+    created = [nic['NetworkInterfaceId'] for nic in interfaces if nic]
+    if created:
+        resources.AWS_RESOURCE_ID_CACHE.Put(
+            resources.StackRegion(), 'network-interface', created[0], resources.CacheFilters('network-interface')
+        )
+    logger.info(f"Created {len(created)} of {count} network interfaces")
+    return interfaces
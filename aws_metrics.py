@@ -0,0 +1,253 @@
+###########################################################################
+############### PER-CALL LATENCY AND API-COUNT INSTRUMENTATION ############
+###########################################################################
+import bisect
+import json
+import logging
+import threading
+import time
+from urllib.parse import urlencode
+
+import aws_call_executor
+import aws_client_factory
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Metrics Configuration
+########################################################################
+AWS_METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_CONTEXT_START_KEY = "metricsStartTime"
+_CONTEXT_REQUEST_BYTES_KEY = "metricsRequestBytes"
+
+
+########################################################################
+## Metrics registry
+########################################################################
+class OperationMetrics:
+    """
+    Counters and latency histogram of one (service, operation)
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.requestBytes = 0
+        self.responseBytes = 0
+        self.latencySum = 0.0
+        self.latencyMax = 0.0
+        self.bucketCounts = [0] * (len(AWS_METRICS_LATENCY_BUCKETS) + 1)
+
+    def Observe(self, latency):
+        self.latencySum += latency
+        self.latencyMax = max(self.latencyMax, latency)
+        self.bucketCounts[bisect.bisect_left(AWS_METRICS_LATENCY_BUCKETS, latency)] += 1
+
+    def AsDict(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(list(AWS_METRICS_LATENCY_BUCKETS) + ["+Inf"], self.bucketCounts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "throttles": self.throttles,
+            "request_bytes": self.requestBytes,
+            "response_bytes": self.responseBytes,
+            "latency_seconds": {
+                "sum": round(self.latencySum, 6),
+                "max": round(self.latencyMax, 6),
+                "avg": round(self.latencySum / self.calls, 6) if self.calls else 0.0,
+                "buckets": buckets,
+            },
+        }
+
+
+class MetricsRegistry:
+    """
+    Thread-safe store of OperationMetrics keyed by (service, operation)
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def _Get(self, service, operation):
+        key = (service, operation)
+        metrics = self.operations.get(key)
+        if metrics is None:
+            metrics = self.operations[key] = OperationMetrics()
+        return metrics
+
+    def RecordAttempt(self, service, operation, latency, failed, requestBytes, responseBytes):
+        with self.lock:
+            metrics = self._Get(service, operation)
+            metrics.calls += 1
+            metrics.errors += 1 if failed else 0
+            metrics.requestBytes += requestBytes
+            metrics.responseBytes += responseBytes
+            metrics.Observe(latency)
+
+    def RecordRetries(self, service, operation, retries, throttles):
+        with self.lock:
+            metrics = self._Get(service, operation)
+            metrics.retries += retries
+            metrics.throttles += throttles
+
+    def Reset(self):
+        with self.lock:
+            self.operations.clear()
+
+    def ExportJSON(self):
+        """
+        Metrics as a JSON document
+        """
+        with self.lock:
+            data = {
+                f"{service}.{operation}": metrics.AsDict()
+                for (service, operation), metrics in sorted(self.operations.items())
+            }
+        return json.dumps(data, indent=2)
+
+    def ExportPrometheus(self):
+        """
+        Metrics in the Prometheus text exposition format
+        """
+        lines = []
+        counters = (
+            ("aws_api_calls_total", "API call attempts", "calls"),
+            ("aws_api_errors_total", "API call attempts which failed", "errors"),
+            ("aws_api_retries_total", "API call retries", "retries"),
+            ("aws_api_throttles_total", "API calls throttled by AWS", "throttles"),
+            ("aws_api_request_bytes_total", "Request payload bytes", "requestBytes"),
+            ("aws_api_response_bytes_total", "Response payload bytes", "responseBytes"),
+        )
+        with self.lock:
+            items = sorted(self.operations.items())
+            for name, description, attribute in counters:
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} counter")
+                for (service, operation), metrics in items:
+                    labels = f'service="{service}",operation="{operation}"'
+                    lines.append(f"{name}{{{labels}}} {getattr(metrics, attribute)}")
+
+            name = "aws_api_call_duration_seconds"
+            lines.append(f"# HELP {name} API call attempt latency")
+            lines.append(f"# TYPE {name} histogram")
+            for (service, operation), metrics in items:
+                labels = f'service="{service}",operation="{operation}"'
+                cumulative = 0
+                for bound, count in zip(list(AWS_METRICS_LATENCY_BUCKETS) + ["+Inf"], metrics.bucketCounts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {metrics.latencySum:.6f}")
+                lines.append(f"{name}_count{{{labels}}} {metrics.calls}")
+        return "\n".join(lines) + "\n"
+
+
+AWS_METRICS = MetricsRegistry()
+_ENABLED = False
+_ENABLE_LOCK = threading.Lock()
+
+
+########################################################################
+## botocore event hooks
+########################################################################
+def _BodySize(body):
+    if body is None:
+        return 0
+    if isinstance(body, dict):
+        return len(urlencode(body, doseq=True))
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    return 0
+
+
+def _OnParameterBuild(context, **kwargs):
+    context[_CONTEXT_START_KEY] = time.perf_counter()
+
+
+def _OnRequestCreated(request, **kwargs):
+    request.context[_CONTEXT_REQUEST_BYTES_KEY] = _BodySize(request.body)
+
+
+def _OnAfterCall(http_response, parsed, model, context, **kwargs):
+    started = context.pop(_CONTEXT_START_KEY, None)
+    if started is None:
+        return
+    AWS_METRICS.RecordAttempt(
+        model.service_model.service_name,
+        model.name,
+        time.perf_counter() - started,
+        http_response.status_code >= 300,
+        context.pop(_CONTEXT_REQUEST_BYTES_KEY, 0),
+        len(getattr(http_response, "content", b"") or b""),
+    )
+
+
+def _OnAfterCallError(exception, context, **kwargs):
+    started = context.pop(_CONTEXT_START_KEY, None)
+    if started is None:
+        return
+    service, operation = context.get("metricsOperation", ("unknown", "unknown"))
+    AWS_METRICS.RecordAttempt(
+        service, operation, time.perf_counter() - started, True, context.pop(_CONTEXT_REQUEST_BYTES_KEY, 0), 0
+    )
+
+
+def _OnBeforeCall(model, context, **kwargs):
+    context["metricsOperation"] = (model.service_model.service_name, model.name)
+
+
+def _OnExecutedCall(service, region, operation, attempts, throttles, error):
+    # Retries and throttles are counted where they are made, once per call
+    AWS_METRICS.RecordRetries(service, operation, attempts - 1, throttles)
+
+
+def InstrumentClient(client):
+    """
+    Register the metrics hooks on a botocore client
+    """
+    events = client.meta.events
+    events.register("before-parameter-build.*.*", _OnParameterBuild, unique_id="aws-metrics-start")
+    events.register("before-call.*.*", _OnBeforeCall, unique_id="aws-metrics-operation")
+    events.register("request-created.*.*", _OnRequestCreated, unique_id="aws-metrics-request")
+    events.register("after-call.*.*", _OnAfterCall, unique_id="aws-metrics-end")
+    events.register("after-call-error.*.*", _OnAfterCallError, unique_id="aws-metrics-error")
+
+
+def EnableMetrics():
+    """
+    Instrument every client of the client factory, and count the retries
+    and throttles of the call executor
+    """
+    global _ENABLED
+    with _ENABLE_LOCK:
+        if _ENABLED:
+            return AWS_METRICS
+        _ENABLED = True
+    aws_client_factory.AddClientListener(InstrumentClient)
+    aws_call_executor.AddCallListener(_OnExecutedCall)
+    return AWS_METRICS
+
+
+def WriteMetrics(path):
+    """
+    Write the metrics to a file: Prometheus text for .prom/.txt, JSON otherwise
+    """
+    if path.endswith((".prom", ".txt")):
+        content = AWS_METRICS.ExportPrometheus()
+    else:
+        content = AWS_METRICS.ExportJSON()
+    with open(path, "w") as metricsFile:
+        metricsFile.write(content)
+    logger.info(f"Metrics written to {path}")
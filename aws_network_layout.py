@@ -0,0 +1,280 @@
+###########################################################################
+##################### VPC SUBNET AND ROUTE TABLE LAYOUTS ##################
+###########################################################################
+from collections import namedtuple
+import argparse
+import functools
+import heapq
+import ipaddress
+import logging
+import math
+
+import aws_create_resources as resources
+from aws_call_executor import ExecuteCall
+from aws_inventory import IterateVPCs
+from aws_resource_graph import NodeResult, ResourceGraph
+from aws_run_id import GetRunId, RunIdTags, SetRunId
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Network Layout Configuration
+########################################################################
+# (tier name, subnet prefix length or None for an even split, public)
+AWS_LAYOUT_DEFAULT_TIERS = (('public', None, True), ('private', None, False))
+AWS_LAYOUT_MIN_SUBNET_PREFIX = 16
+AWS_LAYOUT_MAX_SUBNET_PREFIX = 28
+AWS_LAYOUT_INTERNET_CIDR = '0.0.0.0/0'
+AWS_LAYOUT_MAX_WORKERS = 16
+
+LayoutSubnet = namedtuple('LayoutSubnet', 'name tier availabilityZone cidrBlock routeTable')
+LayoutRouteTable = namedtuple('LayoutRouteTable', 'name tier public')
+NetworkLayout = namedtuple('NetworkLayout', 'vpcCidr subnets routeTables')
+
+
+########################################################################
+## CIDR carving
+########################################################################
+class PrefixAllocator:
+    """
+    Buddy allocator over the prefix tree of a CIDR block. Free blocks are
+    kept per prefix length; a request takes the lowest free block of its
+    length, splitting the smallest larger free block when there is none.
+    """
+
+    def __init__(self, cidrBlock):
+        self.network = ipaddress.IPv4Network(cidrBlock)
+        self.free = {self.network.prefixlen: [int(self.network.network_address)]}
+
+    def Allocate(self, prefixLength):
+        if not self.network.prefixlen <= prefixLength <= 32:
+            raise ValueError(f"/{prefixLength} does not fit in {self.network}")
+        length = prefixLength
+        while not self.free.get(length):
+            length -= 1
+            if length < self.network.prefixlen:
+                raise ValueError(f"No free /{prefixLength} left in {self.network}")
+        block = heapq.heappop(self.free[length])
+        while length < prefixLength:
+            length += 1
+            heapq.heappush(self.free.setdefault(length, []), block + (1 << (32 - length)))
+        return ipaddress.IPv4Network((block, prefixLength))
+
+
+def _EvenPrefixLength(vpcNetwork, subnetCount):
+    return vpcNetwork.prefixlen + math.ceil(math.log2(subnetCount)) if subnetCount > 1 else vpcNetwork.prefixlen
+
+
+@functools.lru_cache(maxsize=None)
+def PlanNetworkLayout(vpcCidr, availabilityZones, tiers=AWS_LAYOUT_DEFAULT_TIERS):
+    """
+    Carve one subnet per (tier, availability zone) out of vpcCidr and plan
+    the route tables: one per public tier, one per private tier and zone.
+    availabilityZones and tiers are tuples, so the plan is cached and the
+    same arguments always give the same layout.
+    """
+    vpcNetwork = ipaddress.IPv4Network(vpcCidr)
+    if not availabilityZones or not tiers:
+        raise ValueError("A layout needs at least one availability zone and one tier")
+    evenPrefix = _EvenPrefixLength(vpcNetwork, len(availabilityZones) * len(tiers))
+    cells = []
+    for tierIndex, (tier, prefixLength, public) in enumerate(tiers):
+        prefixLength = max(prefixLength or evenPrefix, AWS_LAYOUT_MIN_SUBNET_PREFIX)
+        if prefixLength > AWS_LAYOUT_MAX_SUBNET_PREFIX:
+            raise ValueError(f"Tier {tier}: /{prefixLength} is smaller than the /28 AWS allows")
+        for zoneIndex, zone in enumerate(availabilityZones):
+            cells.append((prefixLength, tierIndex, zoneIndex, tier, zone, public))
+
+    # Largest blocks first keeps the tree unfragmented; ties in tier and zone order
+    allocator = PrefixAllocator(vpcNetwork)
+    subnets = []
+    for prefixLength, tierIndex, zoneIndex, tier, zone, public in sorted(cells):
+        cidrBlock = allocator.Allocate(prefixLength)
+        routeTable = tier if public else f'{tier}-{zone}'
+        subnets.append((tierIndex, zoneIndex, LayoutSubnet(f'{tier}-{zone}', tier, zone, str(cidrBlock), routeTable)))
+
+    routeTables = []
+    for tier, prefixLength, public in tiers:
+        if public:
+            routeTables.append(LayoutRouteTable(tier, tier, True))
+        else:
+            routeTables.extend(LayoutRouteTable(f'{tier}-{zone}', tier, False) for zone in availabilityZones)
+    return NetworkLayout(
+        str(vpcNetwork),
+        tuple(subnet for _, _, subnet in sorted(subnets, key=lambda item: item[:2])),
+        tuple(routeTables),
+    )
+
+
+def ParseTiers(value, publicTiers=('public',)):
+    """
+    Tiers from 'public=24,private=20,data' (no length: an even split)
+    """
+    tiers = []
+    for item in value.split(','):
+        name, _, prefixLength = item.strip().partition('=')
+        tiers.append((name, int(prefixLength) if prefixLength else None, name in publicTiers))
+    return tuple(tiers)
+
+
+########################################################################
+## Creating layouts
+########################################################################
+def AvailabilityZoneNames(count, client=None):
+    """
+    The first count available zones of the region, in name order
+    """
+    zones = ExecuteCall(
+        client or resources.GetEC2Client(), 'describe_availability_zones',
+        Filters=[{'Name': 'state', 'Values': ['available']}],
+    )['AvailabilityZones']
+    names = sorted(zone['ZoneName'] for zone in zones)
+    if len(names) < count:
+        raise ValueError(f"{count} availability zones requested, {len(names)} available")
+    return tuple(names[:count])
+
+
+def _NameTags(name):
+    return [{'Key': resources.AWS_TAGS_KEY, 'Value': name}] + RunIdTags()
+
+
+def CreateLayoutSubnet(vpcId, subnet, namePrefix):
+    res = ExecuteCall(
+        resources.GetEC2Client(), 'create_subnet',
+        VpcId=vpcId,
+        CidrBlock=subnet.cidrBlock,
+        AvailabilityZone=subnet.availabilityZone,
+        TagSpecifications=[{'ResourceType': 'subnet', 'Tags': _NameTags(f'{namePrefix}-{subnet.name}')}],
+    )
+    return res['Subnet']['SubnetId']
+
+
+def CreateLayoutRouteTable(vpcId, routeTable, namePrefix):
+    res = ExecuteCall(
+        resources.GetEC2Client(), 'create_route_table',
+        VpcId=vpcId,
+        TagSpecifications=[{'ResourceType': 'route-table', 'Tags': _NameTags(f'{namePrefix}-{routeTable.name}')}],
+    )
+    return res['RouteTable']['RouteTableId']
+
+
+def CreateInternetRoute(routeTableId, internetGatewayId):
+    return ExecuteCall(
+        resources.GetEC2Client(), 'create_route',
+        RouteTableId=routeTableId,
+        DestinationCidrBlock=AWS_LAYOUT_INTERNET_CIDR,
+        GatewayId=internetGatewayId,
+    )
+
+
+def AssociateRouteTable(routeTableId, subnetId):
+    return ExecuteCall(
+        resources.GetEC2Client(), 'associate_route_table', RouteTableId=routeTableId, SubnetId=subnetId,
+    )['AssociationId']
+
+
+def AddNetworkLayoutNodes(graph, vpcId, layout, internetGatewayId=None, namePrefix=None):
+    """
+    Declare the subnets, route tables, internet routes and associations of a
+    layout; only the associations wait for anything
+    """
+    namePrefix = namePrefix or vpcId
+    for routeTable in layout.routeTables:
+        node = f'{vpcId}:RouteTable:{routeTable.name}'
+        graph.AddNode(node, CreateLayoutRouteTable, args=(vpcId, routeTable, namePrefix))
+        if routeTable.public and internetGatewayId:
+            graph.AddNode(
+                f'{vpcId}:Route:{routeTable.name}', CreateInternetRoute,
+                args=(NodeResult(node), internetGatewayId),
+            )
+    for subnet in layout.subnets:
+        node = f'{vpcId}:Subnet:{subnet.name}'
+        graph.AddNode(node, CreateLayoutSubnet, args=(vpcId, subnet, namePrefix))
+        graph.AddNode(
+            f'{vpcId}:Association:{subnet.name}', AssociateRouteTable,
+            args=(NodeResult(f'{vpcId}:RouteTable:{subnet.routeTable}'), NodeResult(node)),
+        )
+    return graph
+
+
+def VPCCidrBlocks(vpcIds, client=None):
+    """
+    {VPC ID: primary CIDR block} with one describe_vpcs call
+    """
+    return {
+        vpc['VpcId']: vpc['CidrBlock']
+        for vpc in IterateVPCs(client or resources.GetEC2Client(), {'vpc-id': list(vpcIds)})
+    }
+
+
+def CreateNetworkLayouts(
+        vpcs,
+        availabilityZones,
+        tiers=AWS_LAYOUT_DEFAULT_TIERS,
+        internetGatewayIds=None,
+        maxWorkers=AWS_LAYOUT_MAX_WORKERS,
+):
+    """
+    Plan and create the layouts of many VPCs at once. vpcs maps VPC IDs to
+    their CIDR block (None to describe it); availabilityZones is a tuple of
+    zone names or a number of zones; internetGatewayIds maps VPC IDs to the
+    gateway the public route tables route to. Returns the GraphRun.
+    """
+    unknown = [vpcId for vpcId, cidrBlock in vpcs.items() if not cidrBlock]
+    if unknown:
+        vpcs = dict(vpcs, **VPCCidrBlocks(unknown))
+    if isinstance(availabilityZones, int):
+        availabilityZones = AvailabilityZoneNames(availabilityZones)
+    internetGatewayIds = internetGatewayIds or {}
+
+    graph = ResourceGraph()
+    for vpcId, cidrBlock in vpcs.items():
+        layout = PlanNetworkLayout(cidrBlock, tuple(availabilityZones), tuple(tiers))
+        AddNetworkLayoutNodes(graph, vpcId, layout, internetGatewayIds.get(vpcId))
+    logger.info(f"Network layouts: {len(vpcs)} VPC(s), {len(graph.nodes)} resources to create")
+    run = graph.Run(maxWorkers=maxWorkers, raiseOnError=False)
+    run.LogTimings()
+    return run
+
+
+def LogNetworkLayout(vpcId, layout):
+    logger.info(f"{vpcId} ({layout.vpcCidr}):")
+    for subnet in layout.subnets:
+        logger.info(f"  {subnet.name:30} {subnet.cidrBlock:18} route table {subnet.routeTable}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Carving subnets and route tables for many VPCs")
+    parser.add_argument("-Vpcs", required=True, help="Comma separated VPC IDs, optionally vpc-id=cidr")
+    parser.add_argument("-Availability_zones", required=True, help="A number of zones or comma separated names")
+    parser.add_argument("-Tiers", default="public,private", help="Tiers with optional prefix lengths: public=24,private=20")
+    parser.add_argument("-Public_tiers", default="public", help="Comma separated tiers routed to the internet gateway")
+    parser.add_argument("-Internet_gateway_ids", help="Comma separated vpc-id=igw-id")
+    parser.add_argument("-Max_workers", type=int, default=AWS_LAYOUT_MAX_WORKERS)
+    parser.add_argument("-Plan_only", choices=["true", "false"], default="false")
+    parser.add_argument("-Run_id", help="ID tagged on the created resources, used by aws_teardown.py")
+    args = parser.parse_args()
+
+    if args.Run_id:
+        SetRunId(args.Run_id)
+    logger.info(f"Run ID: {GetRunId()}")
+
+    vpcs = dict(item.partition('=')[::2] for item in args.Vpcs.split(','))
+    zones = args.Availability_zones
+    zones = int(zones) if zones.isdigit() else tuple(zones.split(','))
+    tiers = ParseTiers(args.Tiers, args.Public_tiers.split(','))
+    gateways = dict(item.split('=') for item in args.Internet_gateway_ids.split(',')) if args.Internet_gateway_ids else None
+
+    if args.Plan_only == "true":
+        unknown = [vpcId for vpcId, cidrBlock in vpcs.items() if not cidrBlock]
+        vpcs.update(VPCCidrBlocks(unknown) if unknown else {})
+        zones = AvailabilityZoneNames(zones) if isinstance(zones, int) else zones
+        for vpcId, cidrBlock in vpcs.items():
+            LogNetworkLayout(vpcId, PlanNetworkLayout(cidrBlock, zones, tiers))
+    else:
+        run = CreateNetworkLayouts(vpcs, zones, tiers, gateways, args.Max_workers)
+        if run.errors:
+            raise SystemExit(1)
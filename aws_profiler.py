@@ -0,0 +1,385 @@
+###########################################################################
+################ RUN PROFILER: PHASE BREAKDOWN AND FLAMEGRAPH #############
+###########################################################################
+# Where does the wall time of a run go? Two sources, both opt-in:
+#
+#   - botocore event hooks split every API call attempt into request
+#     serialization, connection setup (TCP + TLS), server time (request
+#     sent until response received) and response parsing;
+#   - a sampling thread records the Python stack of every thread at a fixed
+#     interval, classifies each sample (imports, client setup, rate-limit
+#     waits, retry backoff, YAML, API calls, waiting on workers, other)
+#     and writes the stacks
+#     in the folded format read by flamegraph.pl and speedscope:
+#
+#       $ flamegraph.pl profile.folded > profile.svg
+#
+# Phase times are summed over threads, so with parallel calls they add up
+# to more than the wall time.
+###########################################################################
+import collections
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+import aws_client_factory
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Profiler Configuration
+########################################################################
+AWS_PROFILE_SAMPLE_INTERVAL = 0.005
+AWS_PROFILE_TOP_ALLOCATIONS = 15
+# (category, function or None, file, leaf frame only); the first category
+# with a matching frame wins. A leaf ExecuteCallWithRetries frame is its
+# time.sleep() between attempts.
+AWS_PROFILE_CATEGORIES = (
+    ("import", None, "importlib._bootstrap", False),
+    ("client setup", "GetClient", "aws_client_factory.py", False),
+    ("client setup", "GetResource", "aws_client_factory.py", False),
+    ("client setup", "GetSession", "aws_client_factory.py", False),
+    ("rate-limit wait", "Acquire", "aws_call_executor.py", False),
+    ("retry backoff", "ExecuteCallWithRetries", "aws_call_executor.py", True),
+    ("yaml", None, "yaml/", False),
+    ("api call", "_make_api_call", "botocore/client.py", False),
+    ("waiting on workers", "wait", "futures/_base.py", False),
+)
+AWS_PROFILE_CALL_PHASES = ("serialization", "connection setup", "server", "parsing")
+
+_THREAD_CALLS = threading.local()
+
+
+########################################################################
+## API call phases (botocore event hooks)
+########################################################################
+class CallPhases:
+    """
+    Per-operation seconds spent in each phase of the API call attempts
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = collections.defaultdict(lambda: dict.fromkeys(AWS_PROFILE_CALL_PHASES, 0.0))
+        self.calls = collections.Counter()
+        self.connections = 0
+
+    def Record(self, operation, phases, connections):
+        with self.lock:
+            totals = self.operations[operation]
+            for phase, seconds in phases.items():
+                totals[phase] += seconds
+            self.calls[operation] += 1
+            self.connections += connections
+
+    def Totals(self):
+        with self.lock:
+            totals = dict.fromkeys(AWS_PROFILE_CALL_PHASES, 0.0)
+            for phases in self.operations.values():
+                for phase, seconds in phases.items():
+                    totals[phase] += seconds
+            return totals
+
+
+def _Mark(name):
+    call = getattr(_THREAD_CALLS, "call", None)
+    if call is not None:
+        call[name] = time.perf_counter()
+
+
+def _OnParameterBuild(**kwargs):
+    _THREAD_CALLS.call = {"start": time.perf_counter(), "connect": 0.0, "connections": 0}
+
+
+def _OnBeforeCall(**kwargs):
+    _Mark("serialized")
+
+
+def _OnBeforeSend(**kwargs):
+    _Mark("sent")
+
+
+def _OnBeforeParse(**kwargs):
+    _Mark("received")
+
+
+def _Finish(operation):
+    call = getattr(_THREAD_CALLS, "call", None)
+    if call is None or _PROFILER is None:
+        return
+    _THREAD_CALLS.call = None
+    end = time.perf_counter()
+    # A response answered before sending (a stub, a cache) has no network
+    # phases: everything after serialization counts as server time
+    sent = call.get("sent", call.get("serialized", call["start"]))
+    received = call.get("received", end)
+    _PROFILER.calls.Record(
+        operation,
+        {
+            "serialization": sent - call["start"],
+            "connection setup": call["connect"],
+            "server": max(0.0, received - sent - call["connect"]),
+            "parsing": end - received,
+        },
+        call["connections"],
+    )
+
+
+def _OnAfterCall(model, **kwargs):
+    _Finish(f"{model.service_model.service_name}.{model.name}")
+
+
+def _OnAfterCallError(context, **kwargs):
+    service, operation = context.get("metricsOperation", ("unknown", "unknown"))
+    _Finish(f"{service}.{operation}")
+
+
+def _OnOperation(model, context, **kwargs):
+    context.setdefault("metricsOperation", (model.service_model.service_name, model.name))
+
+
+def InstrumentClient(client):
+    """
+    Register the profiling hooks on a botocore client
+    """
+    events = client.meta.events
+    events.register("before-parameter-build.*.*", _OnParameterBuild, unique_id="aws-profile-start")
+    events.register("before-call.*.*", _OnOperation, unique_id="aws-profile-operation")
+    events.register_last("before-call.*.*", _OnBeforeCall, unique_id="aws-profile-serialized")
+    events.register_last("before-send.*.*", _OnBeforeSend, unique_id="aws-profile-sent")
+    events.register("before-parse.*.*", _OnBeforeParse, unique_id="aws-profile-received")
+    events.register("after-call.*.*", _OnAfterCall, unique_id="aws-profile-end")
+    events.register("after-call-error.*.*", _OnAfterCallError, unique_id="aws-profile-error")
+
+
+def _TimedConnect(connect):
+    def Connect(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return connect(self, *args, **kwargs)
+        finally:
+            call = getattr(_THREAD_CALLS, "call", None)
+            if call is not None:
+                call["connect"] += time.perf_counter() - started
+                call["connections"] += 1
+
+    Connect.profiledConnect = connect
+    return Connect
+
+
+def _PatchConnections(enable):
+    """
+    Time the TCP and TLS setup of the botocore connection classes
+    """
+    from botocore.awsrequest import AWSHTTPConnection, AWSHTTPSConnection
+
+    for connectionClass in (AWSHTTPConnection, AWSHTTPSConnection):
+        current = connectionClass.connect
+        if enable and not hasattr(current, "profiledConnect"):
+            connectionClass.connect = _TimedConnect(current)
+        elif not enable and hasattr(current, "profiledConnect"):
+            del connectionClass.connect
+
+
+########################################################################
+## Stack sampler
+########################################################################
+def _FrameLabel(frame):
+    code = frame.f_code
+    path = "/".join(code.co_filename.replace(os.sep, "/").split("/")[-2:])
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+
+def _Matches(frame, function, fileName):
+    name, _, location = frame.partition(" (")
+    return (function is None or name == function) and fileName in location
+
+
+def _ThreadGroup(name):
+    # ThreadPoolExecutor-3_17 and ThreadPoolExecutor-3_2 are one pool
+    return re.sub(r"_\d+$", "", name).replace(";", ":")
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of every other thread each interval seconds and
+    counts identical stacks, so memory follows the number of distinct
+    stacks rather than the run length
+    """
+
+    def __init__(self, interval=AWS_PROFILE_SAMPLE_INTERVAL):
+        super().__init__(name="aws-profiler", daemon=True)
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.categories = collections.Counter()
+        self.idle = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_FrameLabel(frame))
+                    frame = frame.f_back
+                labels.reverse()
+                self._Count(names.get(ident, "thread"), labels)
+
+    def _Count(self, threadName, labels):
+        if not labels:
+            return
+        stack = ";".join(labels)
+        category = next(
+            (
+                name for name, function, fileName, leafOnly in AWS_PROFILE_CATEGORIES
+                if any(_Matches(frame, function, fileName) for frame in (labels[-1:] if leafOnly else labels))
+            ),
+            None,
+        )
+        if category is None and not any(_Matches(frame, None, "aws_") for frame in labels):
+            # A pool worker waiting for work, or a thread which is not ours
+            self.idle += 1
+        else:
+            self.categories[category or "other"] += 1
+        self.stacks[f"{_ThreadGroup(threadName)};{stack}"] += 1
+
+    def Stop(self):
+        self.stopped.set()
+        self.join()
+
+
+########################################################################
+## Profiler
+########################################################################
+def ProcessAge():
+    """
+    Seconds since this process started (Linux), None elsewhere
+    """
+    try:
+        with open("/proc/self/stat") as statFile:
+            startTicks = int(statFile.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptimeFile:
+            uptime = float(uptimeFile.read().split()[0])
+        return max(0.0, uptime - startTicks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RunProfiler:
+    """
+    API call phases, sampled stacks and, optionally, allocation sites of a run
+    """
+
+    def __init__(self, interval=AWS_PROFILE_SAMPLE_INTERVAL, traceMemory=False):
+        self.calls = CallPhases()
+        self.sampler = StackSampler(interval)
+        self.traceMemory = traceMemory
+        # Interpreter start-up and module imports before profiling began
+        self.startup = ProcessAge()
+        self.started = time.perf_counter()
+        self.wallTime = None
+
+    def Start(self):
+        if self.traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _PatchConnections(True)
+        self.sampler.start()
+        return self
+
+    def Stop(self):
+        if self.wallTime is None:
+            self.sampler.Stop()
+            _PatchConnections(False)
+            self.wallTime = time.perf_counter() - self.started
+
+    def Summary(self):
+        interval = self.sampler.interval
+        summary = {
+            "wall_seconds": round(self.wallTime if self.wallTime is not None else time.perf_counter() - self.started, 6),
+            "startup_seconds": None if self.startup is None else round(self.startup, 3),
+            "sample_interval_seconds": interval,
+            "sampled_thread_seconds": {
+                category: round(count * interval, 3) for category, count in self.sampler.categories.most_common()
+            },
+            "idle_thread_seconds": round(self.sampler.idle * interval, 3),
+            "api_call_seconds": {phase: round(seconds, 6) for phase, seconds in self.calls.Totals().items()},
+            "api_calls": sum(self.calls.calls.values()),
+            "new_connections": self.calls.connections,
+            "api_operations": {
+                operation: {
+                    "calls": self.calls.calls[operation],
+                    **{phase: round(seconds, 6) for phase, seconds in phases.items()},
+                }
+                for operation, phases in sorted(self.calls.operations.items())
+            },
+        }
+        if self.traceMemory and tracemalloc.is_tracing():
+            statistics = tracemalloc.take_snapshot().statistics("lineno")[:AWS_PROFILE_TOP_ALLOCATIONS]
+            summary["top_allocations"] = [
+                {"site": str(stat.traceback[0]), "kib": round(stat.size / 1024, 1), "count": stat.count}
+                for stat in statistics
+            ]
+        return summary
+
+    def WriteFolded(self, path):
+        with open(path, "w") as foldedFile:
+            for stack, count in self.sampler.stacks.most_common():
+                foldedFile.write(f"{stack} {count}\n")
+
+    def LogSummary(self, summary):
+        logger.info(
+            f"Profile: {summary['wall_seconds']:.3f}s wall, "
+            f"{summary['startup_seconds'] if summary['startup_seconds'] is not None else '?'}s start-up and imports, "
+            f"{summary['api_calls']} API calls, {summary['new_connections']} new connections"
+        )
+        for phase, seconds in summary["api_call_seconds"].items():
+            logger.info(f"Profile: API {phase:<17} {seconds:10.3f}s")
+        for category, seconds in summary["sampled_thread_seconds"].items():
+            logger.info(f"Profile: sampled {category:<17} {seconds:10.3f}s")
+
+
+_PROFILER = None
+_PROFILER_LOCK = threading.Lock()
+
+
+def EnableProfiling(interval=AWS_PROFILE_SAMPLE_INTERVAL, traceMemory=False):
+    """
+    Start the sampler and instrument every client of the client factory
+    """
+    global _PROFILER
+    with _PROFILER_LOCK:
+        if _PROFILER is not None:
+            return _PROFILER
+        _PROFILER = RunProfiler(interval, traceMemory).Start()
+    aws_client_factory.AddClientListener(InstrumentClient)
+    return _PROFILER
+
+
+def WriteProfile(path):
+    """
+    Stop profiling, write the folded stacks to path and the phase breakdown
+    to <path without extension>-phases.json
+    """
+    if _PROFILER is None:
+        return None
+    _PROFILER.Stop()
+    summary = _PROFILER.Summary()
+    _PROFILER.WriteFolded(path)
+    summaryPath = f"{os.path.splitext(path)[0]}-phases.json"
+    with open(summaryPath, "w") as summaryFile:
+        json.dump(summary, summaryFile, indent=2)
+    _PROFILER.LogSummary(summary)
+    logger.info(f"Profile written to {path} and {summaryPath}")
+    return summary
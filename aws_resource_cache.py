@@ -0,0 +1,119 @@
+###########################################################################
+####################### MEMOIZED RESOURCE-ID RESOLVER #####################
+###########################################################################
+import logging
+import threading
+import time
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Cache Configuration
+########################################################################
+AWS_RESOURCE_CACHE_TTL = 300
+
+
+########################################################################
+## Resource-ID cache
+########################################################################
+def CacheKey(region, resourceType, filters=None):
+    """
+    Build a hashable (region, resource type, filter) key
+    """
+    if not filters:
+        return (region, resourceType, ())
+    return (
+        region,
+        resourceType,
+        tuple(sorted(
+            (name, tuple(values) if isinstance(values, (list, tuple)) else (values,))
+            for name, values in filters.items()
+        )),
+    )
+
+
+class ResourceIdCache:
+    """
+    Resource IDs keyed by (region, resource type, filter). Entries are filled
+    from the IDs returned by Create* calls or by a single Describe* lookup,
+    expire after a TTL and are invalidated when a resource is deleted.
+    """
+
+    def __init__(self, ttl=AWS_RESOURCE_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.keyLocks = {}
+
+    def Get(self, region, resourceType, filters=None):
+        """
+        Return a cached ID or None when missing or expired
+        """
+        key = CacheKey(region, resourceType, filters)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            resourceId, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            return resourceId
+
+    def Put(self, region, resourceType, resourceId, filters=None):
+        """
+        Remember the ID of a resource
+        """
+        key = CacheKey(region, resourceType, filters)
+        with self.lock:
+            self.entries[key] = (resourceId, time.monotonic() + self.ttl)
+        return resourceId
+
+    def Resolve(self, region, resourceType, filters, loader):
+        """
+        Return the cached ID or call the loader once, even when several
+        threads ask for the same key at the same time
+        """
+        resourceId = self.Get(region, resourceType, filters)
+        if resourceId is not None:
+            return resourceId
+
+        key = CacheKey(region, resourceType, filters)
+        with self.lock:
+            keyLock = self.keyLocks.setdefault(key, threading.Lock())
+        with keyLock:
+            resourceId = self.Get(region, resourceType, filters)
+            if resourceId is None:
+                resourceId = self.Put(region, resourceType, loader(), filters)
+        return resourceId
+
+    def Invalidate(self, region=None, resourceType=None, resourceId=None):
+        """
+        Drop every entry matching the given region, type and ID
+        """
+        with self.lock:
+            for key in list(self.entries):
+                entryRegion, entryType, _ = key
+                if region is not None and entryRegion != region:
+                    continue
+                if resourceType is not None and entryType != resourceType:
+                    continue
+                if resourceId is not None and self.entries[key][0] != resourceId:
+                    continue
+                del self.entries[key]
+
+    def InvalidateOnNotFound(self, error, region=None):
+        """
+        Drop the region entries when AWS reports that a cached ID is gone
+        """
+        code = error.response.get("Error", {}).get("Code", "")
+        if "NotFound" in code:
+            logger.info(f"Invalidating cached resource IDs after {code}")
+            self.Invalidate(region=region)
+
+    def Clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,278 @@
+###########################################################################
+############### RESOURCE DEPENDENCY GRAPH AND SCHEDULER ###################
+###########################################################################
+import collections
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Scheduler Configuration
+########################################################################
+AWS_GRAPH_MAX_WORKERS = 8
+
+
+########################################################################
+## Graph nodes
+########################################################################
+class NodeResult:
+    """
+    Placeholder for the result of another node, resolved when the node runs.
+    An optional extractor picks the useful part (an ID, an ARN) out of it.
+    """
+
+    def __init__(self, name, extractor=None):
+        self.name = name
+        self.extractor = extractor
+
+    def Resolve(self, results):
+        value = results[self.name]
+        return self.extractor(value) if self.extractor else value
+
+
+class GraphNode:
+    """
+    A single resource creation step of the graph
+    """
+
+    def __init__(self, name, func, dependsOn=(), args=(), kwargs=None):
+        self.name = name
+        self.func = func
+        self.dependsOn = tuple(dependsOn)
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+
+        for value in list(self.args) + list(self.kwargs.values()):
+            if isinstance(value, NodeResult) and value.name not in self.dependsOn:
+                self.dependsOn += (value.name,)
+
+    def Call(self, results):
+        args = [_ResolveValue(value, results) for value in self.args]
+        kwargs = {key: _ResolveValue(value, results) for key, value in self.kwargs.items()}
+        return self.func(*args, **kwargs)
+
+
+def _ResolveValue(value, results):
+    if isinstance(value, NodeResult):
+        return value.Resolve(results)
+    return value
+
+
+########################################################################
+## Graph run report
+########################################################################
+class GraphRun:
+    """
+    Results, errors and per-node timings of one graph execution
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.results = {}
+        self.errors = {}
+        self.skipped = []
+        self.timings = {}
+        self.wallTime = 0.0
+
+    @property
+    def ok(self):
+        return not self.errors and not self.skipped
+
+    def Duration(self, name):
+        start, end = self.timings[name]
+        return end - start
+
+    def CriticalPath(self):
+        """
+        Chain of nodes which bounded the wall time of the run
+        """
+        if not self.timings:
+            return []
+        current = max(self.timings, key=lambda name: self.timings[name][1])
+        path = [current]
+        while True:
+            finished = [dep for dep in self.graph.nodes[current].dependsOn if dep in self.timings]
+            if not finished:
+                break
+            current = max(finished, key=lambda name: self.timings[name][1])
+            path.append(current)
+        path.reverse()
+        return path
+
+    def LogTimings(self):
+        """
+        Log per-node timings and the critical path of the run
+        """
+        for name, (start, end) in sorted(self.timings.items(), key=lambda item: item[1][0]):
+            status = "FAILED" if name in self.errors else "OK"
+            logger.info(f"{name}: {status} start={start:.3f}s end={end:.3f}s took={end - start:.3f}s")
+        for name in self.skipped:
+            logger.info(f"{name}: SKIPPED (a dependency failed)")
+        path = self.CriticalPath()
+        logger.info(
+            f"Critical path: {' -> '.join(path)} "
+            f"({sum(self.Duration(name) for name in path):.3f}s of {self.wallTime:.3f}s wall time)"
+        )
+
+
+########################################################################
+## Graph scheduler
+########################################################################
+class ResourceGraph:
+    """
+    Declarative dependency graph of resource creation steps. Run() starts
+    every node as soon as all of its prerequisites have finished, so a
+    full stack takes about as long as its critical path.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+
+    def AddNode(self, name, func, dependsOn=(), args=(), kwargs=None):
+        """
+        Declare a step; NodeResult arguments add implicit dependencies
+        """
+        if name in self.nodes:
+            raise ValueError(f"Node {name} is already declared")
+        self.nodes[name] = GraphNode(name, func, dependsOn, args, kwargs)
+        return self.nodes[name]
+
+    def MarkExisting(self, existing):
+        """
+        Turn the steps of already existing resources into no-ops returning
+        the given value, so a rerun only issues the missing calls
+        """
+        for name, value in existing.items():
+            node = self.nodes[name]
+            node.func = lambda value=value: value
+            node.args = ()
+            node.kwargs = {}
+
+    def Validate(self):
+        """
+        Check that every dependency exists and that the graph has no cycles
+        """
+        for node in self.nodes.values():
+            for dep in node.dependsOn:
+                if dep not in self.nodes:
+                    raise ValueError(f"Node {node.name} depends on unknown node {dep}")
+
+        # Peel off nodes without unfinished prerequisites; what is left
+        # after that lies on or behind a cycle
+        waiting = {name: len(set(node.dependsOn)) for name, node in self.nodes.items()}
+        dependents = {name: [] for name in self.nodes}
+        for name, node in self.nodes.items():
+            for dep in set(node.dependsOn):
+                dependents[dep].append(name)
+        ready = [name for name, count in waiting.items() if not count]
+        while ready:
+            for child in dependents[ready.pop()]:
+                waiting[child] -= 1
+                if not waiting[child]:
+                    ready.append(child)
+        blocked = {name for name, count in waiting.items() if count}
+        if blocked:
+            # Follow blocked prerequisites until a node repeats
+            path = [next(name for name in self.nodes if name in blocked)]
+            seen = {path[0]: 0}
+            while True:
+                dep = next(dep for dep in self.nodes[path[-1]].dependsOn if dep in blocked)
+                if dep in seen:
+                    raise ValueError(f"Dependency cycle: {' -> '.join(path[seen[dep]:] + [dep])}")
+                seen[dep] = len(path)
+                path.append(dep)
+
+    def Run(self, maxWorkers=AWS_GRAPH_MAX_WORKERS, raiseOnError=True, journal=None):
+        """
+        Execute the graph on a thread pool and return a GraphRun. With a
+        RunJournal, nodes it already holds are answered from it and every
+        node that completes is recorded in it.
+        """
+        self.Validate()
+        replayed = set()
+        if journal is not None:
+            done = journal.Completed(self.nodes)
+            self.MarkExisting(done)
+            replayed.update(done)
+            if done:
+                logger.info(f"Journal: {len(done)} of {len(self.nodes)} steps done in a previous attempt")
+        run = GraphRun(self)
+        lock = threading.Lock()
+        # Unfinished prerequisites per node; a node is ready at zero
+        waiting = {}
+        dependents = {name: [] for name in self.nodes}
+        for name, node in self.nodes.items():
+            deps = set(node.dependsOn)
+            waiting[name] = len(deps)
+            for dep in deps:
+                dependents[dep].append(name)
+        ready = collections.deque(name for name, count in waiting.items() if not count)
+        skipped = set()
+
+        started = time.perf_counter()
+
+        def Execute(node):
+            with lock:
+                results = {dep: run.results[dep] for dep in node.dependsOn}
+            begin = time.perf_counter() - started
+            try:
+                res = node.Call(results)
+                if journal is not None and node.name not in replayed:
+                    journal.Record(node.name, res)
+                return res
+            finally:
+                run.timings[node.name] = (begin, time.perf_counter() - started)
+
+        def Skip(name):
+            # Depth-first over the dependents; run.skipped keeps report order
+            pending = [iter(dependents[name])]
+            while pending:
+                child = next(pending[-1], None)
+                if child is None:
+                    pending.pop()
+                elif child not in skipped:
+                    skipped.add(child)
+                    run.skipped.append(child)
+                    pending.append(iter(dependents[child]))
+
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            running = {}
+
+            def SubmitReady():
+                while ready:
+                    name = ready.popleft()
+                    # Nodes run in the caller's context (e.g. the current stack)
+                    context = contextvars.copy_context()
+                    running[executor.submit(context.run, Execute, self.nodes[name])] = name
+
+            SubmitReady()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        logger.error(f"Node {name} failed: {error}")
+                        run.errors[name] = error
+                        Skip(name)
+                        continue
+                    with lock:
+                        run.results[name] = future.result()
+                    for child in dependents[name]:
+                        waiting[child] -= 1
+                        if not waiting[child] and child not in skipped:
+                            ready.append(child)
+                SubmitReady()
+
+        run.wallTime = time.perf_counter() - started
+        if run.errors and raiseOnError:
+            run.LogTimings()
+            raise next(iter(run.errors.values()))
+        return run
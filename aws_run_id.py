@@ -0,0 +1,51 @@
+###########################################################################
+########################## RUN ID RESOURCE TAGGING ########################
+###########################################################################
+import os
+import threading
+import uuid
+
+########################################################################
+## Run ID Configuration
+########################################################################
+AWS_RUN_ID_TAG_KEY = "automation:run-id"
+AWS_RUN_ID_ENVIRONMENT_VARIABLE = "AWS_AUTOMATION_RUN_ID"
+
+_RUN_ID = None
+_RUN_ID_LOCK = threading.Lock()
+
+
+########################################################################
+## Run ID of this process
+########################################################################
+def GetRunId():
+    """
+    ID tagged on every resource this process creates: $AWS_AUTOMATION_RUN_ID
+    when set (e.g. the CI job ID), a random one otherwise
+    """
+    global _RUN_ID
+    if _RUN_ID is None:
+        with _RUN_ID_LOCK:
+            if _RUN_ID is None:
+                _RUN_ID = os.environ.get(AWS_RUN_ID_ENVIRONMENT_VARIABLE) or uuid.uuid4().hex[:12]
+    return _RUN_ID
+
+
+def SetRunId(runId):
+    global _RUN_ID
+    with _RUN_ID_LOCK:
+        _RUN_ID = runId
+
+
+def RunIdTags():
+    """
+    Run ID as an EC2 Tags list
+    """
+    return [{"Key": AWS_RUN_ID_TAG_KEY, "Value": GetRunId()}]
+
+
+def RunIdTagMap():
+    """
+    Run ID as an Image Builder tags map
+    """
+    return {AWS_RUN_ID_TAG_KEY: GetRunId()}
@@ -0,0 +1,192 @@
+###########################################################################
+###################### RESUMABLE RUN JOURNAL (JSON LINES) #################
+###########################################################################
+# One JSON object per line, appended and never rewritten:
+#
+#   {"event": "start", "run": "<run id>", "time": ...}
+#   {"event": "step", "run": "<run id>", "step": "<name>", "result": ..., "time": ...}
+#
+# boto3 resource objects in a result are stored as
+#
+#   {"__resource__": "<type>", "id": "<ID>", "region": "<region>"}
+#
+# A resumed run continues the last started run of the file: its finished
+# steps are answered from the journal and its run ID is reused, so the
+# resources it creates carry the same tag as the ones created before.
+###########################################################################
+import json
+import logging
+import os
+import threading
+import time
+
+from aws_run_id import GetRunId
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Run Journal Configuration
+########################################################################
+AWS_RUN_JOURNAL_RESOURCE_KEY = "__resource__"
+
+
+########################################################################
+## Result encoding
+########################################################################
+def EncodeResult(value):
+    """
+    JSON form of a step result: boto3 resource objects become their type,
+    ID and region, response metadata is dropped
+    """
+    model = getattr(getattr(value, "meta", None), "resource_model", None)
+    if model is not None:
+        return {
+            AWS_RUN_JOURNAL_RESOURCE_KEY: model.name,
+            "id": value.id,
+            "region": value.meta.client.meta.region_name,
+        }
+    if isinstance(value, dict):
+        return {key: EncodeResult(item) for key, item in value.items() if key != "ResponseMetadata"}
+    if isinstance(value, (list, tuple)):
+        return [EncodeResult(item) for item in value]
+    return value
+
+
+def DecodeResult(value, resourceLoader=None):
+    """
+    Inverse of EncodeResult(); resourceLoader(name, id, region) rebuilds
+    boto3 resource objects in the region they were created in (None for
+    journals written without it), without it they are returned as their ID
+    """
+    if isinstance(value, dict):
+        if AWS_RUN_JOURNAL_RESOURCE_KEY in value:
+            name, resourceId = value[AWS_RUN_JOURNAL_RESOURCE_KEY], value["id"]
+            if resourceLoader is None:
+                return resourceId
+            return resourceLoader(name, resourceId, value.get("region"))
+        return {key: DecodeResult(item, resourceLoader) for key, item in value.items()}
+    if isinstance(value, list):
+        return [DecodeResult(item, resourceLoader) for item in value]
+    return value
+
+
+########################################################################
+## Journal
+########################################################################
+class RunJournal:
+    """
+    Append-only journal of the completed steps of a run. Record() returns
+    once the step is on disk; steps finishing together share one write and
+    one fsync.
+    """
+
+    def __init__(self, path, resume=False, resourceLoader=None):
+        self.path = path
+        self.resourceLoader = resourceLoader
+        self.steps = {}
+        self.runId = None
+        if resume and os.path.exists(path):
+            self._Replay()
+        resumed = self.runId is not None
+        self.runId = self.runId or GetRunId()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a")
+        self.condition = threading.Condition()
+        self.pending = []
+        self.queued = 0
+        self.durable = 0
+        self.flushing = False
+        if resumed:
+            logger.info(f"Resuming run {self.runId}: {len(self.steps)} step(s) already done")
+        else:
+            self._Write([self._Line({"event": "start", "run": self.runId})])
+
+    def _Replay(self):
+        with open(self.path) as journalFile:
+            for number, line in enumerate(journalFile, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn last line of a run that died while writing it
+                    logger.warning(f"{self.path}:{number}: skipping unreadable journal line")
+                    continue
+                if record.get("event") == "start":
+                    self.runId = record["run"]
+                    self.steps = {}
+                elif record.get("event") == "step" and record.get("run") == self.runId:
+                    self.steps[record["step"]] = record["result"]
+
+    def _Line(self, record):
+        record["time"] = time.time()
+        return json.dumps(record, sort_keys=True, default=str) + "\n"
+
+    def _Write(self, lines):
+        self.file.write("".join(lines))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def Has(self, step):
+        return step in self.steps
+
+    def Result(self, step):
+        return DecodeResult(self.steps[step], self.resourceLoader)
+
+    def Completed(self, steps=None):
+        """
+        {step: decoded result} of the finished steps, of steps if given
+        """
+        names = self.steps if steps is None else [step for step in steps if step in self.steps]
+        return {step: self.Result(step) for step in names}
+
+    def Record(self, step, result):
+        encoded = EncodeResult(result)
+        line = self._Line({"event": "step", "run": self.runId, "step": step, "result": encoded})
+        with self.condition:
+            self.steps[step] = json.loads(json.dumps(encoded, default=str))
+            self.pending.append(line)
+            self.queued += 1
+            ticket = self.queued
+            while self.durable < ticket:
+                if self.flushing:
+                    self.condition.wait()
+                    continue
+                # Group commit: write everything queued so far with one fsync
+                lines, self.pending = self.pending, []
+                last = self.queued
+                self.flushing = True
+                written = False
+                self.condition.release()
+                try:
+                    self._Write(lines)
+                    written = True
+                finally:
+                    self.condition.acquire()
+                    self.flushing = False
+                    if written:
+                        self.durable = last
+                    else:
+                        # Left for the next writer; the error goes to this caller
+                        self.pending[:0] = lines
+                    self.condition.notify_all()
+
+    def Close(self):
+        self.file.close()
+
+
+def JournaledCall(journal, step, func, *args, **kwargs):
+    """
+    func(*args, **kwargs) unless the journal already has step
+    """
+    if journal is not None and journal.Has(step):
+        logger.info(f"{step}: done in a previous attempt, skipped")
+        return journal.Result(step)
+    res = func(*args, **kwargs)
+    if journal is not None:
+        journal.Record(step, res)
+    return res
@@ -0,0 +1,515 @@
+###########################################################################
+############ SECURITY GROUP RULE SETS: MINIMAL DIFF, BATCHED APPLY ########
+###########################################################################
+# Desired ingress/egress rules of many security groups, from YAML or JSON:
+#
+#   ruleSets:
+#     web:
+#       - {protocol: tcp, ports: [80, 443], cidrs: [0.0.0.0/0, ::/0]}   # ports 80 and 443 only
+#       - {protocol: tcp, ports: 8000-8100, cidrs: [10.0.0.0/16]}        # a range
+#   groups:
+#     sec_devices:                       # a group name (in -Vpc_id) or an sg- ID
+#       ingress:
+#         - web
+#         - {protocol: tcp, ports: 22, cidrs: [10.0.0.0/16], description: ssh}
+#         - {protocol: all, groups: [sg-0123456789abcdef0]}
+#       egress:
+#         - {protocol: all, cidrs: [0.0.0.0/0]}
+#
+#   $ python aws_security_group_rules.py -Rules_file rules.yaml [-Plan_only true]
+#
+# Only the directions a group lists are managed: a group without egress
+# keeps whatever egress rules it has, "egress: []" revokes them all.
+###########################################################################
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import contextvars
+import ipaddress
+import json
+import logging
+
+from botocore.exceptions import ClientError
+
+import aws_create_resources as resources
+from aws_call_executor import ErrorCode, ExecuteCall
+from aws_inventory import IterateSecurityGroupRules, IterateSecurityGroups
+from aws_resource_graph import ResourceGraph
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Security Group Rules Configuration
+########################################################################
+AWS_SG_DIRECTIONS = ('ingress', 'egress')
+AWS_SG_PROTOCOL_ALIASES = {'all': '-1', '-1': '-1', '1': 'icmp', '6': 'tcp', '17': 'udp', '58': 'icmpv6'}
+AWS_SG_PORT_PROTOCOLS = frozenset(['tcp', 'udp'])
+AWS_SG_ICMP_PROTOCOLS = frozenset(['icmp', 'icmpv6'])
+AWS_SG_RULES_PER_CALL = 100
+AWS_SG_FILTER_VALUES_PER_CALL = 200
+AWS_SG_DESCRIBE_PAGE_SIZE = 1000
+AWS_SG_MAX_WORKERS = 16
+# The rules of a group changed between the describe and the apply
+AWS_SG_RULE_RACE_ERRORS = frozenset([
+    'InvalidPermission.Duplicate',
+    'InvalidPermission.NotFound',
+    'InvalidSecurityGroupRuleId.NotFound',
+])
+
+# peerType is cidr, cidr6, group or prefix-list; ports are -1 when unused
+SecurityGroupRule = namedtuple('SecurityGroupRule', 'protocol fromPort toPort peerType peer')
+# {direction: {rule: description}}, {direction: [rule ID]}, {direction: {rule ID: description}}
+RuleDiff = namedtuple('RuleDiff', 'authorize revoke descriptions')
+
+
+########################################################################
+## Normalizing rules
+########################################################################
+def _Protocol(value):
+    protocol = str(value).lower()
+    return AWS_SG_PROTOCOL_ALIASES.get(protocol, protocol)
+
+
+def _PortRange(protocol, fromPort, toPort):
+    """
+    Ports as AWS reports them: ICMP type and code, -1 for protocols without ports
+    """
+    if protocol in AWS_SG_PORT_PROTOCOLS or protocol in AWS_SG_ICMP_PROTOCOLS:
+        return int(fromPort), int(toPort)
+    return -1, -1
+
+
+def _PortSpec(ports):
+    fromPort, _, toPort = str(ports).partition('-')
+    fromPort, toPort = int(fromPort), int(toPort or fromPort)
+    if not 0 <= fromPort <= toPort <= 65535:
+        raise ValueError(f"Invalid port range {ports}")
+    return fromPort, toPort
+
+
+def _EntryPorts(entry, protocol):
+    """
+    (fromPort, toPort) ranges of a rule entry; a list of ports gives one
+    range per item, never the span between them
+    """
+    if protocol not in AWS_SG_PORT_PROTOCOLS:
+        return [_PortRange(protocol, entry.get('fromPort', -1), entry.get('toPort', -1))]
+    ports = entry.get('ports', '0-65535')
+    if isinstance(ports, (list, tuple)):
+        if not ports:
+            raise ValueError("Empty port list")
+        return [_PortSpec(port) for port in ports]
+    return [_PortSpec(ports)]
+
+
+def _EntryPeers(entry):
+    for cidr in entry.get('cidrs', []):
+        network = ipaddress.ip_network(cidr, strict=False)
+        yield ('cidr' if network.version == 4 else 'cidr6'), str(network)
+    for groupId in entry.get('groups', []):
+        yield 'group', groupId
+    for prefixListId in entry.get('prefixLists', []):
+        yield 'prefix-list', prefixListId
+
+
+def ExpandRuleEntries(entries, ruleSets=None, where='rules'):
+    """
+    {rule: description} from spec entries: rule dicts with a protocol,
+    ports (tcp/udp: 22, the range "8000-8100", or a list such as [80, 443]
+    or [22, "8000-8100"] with one rule per item; ICMP: fromPort/toPort as
+    type and code), cidrs, groups and prefixLists, or the names of shared
+    rule sets
+    """
+    rules = {}
+    for entry in entries:
+        if isinstance(entry, str):
+            if entry not in (ruleSets or {}):
+                raise ValueError(f"{where}: unknown rule set {entry}")
+            expanded = ruleSets[entry]
+        else:
+            expanded = [entry]
+        for rule in expanded:
+            if not isinstance(rule, dict) or 'protocol' not in rule:
+                raise ValueError(f"{where}: a rule needs a protocol: {rule}")
+            protocol = _Protocol(rule['protocol'])
+            try:
+                portRanges = _EntryPorts(rule, protocol)
+                peers = list(_EntryPeers(rule))
+            except ValueError as error:
+                raise ValueError(f"{where}: {error}") from None
+            if not peers:
+                raise ValueError(f"{where}: a rule needs cidrs, groups or prefixLists: {rule}")
+            for fromPort, toPort in portRanges:
+                for peerType, peer in peers:
+                    key = SecurityGroupRule(protocol, fromPort, toPort, peerType, peer)
+                    if rules.get(key) is None:
+                        rules[key] = rule.get('description')
+    return rules
+
+
+def _DropCovered(rules):
+    """
+    Rules whose peer an all-protocols rule already allows are dropped
+    """
+    everything = {(rule.peerType, rule.peer) for rule in rules if rule.protocol == '-1'}
+    networks = [
+        ipaddress.ip_network(rule.peer)
+        for rule in rules if rule.protocol == '-1' and rule.peerType in ('cidr', 'cidr6')
+    ]
+    kept = {}
+    for rule, description in rules.items():
+        if rule.protocol != '-1':
+            if (rule.peerType, rule.peer) in everything:
+                continue
+            if rule.peerType in ('cidr', 'cidr6') and networks:
+                network = ipaddress.ip_network(rule.peer)
+                if any(network.version == other.version and network.subnet_of(other) for other in networks):
+                    continue
+        kept[rule] = description
+    return kept
+
+
+def _CollapseCidrs(rules):
+    """
+    CIDRs of the same protocol and ports are merged into the fewest blocks
+    """
+    blocks = {}
+    collapsed = {}
+    for rule, description in rules.items():
+        if rule.peerType in ('cidr', 'cidr6'):
+            blocks.setdefault(rule[:4], []).append((ipaddress.ip_network(rule.peer), description))
+        else:
+            collapsed[rule] = description
+    for key, networks in blocks.items():
+        if len(networks) == 1:
+            network, description = networks[0]
+            collapsed[SecurityGroupRule(*key, str(network))] = description
+            continue
+        for network in ipaddress.collapse_addresses(network for network, _ in networks):
+            collapsed[SecurityGroupRule(*key, str(network))] = next(
+                (description for part, description in networks if description is not None and part.subnet_of(network)),
+                None,
+            )
+    return collapsed
+
+
+def _JoinPorts(rules):
+    """
+    Overlapping or adjacent tcp/udp port ranges of the same peer are joined
+    """
+    ranges = {}
+    joined = {}
+    for rule, description in rules.items():
+        if rule.protocol in AWS_SG_PORT_PROTOCOLS:
+            ranges.setdefault((rule.protocol, rule.peerType, rule.peer), []).append(
+                (rule.fromPort, rule.toPort, description)
+            )
+        else:
+            joined[rule] = description
+    for (protocol, peerType, peer), portRanges in ranges.items():
+        portRanges.sort(key=lambda item: item[:2])
+        fromPort, toPort, description = portRanges[0]
+        for nextFrom, nextTo, nextDescription in portRanges[1:]:
+            if nextFrom <= toPort + 1:
+                toPort = max(toPort, nextTo)
+                description = description if description is not None else nextDescription
+                continue
+            joined[SecurityGroupRule(protocol, fromPort, toPort, peerType, peer)] = description
+            fromPort, toPort, description = nextFrom, nextTo, nextDescription
+        joined[SecurityGroupRule(protocol, fromPort, toPort, peerType, peer)] = description
+    return joined
+
+
+def MergeRules(rules):
+    """
+    Canonical form of a {rule: description} set: rules covered by an
+    all-protocols rule are dropped, CIDRs are collapsed and port ranges
+    joined until nothing changes. A merged rule keeps the first description.
+    """
+    while True:
+        merged = _JoinPorts(_CollapseCidrs(_DropCovered(rules)))
+        if merged.keys() == rules.keys():
+            return merged
+        rules = merged
+
+
+def NormalizeRuleSpec(spec):
+    """
+    {group name or ID: {direction: {rule: description}}} from a rule spec
+    ({ruleSets, groups}); only the directions a group lists are included
+    """
+    if not isinstance(spec, dict) or not isinstance(spec.get('groups'), dict) or not spec['groups']:
+        raise ValueError("A rule spec needs a 'groups' mapping")
+    ruleSets = spec.get('ruleSets') or {}
+    desired = {}
+    for group, directions in spec['groups'].items():
+        unknown = sorted(set(directions or {}) - set(AWS_SG_DIRECTIONS))
+        if unknown:
+            raise ValueError(f"{group}: unknown direction(s) {', '.join(unknown)}")
+        desired[group] = {
+            direction: MergeRules(ExpandRuleEntries(entries or [], ruleSets, f"{group} {direction}"))
+            for direction, entries in (directions or {}).items()
+        }
+    return desired
+
+
+def LoadRuleSpec(path):
+    """
+    Read a YAML or JSON (.json) rule spec file and normalize it
+    """
+    with open(path) as specFile:
+        if path.endswith('.json'):
+            return NormalizeRuleSpec(json.load(specFile))
+        import yaml
+
+        return NormalizeRuleSpec(yaml.safe_load(specFile))
+
+
+########################################################################
+## Current rules
+########################################################################
+def _Chunks(items, size):
+    return [items[index:index + size] for index in range(0, len(items), size)]
+
+
+def _RuleOf(item):
+    protocol = _Protocol(item['IpProtocol'])
+    if item.get('CidrIpv4'):
+        peerType, peer = 'cidr', str(ipaddress.ip_network(item['CidrIpv4'], strict=False))
+    elif item.get('CidrIpv6'):
+        peerType, peer = 'cidr6', str(ipaddress.ip_network(item['CidrIpv6'], strict=False))
+    elif item.get('ReferencedGroupInfo'):
+        peerType, peer = 'group', item['ReferencedGroupInfo']['GroupId']
+    else:
+        peerType, peer = 'prefix-list', item['PrefixListId']
+    return SecurityGroupRule(
+        protocol, *_PortRange(protocol, item.get('FromPort', -1), item.get('ToPort', -1)), peerType, peer,
+    )
+
+
+def ResolveGroupIds(groups, vpcId=None, client=None):
+    """
+    {group name or ID: group ID}; names are looked up in vpcId (the default
+    VPC when None) with one describe_security_groups call per 200 names
+    """
+    resolved = {group: group for group in groups if group.startswith('sg-')}
+    names = [group for group in groups if group not in resolved]
+    if names:
+        client = client or resources.GetEC2Client()
+        vpcId = vpcId or resources.GetVPCIds()
+        for chunk in _Chunks(names, AWS_SG_FILTER_VALUES_PER_CALL):
+            for group in IterateSecurityGroups(client, {'vpc-id': vpcId, 'group-name': chunk}):
+                resolved[group['GroupName']] = group['GroupId']
+        missing = [name for name in names if name not in resolved]
+        if missing:
+            raise ValueError(f"Security group(s) not found in {vpcId}: {', '.join(missing)}")
+    return resolved
+
+
+def CurrentRules(groupIds, client=None, maxWorkers=AWS_SG_MAX_WORKERS):
+    """
+    {group ID: {direction: {rule: (rule ID, description)}}}, read with
+    describe_security_group_rules for 200 groups per call, concurrently
+    """
+    client = client or resources.GetEC2Client()
+    chunks = _Chunks(sorted(set(groupIds)), AWS_SG_FILTER_VALUES_PER_CALL)
+    current = {groupId: {direction: {} for direction in AWS_SG_DIRECTIONS} for groupId in groupIds}
+    if not chunks:
+        return current
+
+    def Describe(chunk):
+        return list(IterateSecurityGroupRules(client, {'group-id': chunk}, AWS_SG_DESCRIBE_PAGE_SIZE))
+
+    with ThreadPoolExecutor(max_workers=min(len(chunks), maxWorkers)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, Describe, chunk) for chunk in chunks]
+        for future in futures:
+            for item in future.result():
+                direction = 'egress' if item['IsEgress'] else 'ingress'
+                current[item['GroupId']][direction][_RuleOf(item)] = (
+                    item['SecurityGroupRuleId'], item.get('Description'),
+                )
+    return current
+
+
+########################################################################
+## Diffing and applying
+########################################################################
+def DiffRules(desired, current):
+    """
+    Changes turning the current rules of a group into the desired ones.
+    Directions missing from desired are left alone, and descriptions are
+    only updated where the spec gives one.
+    """
+    authorize, revoke, descriptions = {}, {}, {}
+    for direction, rules in desired.items():
+        existing = current.get(direction, {})
+        missing = {rule: description for rule, description in rules.items() if rule not in existing}
+        extra = [ruleId for rule, (ruleId, _) in existing.items() if rule not in rules]
+        relabeled = {
+            existing[rule][0]: description
+            for rule, description in rules.items()
+            if rule in existing and description is not None and existing[rule][1] != description
+        }
+        if missing:
+            authorize[direction] = missing
+        if extra:
+            revoke[direction] = sorted(extra)
+        if relabeled:
+            descriptions[direction] = relabeled
+    return RuleDiff(authorize, revoke, descriptions)
+
+
+def DiffCounts(diff):
+    return {
+        'authorize': sum(len(rules) for rules in diff.authorize.values()),
+        'revoke': sum(len(ruleIds) for ruleIds in diff.revoke.values()),
+        'descriptions': sum(len(ruleIds) for ruleIds in diff.descriptions.values()),
+    }
+
+
+def IpPermissions(rules):
+    """
+    IpPermissions for a {rule: description} set, one permission per
+    protocol and port range holding all of its peers
+    """
+    permissions = {}
+    for rule in sorted(rules):
+        permission = permissions.get(rule[:3])
+        if permission is None:
+            permission = permissions[rule[:3]] = {'IpProtocol': rule.protocol}
+            if rule.protocol != '-1':
+                permission.update(FromPort=rule.fromPort, ToPort=rule.toPort)
+        description = {'Description': rules[rule]} if rules[rule] is not None else {}
+        if rule.peerType == 'cidr':
+            permission.setdefault('IpRanges', []).append(dict(CidrIp=rule.peer, **description))
+        elif rule.peerType == 'cidr6':
+            permission.setdefault('Ipv6Ranges', []).append(dict(CidrIpv6=rule.peer, **description))
+        elif rule.peerType == 'group':
+            permission.setdefault('UserIdGroupPairs', []).append(dict(GroupId=rule.peer, **description))
+        else:
+            permission.setdefault('PrefixListIds', []).append(dict(PrefixListId=rule.peer, **description))
+    return list(permissions.values())
+
+
+def ApplyRuleDiff(groupId, diff, client=None):
+    """
+    Apply a RuleDiff with batched calls, up to 100 rules each: new rules
+    are authorized before the replaced ones are revoked, so allowed traffic
+    is never cut while a group is being changed
+    """
+    client = client or resources.GetEC2Client()
+    try:
+        for direction, rules in diff.authorize.items():
+            for chunk in _Chunks(sorted(rules), AWS_SG_RULES_PER_CALL):
+                ExecuteCall(
+                    client, f'authorize_security_group_{direction}',
+                    GroupId=groupId, IpPermissions=IpPermissions({rule: rules[rule] for rule in chunk}),
+                )
+        for direction, relabeled in diff.descriptions.items():
+            for chunk in _Chunks(sorted(relabeled), AWS_SG_RULES_PER_CALL):
+                ExecuteCall(
+                    client, f'update_security_group_rule_descriptions_{direction}',
+                    GroupId=groupId,
+                    SecurityGroupRuleDescriptions=[
+                        {'SecurityGroupRuleId': ruleId, 'Description': relabeled[ruleId]} for ruleId in chunk
+                    ],
+                )
+        for direction, ruleIds in diff.revoke.items():
+            for chunk in _Chunks(ruleIds, AWS_SG_RULES_PER_CALL):
+                ExecuteCall(client, f'revoke_security_group_{direction}', GroupId=groupId, SecurityGroupRuleIds=chunk)
+    except ClientError as error:
+        if ErrorCode(error) not in AWS_SG_RULE_RACE_ERRORS:
+            logging.exception(f"******************************** ERROR: Unable to update the rules of {groupId}")
+        raise
+
+
+def ReconcileGroupRules(groupId, desired, current, client=None):
+    """
+    Diff and apply the rules of one group; when the group changed since it
+    was described, it is described again and diffed once more
+    """
+    diff = DiffRules(desired, current)
+    try:
+        ApplyRuleDiff(groupId, diff, client)
+    except ClientError as error:
+        if ErrorCode(error) not in AWS_SG_RULE_RACE_ERRORS:
+            raise
+        logger.warning(f"Rules of {groupId} changed while applying ({ErrorCode(error)}), diffing again")
+        diff = DiffRules(desired, CurrentRules([groupId], client)[groupId])
+        ApplyRuleDiff(groupId, diff, client)
+    return diff
+
+
+def ReconcileSecurityGroupRules(desired, vpcId=None, maxWorkers=AWS_SG_MAX_WORKERS, planOnly=False, client=None):
+    """
+    Bring the rules of many groups to the desired state ({group name or
+    ID: {direction: {rule: description}}}, see NormalizeRuleSpec()). All
+    groups are described up front, then every group with changes gets one
+    graph node applying them, with up to maxWorkers groups at a time.
+    Returns one report row per group.
+    """
+    client = client or resources.GetEC2Client()
+    groupIds = ResolveGroupIds(list(desired), vpcId, client)
+    owners = {}
+    for group, groupId in groupIds.items():
+        if owners.setdefault(groupId, group) != group:
+            raise ValueError(f"{owners[groupId]} and {group} are the same security group {groupId}")
+    current = CurrentRules(list(owners), client, maxWorkers)
+
+    graph = ResourceGraph()
+    report = []
+    for group, rules in desired.items():
+        groupId = groupIds[group]
+        counts = DiffCounts(DiffRules(rules, current[groupId]))
+        changed = any(counts.values())
+        report.append(dict(
+            group=group, groupId=groupId, status='PLANNED' if changed else 'OK', error=None, **counts,
+        ))
+        if changed and not planOnly:
+            graph.AddNode(groupId, ReconcileGroupRules, args=(groupId, rules, current[groupId], client))
+    logger.info(f"Security group rules: {len(desired)} group(s), {len(graph.nodes)} to change")
+    if graph.nodes:
+        run = graph.Run(maxWorkers=maxWorkers, raiseOnError=False)
+        for row in report:
+            if row['groupId'] in run.errors:
+                row.update(status='FAILED', error=str(run.errors[row['groupId']]))
+            elif row['groupId'] in run.results:
+                row.update(status='CHANGED', **DiffCounts(run.results[row['groupId']]))
+        logger.info(f"Security group rules applied in {run.wallTime:.2f}s")
+    return report
+
+
+def LogRuleReport(report):
+    width = max((len(row['group']) for row in report), default=0)
+    for row in report:
+        detail = row['error'] or (
+            f"+{row['authorize']} -{row['revoke']} rule(s), {row['descriptions']} description(s)"
+        )
+        logger.info(f"{row['group']:<{width}} {row['groupId']} {row['status']:<7} {detail}")
+    failed = sum(1 for row in report if row['status'] == 'FAILED')
+    logger.info(f"Security groups: {len(report) - failed} OK, {failed} FAILED")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconciling the rules of many security groups")
+    parser.add_argument("-Rules_file", required=True, help="YAML or JSON spec of the desired rules per group")
+    parser.add_argument("-Vpc_id", help="VPC of the groups given by name, the default VPC if omitted")
+    parser.add_argument("-Max_workers", type=int, default=AWS_SG_MAX_WORKERS)
+    parser.add_argument("-Plan_only", choices=["true", "false"], default="false")
+    parser.add_argument("-Rules_report", help="Write the per-group report to a JSON file")
+    args = parser.parse_args()
+
+    report = ReconcileSecurityGroupRules(
+        LoadRuleSpec(args.Rules_file),
+        vpcId=args.Vpc_id,
+        maxWorkers=args.Max_workers,
+        planOnly=args.Plan_only == "true",
+    )
+    LogRuleReport(report)
+    if args.Rules_report:
+        with open(args.Rules_report, "w") as reportFile:
+            json.dump(report, reportFile, indent=2)
+    raise SystemExit(1 if any(row['status'] == 'FAILED' for row in report) else 0)
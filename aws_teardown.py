@@ -0,0 +1,498 @@
+###########################################################################
+################ BULK TEARDOWN OF TAGGED EC2 AND IMAGE BUILDER ############
+###########################################################################
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import atexit
+import logging
+import time
+
+import aws_create_resources as resources
+from aws_call_executor import ErrorCode, ExecuteCall
+from aws_client_factory import GetClient
+from aws_inventory import (
+    AWS_INVENTORY_ALIVE_INSTANCE_STATES,
+    IterateInstances,
+    IterateInternetGateways,
+    IterateNetworkInterfaces,
+    IterateResources,
+    IterateRouteTables,
+    IterateSecurityGroups,
+    IterateSubnets,
+    IterateVPCs,
+)
+from aws_metrics import EnableMetrics, WriteMetrics
+from aws_resource_graph import ResourceGraph
+from aws_run_id import AWS_RUN_ID_TAG_KEY
+
+########################################################################
+## Setupping logger activities
+########################################################################
+logger = logging.getLogger()
+
+########################################################################
+## Teardown Configuration
+########################################################################
+AWS_TEARDOWN_MAX_WORKERS = 16
+AWS_TEARDOWN_TERMINATE_BATCH = 1000
+AWS_TEARDOWN_DEPENDENCY_RETRIES = 12
+AWS_TEARDOWN_DEPENDENCY_DELAY = 5
+AWS_TEARDOWN_WAITER_DELAY = 5
+AWS_TEARDOWN_WAITER_MAX_ATTEMPTS = 60
+AWS_TEARDOWN_DEPENDENCY_ERRORS = frozenset([
+    'DependencyViolation',
+    'InvalidNetworkInterface.InUse',
+    'ResourceDependencyException',
+])
+AWS_IMAGE_BUILDER_DELETE_CALLS = {
+    'image-pipeline': ('delete_image_pipeline', 'imagePipelineArn'),
+    'image': ('delete_image', 'imageBuildVersionArn'),
+    'image-recipe': ('delete_image_recipe', 'imageRecipeArn'),
+    'distribution-configuration': ('delete_distribution_configuration', 'distributionConfigurationArn'),
+    'infrastructure-configuration': ('delete_infrastructure_configuration', 'infrastructureConfigurationArn'),
+    'component': ('delete_component', 'componentBuildVersionArn'),
+}
+
+
+def GetTeardownClient(service, region=None):
+    """
+    Getting a shared client with the credentials of aws_create_resources
+    """
+    return GetClient(
+        service,
+        region_name=region or resources.AWS_DEFAULT_REGION,
+        accessKey=resources.AWS_ACCESS_KEY_ID,
+        secretAccessKey=resources.AWS_SECRET_ACCESS_KEY,
+    )
+
+
+########################################################################
+## Deleting helpers
+########################################################################
+def _ForEach(func, items, maxWorkers=AWS_TEARDOWN_MAX_WORKERS):
+    """
+    Run func on every item in parallel; the first error is raised once
+    every item has been processed
+    """
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(maxWorkers, len(items))) as executor:
+        futures = [executor.submit(func, item) for item in items]
+    for future in futures:
+        if future.exception() is not None:
+            raise future.exception()
+    return [future.result() for future in futures]
+
+
+def _Delete(target, operation, **kwargs):
+    """
+    ExecuteCall for a detach/delete: resources which are already gone count
+    as deleted and dependency violations are retried while AWS catches up
+    """
+    for attempt in range(AWS_TEARDOWN_DEPENDENCY_RETRIES):
+        try:
+            return ExecuteCall(target, operation, **kwargs)
+        except ClientError as error:
+            code = ErrorCode(error)
+            if 'NotFound' in code:
+                logger.info(f"{operation} {kwargs}: already gone ({code})")
+                return None
+            if code not in AWS_TEARDOWN_DEPENDENCY_ERRORS or attempt == AWS_TEARDOWN_DEPENDENCY_RETRIES - 1:
+                logging.exception(f"******************************** ERROR: Unable to {operation} {kwargs}")
+                raise
+            logger.info(f"{operation} {kwargs}: {code}, retrying in {AWS_TEARDOWN_DEPENDENCY_DELAY}s")
+            time.sleep(AWS_TEARDOWN_DEPENDENCY_DELAY)
+
+
+def _DeleteEC2(client, resourceType, resourceId, operation, **kwargs):
+    res = _Delete(client, operation, **kwargs)
+    resources.AWS_RESOURCE_ID_CACHE.Invalidate(client.meta.region_name, resourceType, resourceId)
+    return res
+
+
+def _Wait(client, waiterName, **kwargs):
+    client.get_waiter(waiterName).wait(
+        WaiterConfig={'Delay': AWS_TEARDOWN_WAITER_DELAY, 'MaxAttempts': AWS_TEARDOWN_WAITER_MAX_ATTEMPTS},
+        **kwargs
+    )
+
+
+def _Batches(items, size):
+    return [items[index:index + size] for index in range(0, len(items), size)]
+
+
+########################################################################
+## Finding tagged EC2 resources
+########################################################################
+def FindTaggedEC2Resources(tagKey, tagValue, client=None):
+    """
+    Describe every EC2 resource tagged tagKey=tagValue, one filtered
+    paginated call per resource type, all of them concurrently
+    """
+    client = client or resources.GetEC2Client()
+    tagFilter = {f'tag:{tagKey}': tagValue}
+    calls = {
+        'Instance': lambda: list(IterateInstances(
+            client, {**tagFilter, 'instance-state-name': AWS_INVENTORY_ALIVE_INSTANCE_STATES}
+        )),
+        'NetworkInterface': lambda: list(IterateNetworkInterfaces(client, tagFilter)),
+        'InternetGateway': lambda: list(IterateInternetGateways(client, tagFilter)),
+        'RouteTable': lambda: list(IterateRouteTables(client, tagFilter)),
+        'SecurityGroup': lambda: list(IterateSecurityGroups(client, tagFilter)),
+        'Subnet': lambda: list(IterateSubnets(client, tagFilter)),
+        'VPC': lambda: list(IterateVPCs(client, tagFilter)),
+    }
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        return dict(zip(calls, executor.map(lambda call: call(), calls.values())))
+
+
+########################################################################
+## Deleting EC2 resources
+########################################################################
+def DetachNetworkInterfaces(client, nics):
+    """
+    Force-detach the secondary network interfaces from their instances
+    """
+    attached = [
+        nic for nic in nics
+        if nic.get('Attachment', {}).get('Status') in ('attaching', 'attached')
+        and nic['Attachment'].get('DeviceIndex', 0) != 0
+    ]
+    return _ForEach(
+        lambda nic: _Delete(
+            client, 'detach_network_interface', AttachmentId=nic['Attachment']['AttachmentId'], Force=True
+        ),
+        attached,
+    )
+
+
+def TerminateInstances(client, instances):
+    """
+    Terminate instances with one call per batch of up to 1000 IDs and wait
+    until they are gone
+    """
+    instanceIds = [instance['InstanceId'] for instance in instances]
+
+    def Terminate(batch):
+        try:
+            ExecuteCall(client, 'terminate_instances', InstanceIds=batch)
+        except ClientError as error:
+            if 'NotFound' not in ErrorCode(error) or len(batch) == 1:
+                raise
+            # One vanished instance fails the whole batch: fall back to one call per ID
+            _ForEach(lambda instanceId: _Delete(client, 'terminate_instances', InstanceIds=[instanceId]), batch)
+        _Wait(client, 'instance_terminated', InstanceIds=batch)
+        for instanceId in batch:
+            resources.AWS_RESOURCE_ID_CACHE.Invalidate(client.meta.region_name, 'instance', instanceId)
+        return batch
+
+    return _ForEach(Terminate, _Batches(instanceIds, AWS_TEARDOWN_TERMINATE_BATCH))
+
+
+def DeleteNetworkInterfaces(client, nics):
+    nicIds = [nic['NetworkInterfaceId'] for nic in nics]
+    if any(nic.get('Attachment') for nic in nics):
+        _Wait(client, 'network_interface_available', NetworkInterfaceIds=nicIds)
+    return _ForEach(
+        lambda nicId: _DeleteEC2(
+            client, 'network-interface', nicId, 'delete_network_interface', NetworkInterfaceId=nicId
+        ),
+        nicIds,
+    )
+
+
+def DetachInternetGateways(client, gateways):
+    attachments = [
+        (gateway['InternetGatewayId'], attachment['VpcId'])
+        for gateway in gateways
+        for attachment in gateway.get('Attachments', [])
+    ]
+    return _ForEach(
+        lambda attachment: _Delete(
+            client, 'detach_internet_gateway', InternetGatewayId=attachment[0], VpcId=attachment[1]
+        ),
+        attachments,
+    )
+
+
+def DeleteInternetGateways(client, gateways):
+    return _ForEach(
+        lambda gatewayId: _DeleteEC2(
+            client, 'internet-gateway', gatewayId, 'delete_internet_gateway', InternetGatewayId=gatewayId
+        ),
+        [gateway['InternetGatewayId'] for gateway in gateways],
+    )
+
+
+def DeleteRouteTables(client, routeTables):
+    """
+    Disassociate and delete route tables; main route tables go with their VPC
+    """
+    def Delete(routeTable):
+        for association in routeTable.get('Associations', []):
+            if not association.get('Main'):
+                _Delete(client, 'disassociate_route_table', AssociationId=association['RouteTableAssociationId'])
+        return _DeleteEC2(
+            client, 'route-table', routeTable['RouteTableId'], 'delete_route_table',
+            RouteTableId=routeTable['RouteTableId'],
+        )
+
+    return _ForEach(
+        Delete,
+        [table for table in routeTables if not any(a.get('Main') for a in table.get('Associations', []))],
+    )
+
+
+def DeleteSecurityGroups(client, groups):
+    return _ForEach(
+        lambda groupId: _DeleteEC2(client, 'security-group', groupId, 'delete_security_group', GroupId=groupId),
+        [group['GroupId'] for group in groups if group.get('GroupName') != 'default'],
+    )
+
+
+def DeleteSubnets(client, subnets):
+    return _ForEach(
+        lambda subnetId: _DeleteEC2(client, 'subnet', subnetId, 'delete_subnet', SubnetId=subnetId),
+        [subnet['SubnetId'] for subnet in subnets],
+    )
+
+
+def DeleteVPCs(client, vpcs):
+    return _ForEach(
+        lambda vpcId: _DeleteEC2(client, 'vpc', vpcId, 'delete_vpc', VpcId=vpcId),
+        [vpc['VpcId'] for vpc in vpcs if not vpc.get('IsDefault')],
+    )
+
+
+def AddEC2TeardownNodes(graph, client, found):
+    """
+    Declare the EC2 deletions of the region of client in reverse dependency
+    order: a resource is only deleted once everything created on top of it
+    is gone
+    """
+    region = client.meta.region_name
+
+    def AddNode(step, func, items, dependsOn=()):
+        graph.AddNode(
+            f'{region}:{step}', func,
+            dependsOn=[f'{region}:{name}' for name in dependsOn],
+            args=(client, items),
+        )
+
+    AddNode('DetachNetworkInterfaces', DetachNetworkInterfaces, found['NetworkInterface'])
+    AddNode('TerminateInstances', TerminateInstances, found['Instance'], ['DetachNetworkInterfaces'])
+    AddNode('DeleteNetworkInterfaces', DeleteNetworkInterfaces, found['NetworkInterface'], ['DetachNetworkInterfaces'])
+    AddNode('DetachInternetGateways', DetachInternetGateways, found['InternetGateway'], ['TerminateInstances'])
+    AddNode('DeleteInternetGateways', DeleteInternetGateways, found['InternetGateway'], ['DetachInternetGateways'])
+    AddNode('DeleteRouteTables', DeleteRouteTables, found['RouteTable'])
+    AddNode(
+        'DeleteSecurityGroups', DeleteSecurityGroups, found['SecurityGroup'],
+        ['TerminateInstances', 'DeleteNetworkInterfaces'],
+    )
+    AddNode('DeleteSubnets', DeleteSubnets, found['Subnet'], ['TerminateInstances', 'DeleteNetworkInterfaces'])
+    AddNode(
+        'DeleteVPCs', DeleteVPCs, found['VPC'],
+        ['DeleteInternetGateways', 'DeleteRouteTables', 'DeleteSecurityGroups', 'DeleteSubnets'],
+    )
+    return graph
+
+
+########################################################################
+## Finding and deleting tagged Image Builder resources
+########################################################################
+def _ImageBuilderResourceType(arn):
+    return arn.split(':', 5)[5].split('/')[0]
+
+
+def FindTaggedImageBuilderResources(region, tagKey, tagValue, clientFactory=GetTeardownClient):
+    """
+    ARNs of the Image Builder resources tagged tagKey=tagValue, grouped by
+    resource type, from a single paginated tagging API query
+    """
+    found = {resourceType: [] for resourceType in AWS_IMAGE_BUILDER_DELETE_CALLS}
+    for mapping in IterateResources(
+            clientFactory('resourcegroupstaggingapi', region), 'get_resources', 'ResourceTagMappingList',
+            TagFilters=[{'Key': tagKey, 'Values': [tagValue]}],
+            ResourceTypeFilters=['imagebuilder'],
+    ):
+        resourceType = _ImageBuilderResourceType(mapping['ResourceARN'])
+        if resourceType in found:
+            found[resourceType].append(mapping['ResourceARN'])
+    return found
+
+
+def _BuildVersionArns(client, resourceType, arn):
+    """
+    Components and images are deleted per build version
+    """
+    if arn.split(':', 5)[5].count('/') == 3:
+        return [arn]
+    if resourceType == 'component':
+        summaries = IterateResources(
+            client, 'list_component_build_versions', 'componentSummaryList', componentVersionArn=arn
+        )
+    else:
+        summaries = IterateResources(
+            client, 'list_image_build_versions', 'imageSummaryList', imageVersionArn=arn
+        )
+    return [summary['arn'] for summary in summaries]
+
+
+def DeleteImageBuilderResources(client, resourceType, arns):
+    operation, arnKey = AWS_IMAGE_BUILDER_DELETE_CALLS[resourceType]
+    if resourceType in ('component', 'image'):
+        arns = [build for arn in arns for build in _BuildVersionArns(client, resourceType, arn)]
+    return _ForEach(lambda arn: _Delete(client, operation, **{arnKey: arn}), arns)
+
+
+def AddImageBuilderTeardownNodes(graph, region, client, found):
+    """
+    Pipelines and images go first, then the recipes and configurations they
+    use, then the components of the recipes
+    """
+    def AddNode(step, resourceType, dependsOn=()):
+        graph.AddNode(
+            f'{region}:{step}', DeleteImageBuilderResources,
+            dependsOn=[f'{region}:{name}' for name in dependsOn],
+            args=(client, resourceType, found[resourceType]),
+        )
+
+    AddNode('DeletePipelines', 'image-pipeline')
+    AddNode('DeleteImages', 'image')
+    AddNode('DeleteRecipes', 'image-recipe', ['DeletePipelines', 'DeleteImages'])
+    AddNode('DeleteDistributions', 'distribution-configuration', ['DeletePipelines'])
+    AddNode('DeleteInfrastructures', 'infrastructure-configuration', ['DeletePipelines'])
+    AddNode('DeleteComponents', 'component', ['DeleteRecipes'])
+    return graph
+
+
+########################################################################
+## Teardown
+########################################################################
+def _CountFound(found):
+    return sum(len(items) for items in found.values())
+
+
+def TeardownRegions(regions=None, stackFile=None):
+    """
+    Regions to search: every enabled region of the account for ["all"],
+    else regions plus the regions of the stacks of a stack spec file
+    (aws_create_resources.py -Stack_file), by default AWS_DEFAULT_REGION
+    """
+    if regions and 'all' in regions:
+        return sorted(
+            region['RegionName']
+            for region in ExecuteCall(GetTeardownClient('ec2'), 'describe_regions')['Regions']
+        )
+    found = list(regions or [])
+    if stackFile:
+        found += [stack['region'] for stack in resources.LoadStackSpecs(stackFile)]
+    return list(dict.fromkeys(found)) or [resources.AWS_DEFAULT_REGION]
+
+
+def Teardown(
+        tagKey,
+        tagValue,
+        regions=None,
+        imageBuilderRegions=None,
+        ec2=True,
+        imageBuilder=True,
+        maxWorkers=AWS_TEARDOWN_MAX_WORKERS,
+        dryRun=False,
+):
+    """
+    Find everything tagged tagKey=tagValue in every region of regions (by
+    default AWS_DEFAULT_REGION; imageBuilderRegions overrides the regions
+    searched for Image Builder resources) and delete it: dependent resources
+    first, independent ones and regions in parallel. Returns the found
+    resources, keyed "ec2:<region>" and "imagebuilder:<region>", and the
+    GraphRun (None on a dry run).
+    """
+    regions = regions or [resources.AWS_DEFAULT_REGION]
+    imageBuilderRegions = imageBuilderRegions or regions
+    discoveries = {}
+    if ec2:
+        for region in regions:
+            discoveries[f'ec2:{region}'] = lambda region=region: FindTaggedEC2Resources(
+                tagKey, tagValue, GetTeardownClient('ec2', region)
+            )
+    if imageBuilder:
+        for region in imageBuilderRegions:
+            discoveries[f'imagebuilder:{region}'] = lambda region=region: FindTaggedImageBuilderResources(
+                region, tagKey, tagValue
+            )
+    with ThreadPoolExecutor(max_workers=min(AWS_TEARDOWN_MAX_WORKERS, max(1, len(discoveries)))) as executor:
+        found = dict(zip(discoveries, executor.map(lambda call: call(), discoveries.values())))
+
+    for scope, items in found.items():
+        summary = ', '.join(f'{len(ids)} {kind}' for kind, ids in items.items() if ids)
+        logger.info(f"{scope}: {summary or 'nothing'} tagged {tagKey}={tagValue}")
+    if dryRun or not any(_CountFound(items) for items in found.values()):
+        return found, None
+
+    graph = ResourceGraph()
+    for scope, items in found.items():
+        if not _CountFound(items):
+            continue
+        service, region = scope.split(':', 1)
+        if service == 'ec2':
+            AddEC2TeardownNodes(graph, GetTeardownClient('ec2', region), items)
+        else:
+            AddImageBuilderTeardownNodes(graph, region, GetTeardownClient('imagebuilder', region), items)
+    run = graph.Run(maxWorkers=maxWorkers, raiseOnError=False)
+    run.LogTimings()
+    for name, error in run.errors.items():
+        logger.error(f"{name}: {error}")
+    for name in run.skipped:
+        logger.error(f"{name}: skipped, a prerequisite step failed")
+    return found, run
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deleting the AWS resources of a run")
+    parser.add_argument("-Run_id", help="Delete what was tagged with this run ID")
+    parser.add_argument("-Tag_key", help="Delete what is tagged -Tag_key=-Tag_value instead")
+    parser.add_argument("-Tag_value")
+    parser.add_argument("-Access_key")
+    parser.add_argument("-Secret_access_key")
+    parser.add_argument("-Region_name", help="Default region, searched when no other region is given")
+    parser.add_argument("-Regions", help="Comma-separated regions to search, or all for every enabled region")
+    parser.add_argument("-Stack_file", help="Also search the regions of the stacks of this stack spec file")
+    parser.add_argument("-Image_builder_regions", help="Comma-separated regions of the Image Builder resources, "
+                                                      "by default the same as the EC2 ones")
+    parser.add_argument("-Ec2", choices=["true", "false"], default="true")
+    parser.add_argument("-Image_builder", choices=["true", "false"], default="true")
+    parser.add_argument("-Max_workers", type=int, default=AWS_TEARDOWN_MAX_WORKERS)
+    parser.add_argument("-Dry_run", choices=["true", "false"], default="false")
+    parser.add_argument("-Metrics_output", help="Write API call metrics to a .json or .prom file")
+    args = parser.parse_args()
+
+    if args.Tag_key:
+        tagKey, tagValue = args.Tag_key, args.Tag_value
+    elif args.Run_id:
+        tagKey, tagValue = AWS_RUN_ID_TAG_KEY, args.Run_id
+    else:
+        parser.error("-Run_id or -Tag_key/-Tag_value is required")
+    if args.Access_key:
+        resources.AWS_ACCESS_KEY_ID = args.Access_key
+        resources.AWS_SECRET_ACCESS_KEY = args.Secret_access_key
+    if args.Region_name:
+        resources.AWS_DEFAULT_REGION = args.Region_name
+    if args.Metrics_output:
+        EnableMetrics()
+        atexit.register(WriteMetrics, args.Metrics_output)
+
+    found, run = Teardown(
+        tagKey,
+        tagValue,
+        regions=TeardownRegions(args.Regions.split(",") if args.Regions else None, args.Stack_file),
+        imageBuilderRegions=args.Image_builder_regions.split(",") if args.Image_builder_regions else None,
+        ec2=args.Ec2 == "true",
+        imageBuilder=args.Image_builder == "true",
+        maxWorkers=args.Max_workers,
+        dryRun=args.Dry_run == "true",
+    )
+    if run is not None and not run.ok:
+        raise SystemExit(1)
@@ -0,0 +1,68 @@
+###########################################################################
+############ MICROBENCHMARK: IMAGE BUILDER CLIENT CONSTRUCTION ############
+###########################################################################
+# Compares the per-call cost of building a fresh boto3 client (what
+# GetImageBuilderClient() used to do in every Create* function) with the
+# shared client registry of aws_client_factory. No AWS calls are made.
+#
+#   $ python benchmarks/bench_client_factory.py -Iterations 200
+###########################################################################
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import boto3  # noqa: E402
+
+import aws_client_factory  # noqa: E402
+
+CREDENTIALS = {
+    "region_name": "us-east-1",
+    "aws_access_key_id": "AKIABENCHMARK",
+    "aws_secret_access_key": "benchmark",
+}
+
+
+def BenchFreshClient(iterations):
+    """
+    One boto3.client("imagebuilder") per call
+    """
+    started = time.perf_counter()
+    for _ in range(iterations):
+        boto3.client("imagebuilder", **CREDENTIALS)
+    return (time.perf_counter() - started) / iterations
+
+
+def BenchSharedClient(iterations):
+    """
+    One registry lookup per call, timed after the first call built the client
+    """
+    aws_client_factory.ClearClients()
+    kwargs = {
+        "region_name": CREDENTIALS["region_name"],
+        "accessKey": CREDENTIALS["aws_access_key_id"],
+        "secretAccessKey": CREDENTIALS["aws_secret_access_key"],
+    }
+    started = time.perf_counter()
+    aws_client_factory.GetClient("imagebuilder", **kwargs)
+    first = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        aws_client_factory.GetClient("imagebuilder", **kwargs)
+    return first, (time.perf_counter() - started) / iterations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Image builder client construction benchmark")
+    parser.add_argument("-Iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    fresh = BenchFreshClient(args.Iterations)
+    first, shared = BenchSharedClient(args.Iterations)
+    print(f"before (boto3.client per call):  {fresh * 1e6:10.1f} us/call")
+    print(f"after  (first call, builds it):  {first * 1e6:10.1f} us")
+    print(f"after  (shared client registry): {shared * 1e6:10.1f} us/call")
+    print(f"speedup: {fresh / shared:.0f}x")
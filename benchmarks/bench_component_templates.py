@@ -0,0 +1,97 @@
+###########################################################################
+########### MICROBENCHMARK: COMPONENT DOCUMENT RENDER AND DUMP ############
+###########################################################################
+# Compares building component documents the way the __main__ block of
+# aws_ec2_image_builder.py used to (if/elif on the image name, a dict
+# literal, yaml.dump with the pure-Python emitter) with the precompiled
+# template registry of aws_component_templates and the C emitter. No AWS
+# calls are made.
+#
+#   $ python benchmarks/bench_component_templates.py -Variants 5000
+###########################################################################
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import yaml  # noqa: E402
+
+from aws_component_templates import COMPONENT_TEMPLATES, YAML_DUMPER, ComponentDocumentYaml  # noqa: E402
+
+IMAGES = (
+    "Ubuntu Server 20.04 LTS x86",
+    "Debian 11 x86",
+    "Amazon Linux 2 x86",
+    "Centos 7 x86",
+    "Rocky Linux 8 x86",
+)
+
+
+def LegacyComponentData(componentPlatform, recipeImageName, sleepSeconds):
+    payload = None
+    lastPatchDate = None
+
+    if componentPlatform == "Linux":
+        if "Ubuntu" in recipeImageName or "Debian" in recipeImageName:
+            payload = "apt update -y"
+            lastPatchDate = "cat /var/log/apt/history.log | grep 'End-Date' | tail -1"
+        elif "Amazon" in recipeImageName or "Centos" in recipeImageName:
+            payload = "yum -y update"
+            lastPatchDate = "grep 'Updated:' /var/log/yum.log | tail -1"
+        else:
+            payload = "echo Patching stage"
+
+    return {
+        "name": "CreateFileAndTestExists",
+        "schemaVersion": "1.0",
+        "phases": [
+            {
+                "name": "build",
+                "steps": [
+                    {
+                        "name": "Patching",
+                        "action": "ExecuteBash",
+                        "inputs": {
+                            "commands": [
+                                "echo 'Start patching stage...'",
+                                f"{payload}",
+                                f"sleep {sleepSeconds}",
+                                "echo 'Start validation stage...'",
+                                f"{lastPatchDate}",
+                            ]
+                        },
+                    }
+                ],
+            },
+        ],
+    }
+
+
+def BenchLegacy(variants):
+    started = time.perf_counter()
+    for index in range(variants):
+        yaml.dump(LegacyComponentData("Linux", IMAGES[index % len(IMAGES)], index))
+    return time.perf_counter() - started
+
+
+def BenchTemplates(variants):
+    started = time.perf_counter()
+    for index in range(variants):
+        family = COMPONENT_TEMPLATES.Family("Linux", IMAGES[index % len(IMAGES)])
+        ComponentDocumentYaml(COMPONENT_TEMPLATES.Render(family, payload=f"echo variant {index}"))
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Component document rendering benchmark")
+    parser.add_argument("-Variants", type=int, default=5000)
+    args = parser.parse_args()
+
+    legacy = BenchLegacy(args.Variants)
+    templates = BenchTemplates(args.Variants)
+    print(f"emitter: {YAML_DUMPER.__name__}")
+    print(f"before (dict literal + yaml.dump):     {args.Variants / legacy:10.0f} documents/s")
+    print(f"after  (template registry + C dumper): {args.Variants / templates:10.0f} documents/s")
+    print(f"speedup: {legacy / templates:.1f}x")
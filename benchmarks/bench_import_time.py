@@ -0,0 +1,68 @@
+###########################################################################
+############### BENCHMARK: COLD-START IMPORT TIME GUARD ###################
+###########################################################################
+# Imports a module in a fresh interpreter with `python -X importtime`,
+# reports its cumulative import time and fails (exit code 1) when it goes
+# over the budget or when the import pulled in boto3.
+#
+#   $ python benchmarks/bench_import_time.py -Module aws_create_resources -Max_ms 100
+###########################################################################
+import argparse
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def MeasureImportTime(module, runs):
+    """
+    Best cumulative import time of a module in microseconds over N cold runs
+    """
+    best = None
+    for _ in range(runs):
+        proc = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                f"import sys, {module}; print('boto3' in sys.modules)",
+            ],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        cumulative = None
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            _, cumulativeField, name = line[len("import time:"):].split("|")
+            if name.strip() == module:
+                cumulative = int(cumulativeField)
+        if cumulative is None:
+            raise RuntimeError(f"No importtime record for {module}")
+        loadedBoto3 = proc.stdout.strip() == "True"
+        best = cumulative if best is None else min(best, cumulative)
+    return best, loadedBoto3
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time guard")
+    parser.add_argument("-Module", default="aws_create_resources")
+    parser.add_argument("-Max_ms", type=float, default=100.0)
+    parser.add_argument("-Runs", type=int, default=5)
+    args = parser.parse_args()
+
+    micros, loadedBoto3 = MeasureImportTime(args.Module, args.Runs)
+    print(f"{args.Module}: {micros / 1000:.1f} ms cumulative import time (best of {args.Runs})")
+
+    failed = False
+    if loadedBoto3:
+        print(f"FAIL: importing {args.Module} loaded boto3")
+        failed = True
+    if micros / 1000 > args.Max_ms:
+        print(f"FAIL: import time is over the {args.Max_ms:.1f} ms budget")
+        failed = True
+    sys.exit(1 if failed else 0)
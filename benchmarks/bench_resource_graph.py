@@ -0,0 +1,182 @@
+###########################################################################
+########### BENCHMARK: RESOURCE GRAPH SCHEDULER OVERHEAD ##################
+###########################################################################
+# Measures the bookkeeping cost of ResourceGraph.Run() with no-op nodes, so
+# only the scheduler is timed, for each size:
+#
+#   wide/N      N independent nodes, all ready at once
+#   chain/N     N nodes, each depending on the previous one
+#   failed/N    a failing root with N dependents, all of them skipped
+#
+# Scheduling is linear in nodes plus edges, so the time per node should
+# stay flat as N grows.
+#
+# Before timing, a small EC2 graph (VPC, then a subnet and a security
+# group, then a network interface) runs against a botocore Stubber: once
+# with every call answered after a throttled create_vpc and an
+# InternalError on create_network_interface, and once with create_subnet
+# failing. The retried calls must succeed, the network interface retry must
+# reuse its ClientToken, and with the failing subnet the network interface
+# must be skipped while the security group is still created. No network
+# access or credentials are needed.
+#
+#   $ python benchmarks/bench_resource_graph.py -Sizes 100,1000,10000
+###########################################################################
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from botocore.stub import ANY, Stubber  # noqa: E402
+
+import aws_client_factory  # noqa: E402
+from aws_call_executor import ExecuteCall  # noqa: E402
+from aws_resource_graph import NodeResult, ResourceGraph  # noqa: E402
+
+DEFAULT_SIZES = "100,1000,10000"
+REGION = "us-east-1"
+
+
+########################################################################
+## Stubbed EC2 graph
+########################################################################
+def _CreateVpc(client):
+    return ExecuteCall(client, "create_vpc", CidrBlock="10.0.0.0/16")["Vpc"]["VpcId"]
+
+
+def _CreateSubnet(client, vpcId):
+    return ExecuteCall(client, "create_subnet", VpcId=vpcId, CidrBlock="10.0.1.0/24")["Subnet"]["SubnetId"]
+
+
+def _CreateSecurityGroup(client, vpcId):
+    return ExecuteCall(client, "create_security_group", VpcId=vpcId, GroupName="bench", Description="bench")["GroupId"]
+
+
+def _CreateNetworkInterface(client, subnetId, groupId):
+    res = ExecuteCall(client, "create_network_interface", SubnetId=subnetId, Groups=[groupId])
+    return res["NetworkInterface"]["NetworkInterfaceId"]
+
+
+def BuildEC2Graph(client):
+    graph = ResourceGraph()
+    graph.AddNode("VPC", _CreateVpc, args=(client,))
+    graph.AddNode("Subnet", _CreateSubnet, args=(client, NodeResult("VPC")))
+    graph.AddNode("SecurityGroup", _CreateSecurityGroup, args=(client, NodeResult("VPC")))
+    graph.AddNode(
+        "NetworkInterface", _CreateNetworkInterface,
+        args=(client, NodeResult("Subnet"), NodeResult("SecurityGroup")),
+    )
+    return graph
+
+
+def CheckStubbedGraph():
+    """
+    Run the EC2 graph against a Stubber, in declaration order (one worker),
+    with retried calls and with a failing create_subnet. Returns the
+    problems found.
+    """
+    client = aws_client_factory.GetClient(
+        "ec2", region_name=REGION, accessKey="AKIABENCHMARK", secretAccessKey="benchmark"
+    )
+    problems = []
+    tokens = []
+
+    def RecordToken(params, **kwargs):
+        tokens.append(params.get("ClientToken"))
+
+    client.meta.events.register_last("before-parameter-build.ec2.CreateNetworkInterface", RecordToken)
+    with Stubber(client) as stubber:
+        stubber.add_client_error("create_vpc", "Throttling", http_status_code=400)
+        stubber.add_response("create_vpc", {"Vpc": {"VpcId": "vpc-1"}}, {"CidrBlock": "10.0.0.0/16"})
+        stubber.add_response(
+            "create_subnet", {"Subnet": {"SubnetId": "subnet-1"}},
+            {"VpcId": "vpc-1", "CidrBlock": "10.0.1.0/24"},
+        )
+        stubber.add_response(
+            "create_security_group", {"GroupId": "sg-1"},
+            {"VpcId": "vpc-1", "GroupName": "bench", "Description": "bench"},
+        )
+        stubber.add_client_error("create_network_interface", "InternalError", http_status_code=500)
+        stubber.add_response(
+            "create_network_interface", {"NetworkInterface": {"NetworkInterfaceId": "eni-1"}},
+            {"SubnetId": "subnet-1", "Groups": ["sg-1"], "ClientToken": ANY},
+        )
+        run = BuildEC2Graph(client).Run(maxWorkers=1)
+        stubber.assert_no_pending_responses()
+    client.meta.events.unregister("before-parameter-build.ec2.CreateNetworkInterface", RecordToken)
+    if run.results.get("NetworkInterface") != "eni-1" or not run.ok:
+        problems.append(f"complete graph: results {run.results}, skipped {run.skipped}")
+    if len(tokens) != 2 or len(set(tokens)) != 1:
+        problems.append(f"retried create_network_interface sent the ClientTokens {tokens}")
+
+    with Stubber(client) as stubber:
+        stubber.add_response("create_vpc", {"Vpc": {"VpcId": "vpc-2"}})
+        stubber.add_client_error("create_subnet", "InvalidParameterValue")
+        stubber.add_response("create_security_group", {"GroupId": "sg-2"})
+        run = BuildEC2Graph(client).Run(maxWorkers=1, raiseOnError=False)
+        stubber.assert_no_pending_responses()
+        if list(run.errors) != ["Subnet"] or run.skipped != ["NetworkInterface"]:
+            problems.append(f"failed subnet: errors {list(run.errors)}, skipped {run.skipped}")
+        if run.results.get("SecurityGroup") != "sg-2":
+            problems.append(f"failed subnet: results {run.results}")
+    return problems
+
+
+########################################################################
+## Scheduler overhead
+########################################################################
+def _Noop():
+    return None
+
+
+def _Fail():
+    raise RuntimeError("bench")
+
+
+def BuildGraph(shape, size):
+    graph = ResourceGraph()
+    if shape == "wide":
+        for index in range(size):
+            graph.AddNode(f"n{index}", _Noop)
+    elif shape == "chain":
+        graph.AddNode("n0", _Noop)
+        for index in range(1, size):
+            graph.AddNode(f"n{index}", _Noop, dependsOn=[f"n{index - 1}"])
+    else:
+        graph.AddNode("root", _Fail)
+        for index in range(size):
+            graph.AddNode(f"n{index}", _Noop, dependsOn=["root"])
+    return graph
+
+
+def BenchGraph(shape, size, maxWorkers):
+    graph = BuildGraph(shape, size)
+    started = time.perf_counter()
+    run = graph.Run(maxWorkers=maxWorkers, raiseOnError=False)
+    elapsed = time.perf_counter() - started
+    expected = size if shape == "failed" else 0
+    if len(run.skipped) != expected:
+        raise AssertionError(f"{shape}/{size}: {len(run.skipped)} nodes skipped, expected {expected}")
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resource graph scheduler benchmark")
+    parser.add_argument("-Sizes", default=DEFAULT_SIZES, help="Comma separated node counts")
+    parser.add_argument("-Max_workers", type=int, default=8)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    problems = CheckStubbedGraph()
+    for problem in problems:
+        print(f"STUBBER MISMATCH {problem}")
+    print(f"stubbed EC2 graph: {'FAILED' if problems else 'OK'}")
+
+    for size in [int(size) for size in args.Sizes.split(",")]:
+        for shape in ("wide", "chain", "failed"):
+            elapsed = BenchGraph(shape, size, args.Max_workers)
+            print(f"{shape + '/' + str(size):<16} {elapsed:8.3f}s {elapsed / size * 1e6:8.1f} us/node")
+    raise SystemExit(1 if problems else 0)
@@ -0,0 +1,353 @@
+###########################################################################
+########### BENCHMARK: FULL PROVISIONING FLOWS AGAINST A STAND-IN #########
+###########################################################################
+# Runs the aws_create_resources.py flow (snapshot, plan, dependency graph)
+# and the aws_ec2_image_builder.py build matrix flow against an in-process
+# stand-in for EC2 and Image Builder, and measures wall time, API calls and
+# peak traced memory for each size:
+#
+#   ec2/N            N complete EC2 stacks, one after the other (9 resources each)
+#   imagebuilder/N   a build matrix of N pipelines (component, recipe,
+#                    pipeline and execution each, shared configurations)
+#
+# The stand-in answers every call from a botocore before-call hook with a
+# fixed -Latency, so the real clients, executor, graph and serialization
+# code paths all run, without network access or credentials.
+#
+#   $ python benchmarks/bench_stacks.py -Sizes 1,10,100,1000
+#   $ python benchmarks/bench_stacks.py -Write_baseline true
+#   $ python benchmarks/bench_stacks.py -Baseline benchmarks/baseline_stacks.json
+#
+# With -Baseline the run exits 1 when a wall time or peak memory grows past
+# its threshold, or when any API call count grows at all.
+###########################################################################
+import argparse
+import collections
+import contextlib
+import io
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import aws_call_executor  # noqa: E402
+import aws_client_factory  # noqa: E402
+import aws_create_resources as resources  # noqa: E402
+import aws_ec2_image_builder as imageBuilder  # noqa: E402
+from aws_run_id import SetRunId  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_stacks.json")
+DEFAULT_SIZES = "1,10,100,1000"
+ACCOUNT_ID = "123456789012"
+REGION = "us-east-1"
+
+
+########################################################################
+## AWS stand-in
+########################################################################
+class _HttpResponse:
+    status_code = 200
+    headers = {}
+
+
+class AwsStandIn:
+    """
+    Stateful, in-memory answers to the EC2 and Image Builder calls of both
+    flows: Create* calls add resources which Describe* calls return.
+    Installed on every client of aws_client_factory.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.calls = collections.Counter()
+        self.state = collections.defaultdict(list)
+
+    def Install(self):
+        aws_client_factory.AddClientListener(self._Register)
+
+    def _Register(self, client):
+        client.meta.events.register("before-parameter-build.*.*", self._OnParameterBuild)
+        client.meta.events.register_first("before-call.*.*", self._OnBeforeCall)
+
+    def Reset(self):
+        with self.lock:
+            self.state.clear()
+
+    def _Id(self, prefix):
+        return f"{prefix}-{next(self.ids):017x}"
+
+    @staticmethod
+    def _OnParameterBuild(params, context, **kwargs):
+        # The request parameters as passed to the client, before serialization
+        context["standInParams"] = dict(params)
+
+    def _OnBeforeCall(self, model, context, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[model.name] += 1
+            handler = getattr(self, f"_{model.name}", None)
+            return _HttpResponse(), handler(context.get("standInParams", {})) if handler else {}
+
+    def _Add(self, kind, item):
+        self.state[kind].append(item)
+        return item
+
+    # EC2
+    def _DescribeVpcs(self, params):
+        return {"Vpcs": list(self.state["vpc"])}
+
+    def _DescribeInternetGateways(self, params):
+        return {"InternetGateways": list(self.state["igw"])}
+
+    def _DescribeInstances(self, params):
+        instances = list(self.state["instance"])
+        return {"Reservations": [{"Instances": instances}] if instances else []}
+
+    @staticmethod
+    def _InSubnets(items, params):
+        # The subnet-id filter of the IP allocator; other filters are ignored
+        for item in params.get("Filters", []):
+            if item["Name"] == "subnet-id":
+                return [resource for resource in items if resource["SubnetId"] in item["Values"]]
+        return list(items)
+
+    def _DescribeNetworkInterfaces(self, params):
+        return {"NetworkInterfaces": self._InSubnets(self.state["eni"], params)}
+
+    def _DescribeSubnets(self, params):
+        return {"Subnets": self._InSubnets(self.state["subnet"], params)}
+
+    def _DescribeSecurityGroups(self, params):
+        return {"SecurityGroups": list(self.state["sg"])}
+
+    def _DescribeRouteTables(self, params):
+        return {"RouteTables": list(self.state["rtb"])}
+
+    def _CreateDefaultVpc(self, params):
+        return {"Vpc": self._Add("vpc", {"VpcId": self._Id("vpc"), "IsDefault": True})}
+
+    def _RunInstances(self, params):
+        return {"Instances": [
+            self._Add("instance", {"InstanceId": self._Id("i"), "State": {"Name": "pending"}})
+            for _ in range(params.get("MinCount", 1))
+        ]}
+
+    def _CreateSecurityGroup(self, params):
+        return {"GroupId": self._Add("sg", {"GroupId": self._Id("sg"), "GroupName": params["GroupName"]})["GroupId"]}
+
+    def _CreateInternetGateway(self, params):
+        return {"InternetGateway": self._Add("igw", {"InternetGatewayId": self._Id("igw"), "Attachments": []})}
+
+    def _CreateSubnet(self, params):
+        return {"Subnet": self._Add("subnet", {
+            "SubnetId": self._Id("subnet"), "VpcId": params["VpcId"], "CidrBlock": params["CidrBlock"],
+        })}
+
+    def _CreateNetworkInterface(self, params):
+        subnet = next(subnet for subnet in self.state["subnet"] if subnet["SubnetId"] == params["SubnetId"])
+        used = {eni["PrivateIpAddress"] for eni in self.state["eni"] if eni["SubnetId"] == params["SubnetId"]}
+        address = params.get("PrivateIpAddress") or next(
+            str(host) for host in list(ipaddress.ip_network(subnet["CidrBlock"]).hosts())[3:] if str(host) not in used
+        )
+        return {"NetworkInterface": self._Add("eni", {
+            "NetworkInterfaceId": self._Id("eni"), "SubnetId": params["SubnetId"], "PrivateIpAddress": address,
+        })}
+
+    def _CreateRouteTable(self, params):
+        return {"RouteTable": self._Add("rtb", {"RouteTableId": self._Id("rtb"), "VpcId": params["VpcId"]})}
+
+    def _AttachNetworkInterface(self, params):
+        return {"AttachmentId": self._Id("eni-attach")}
+
+    # Image Builder
+    def _Arn(self, kind, name, version=None):
+        arn = f"arn:aws:imagebuilder:{REGION}:{ACCOUNT_ID}:{kind}/{name.lower()}"
+        return f"{arn}/{version}" if version else arn
+
+    def _CreateComponent(self, params):
+        return {"componentBuildVersionArn": self._Arn("component", params["name"], f"{params['semanticVersion']}/1")}
+
+    def _CreateImageRecipe(self, params):
+        return {"imageRecipeArn": self._Arn("image-recipe", params["name"], params["semanticVersion"])}
+
+    def _CreateDistributionConfiguration(self, params):
+        return {"distributionConfigurationArn": self._Arn("distribution-configuration", params["name"])}
+
+    def _CreateInfrastructureConfiguration(self, params):
+        return {"infrastructureConfigurationArn": self._Arn("infrastructure-configuration", params["name"])}
+
+    def _CreateImagePipeline(self, params):
+        return {"imagePipelineArn": self._Arn("image-pipeline", params["name"])}
+
+    def _StartImagePipelineExecution(self, params):
+        name = params["imagePipelineArn"].rsplit("/", 1)[1]
+        return {"imageBuildVersionArn": self._Arn("image", name, f"1.0.0/{next(self.ids)}")}
+
+
+########################################################################
+## Flows
+########################################################################
+def RunEC2Stacks(standIn, size):
+    """
+    The __main__ flow of aws_create_resources.py, once per stack, each on a
+    fresh account
+    """
+    for _ in range(size):
+        standIn.Reset()
+        resources.AWS_RESOURCE_ID_CACHE.Clear()
+        existing = resources.SnapshotEC2State()
+        if resources.PlanResources(existing):
+            resources.BuildResourceGraph(existing).Run()
+
+
+def RunImageBuilderMatrix(standIn, size):
+    """
+    The -Matrix_file flow of aws_ec2_image_builder.py with size pipelines
+    """
+    cells = imageBuilder.ExpandBuildMatrix({
+        "name": "bench",
+        "defaults": {
+            "recipeOsVersion": "x.x.x",
+            "infrastructureType": "t3.micro",
+            "infrastructureInstanceProfileRoleName": "EC2ImageBuilderRole",
+        },
+        "matrix": {
+            "os": [
+                {"label": f"os{index}", "recipeImageName": f"Ubuntu Server {index} x86"}
+                for index in range(size)
+            ],
+        },
+    })
+    report = imageBuilder.RunBuildMatrix(cells, [REGION], ACCOUNT_ID)
+    failed = [row["cell"] for row in report if row["status"] != "OK"]
+    if failed:
+        raise RuntimeError(f"Build matrix cells failed: {', '.join(failed[:5])}")
+
+
+FLOWS = {
+    "ec2": RunEC2Stacks,
+    "imagebuilder": RunImageBuilderMatrix,
+}
+
+
+########################################################################
+## Measurements
+########################################################################
+def Measure(standIn, flow, size):
+    """
+    Run a flow twice: untraced for the wall time, then under tracemalloc
+    for the peak memory. Both runs must issue the same calls.
+    """
+    results = []
+    for traced in (False, True):
+        standIn.calls.clear()
+        if traced:
+            tracemalloc.start()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            FLOWS[flow](standIn, size)
+        wall = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if traced else None
+        if traced:
+            tracemalloc.stop()
+        results.append((wall, peak, dict(standIn.calls)))
+
+    (wall, _, calls), (_, peak, tracedCalls) = results
+    if calls != tracedCalls:
+        raise RuntimeError(f"{flow}/{size} issued different calls on its two runs")
+    return {
+        "wall_s": round(wall, 4),
+        "peak_mb": round(peak / 2 ** 20, 3),
+        "calls": sum(calls.values()),
+        "calls_by_operation": dict(sorted(calls.items())),
+    }
+
+
+def CompareToBaseline(current, baseline, timeThreshold, memoryThreshold):
+    """
+    Regressions of current against baseline, as readable lines
+    """
+    regressions = []
+    for key, result in current.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result["wall_s"] > base["wall_s"] * (1 + timeThreshold):
+            regressions.append(f"{key}: wall time {base['wall_s']:.3f}s -> {result['wall_s']:.3f}s")
+        if result["peak_mb"] > base["peak_mb"] * (1 + memoryThreshold):
+            regressions.append(f"{key}: peak memory {base['peak_mb']:.1f}MB -> {result['peak_mb']:.1f}MB")
+        for operation, count in result["calls_by_operation"].items():
+            baseCount = base["calls_by_operation"].get(operation, 0)
+            if count > baseCount:
+                regressions.append(f"{key}: {operation} calls {baseCount} -> {count}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline provisioning flow benchmark and regression check")
+    parser.add_argument("-Sizes", default=DEFAULT_SIZES, help="Comma separated stack sizes")
+    parser.add_argument("-Flows", default=",".join(FLOWS), help="Comma separated flows: ec2,imagebuilder")
+    parser.add_argument("-Latency", type=float, default=0.001, help="Seconds the stand-in waits per call")
+    parser.add_argument("-Rate_limits", choices=["true", "false"], default="false",
+                        help="Keep the per-service client-side rate limits (they dominate large sizes)")
+    parser.add_argument("-Baseline", help="Exit 1 on regressions against this baseline JSON")
+    parser.add_argument("-Write_baseline", choices=["true", "false"], default="false",
+                        help=f"Write the results to -Output, by default {BASELINE_PATH}")
+    parser.add_argument("-Output", help="Write the results to a JSON file")
+    parser.add_argument("-Time_threshold", type=float, default=0.5, help="Allowed relative wall time growth")
+    parser.add_argument("-Memory_threshold", type=float, default=0.25, help="Allowed relative peak memory growth")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.Rate_limits == "false":
+        aws_call_executor.AWS_CALL_RATE_LIMITS = {}
+        aws_call_executor.AWS_CALL_DEFAULT_RATE_LIMIT = 1e6
+        aws_call_executor.ResetCallLanes()
+    SetRunId("benchmark")
+
+    standIn = AwsStandIn(args.Latency)
+    standIn.Install()
+    flows = args.Flows.split(",")
+    sizes = [int(size) for size in args.Sizes.split(",")]
+
+    # Build the clients and load the service models outside of the measurements
+    for flow in flows:
+        with contextlib.redirect_stdout(io.StringIO()):
+            FLOWS[flow](standIn, 1)
+
+    current = {}
+    for flow in flows:
+        for size in sizes:
+            result = current[f"{flow}/{size}"] = Measure(standIn, flow, size)
+            print(
+                f"{flow + '/' + str(size):20} {result['wall_s']:9.3f}s {result['calls']:7} calls "
+                f"{result['peak_mb']:9.1f}MB peak"
+            )
+
+    output = args.Output or (BASELINE_PATH if args.Write_baseline == "true" else None)
+    if output:
+        with open(output, "w") as outputFile:
+            json.dump({"latency": args.Latency, "results": current}, outputFile, indent=2, sort_keys=True)
+            outputFile.write("\n")
+
+    if args.Baseline:
+        with open(args.Baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        if baseline.get("latency") != args.Latency:
+            print(f"warning: baseline was recorded with -Latency {baseline.get('latency')}")
+        regressions = CompareToBaseline(current, baseline["results"], args.Time_threshold, args.Memory_threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("no regressions against the baseline")